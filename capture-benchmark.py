@@ -0,0 +1,802 @@
+#!/usr/bin/env python
+# Benchmark for the Python side of CAPTURE: capture-benchmark.py
+# It makes synthetic uGMRT-like data sets, loads the functions of capture-pipeline-V0.py with light
+# stand-ins for the CASA tools and tasks and times the pipeline steps that run in Python at growing sizes,
+# so that a change in how a step scales shows up without a CASA installation.
+# Run it with the python that CASA uses (Python 2 with numpy), e.g.:
+#	python capture-benchmark.py
+#	python capture-benchmark.py --nants 16,30 --nchans 128,1024,4096,16384 --scans FPTPTPTPF --out bench_output.txt
+# The synthetic data sets are written to a temporary directory (made inside --workdir when it is given) and removed at the end.
+# With --check it instead runs the whole pipeline script end to end on a small synthetic data set, worker processes
+# included, and checks the files and the manifest it leaves, e.g.:
+#	python capture-benchmark.py --check resume
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import optparse
+import tempfile
+import traceback
+import subprocess
+import numpy as np
+
+mypipeline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'capture-pipeline-V0.py')
+mycalfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vla-cals.list')
+gmrtants = ['C00','C01','C02','C03','C04','C05','C06','C08','C09','C10','C11','C12','C13','C14',
+	'E02','E03','E04','E05','E06','S01','S02','S03','S04','S06','W01','W02','W03','W04','W05','W06']
+rfifreqall = [0.36E09,0.3796E09,0.486E09,0.49355E09,0.8808E09,0.885596E09,0.7646E09,0.769092E09]	# as in the badchans stage
+mybands = {'band3': (300.0E06, 500.0E06), 'band4': (550.0E06, 750.0E06), 'band5': (1050.0E06, 1450.0E06)}
+myfieldlist = {'F': ('3C286', 3.5392577, 0.5324946), 'P': ('0837-198', 2.2566481, -0.3464394), 'T': ('TARGET', 2.3170000, -0.3300000),
+	'U': ('TARGET2', 2.3300000, -0.3100000)}
+
+#############################################################
+# Tables: a table is a directory with one .npy file per column; the last axis of a column is the row.
+#############################################################
+
+def writetable(mypath,mycols):
+	'''write a table with the given columns'''
+	if not os.path.isdir(mypath):
+		os.makedirs(mypath)
+	for myname in mycols.keys():
+		np.save(os.path.join(mypath, myname+'.npy'), mycols[myname])
+
+
+class benchsel:
+	'''rows of a table, as returned by tb.open and tb.query'''
+	def __init__(self,mypath,myrows,nomodify=True):
+		self.mypath = mypath
+		self.myrows = myrows
+		self.nomodify = nomodify
+	def _col(self,myname):
+		if self.nomodify == True:
+			return np.load(os.path.join(self.mypath, myname+'.npy'), mmap_mode='r')
+		return np.load(os.path.join(self.mypath, myname+'.npy'), mmap_mode='r+')
+	def _rows(self,startrow,nrow):
+		if nrow < 0:
+			return self.myrows[startrow:]
+		return self.myrows[startrow:startrow+nrow]
+	def nrows(self):
+		return len(self.myrows)
+	def rownumbers(self):
+		return np.array(self.myrows)
+	def getcell(self,myname,myrow):
+		return np.array(self._col(myname)[...,self.myrows[myrow]])
+	def colnames(self):
+		return sorted([myname[:-4] for myname in os.listdir(self.mypath) if myname.endswith('.npy')])
+	def getcol(self,myname,startrow=0,nrow=-1):
+		mycol = self._col(myname)
+		myrows = self._rows(startrow,nrow)
+		if len(myrows) > 0 and myrows[-1]-myrows[0] == len(myrows)-1:
+			return np.array(mycol[...,myrows[0]:myrows[-1]+1])	# contiguous rows are read as a slice
+		return np.array(mycol[...,myrows])
+	def getcolslice(self,myname,blc,trc,incr=[],startrow=0,nrow=-1):
+		mycol = self._col(myname)
+		myrows = self._rows(startrow,nrow)
+		return np.array(mycol[blc[0]:trc[0]+1,blc[1]:trc[1]+1][...,myrows])
+	def putcol(self,myname,myvalue,startrow=0,nrow=-1):
+		mycol = self._col(myname)
+		mycol[...,self._rows(startrow,nrow)] = myvalue
+		mycol.flush()
+	def query(self,myquery,name='',sortlist='',columns=''):
+		'''selection for queries made of COL==n and COL IN [a,b,...] joined with &&'''
+		mymask = np.ones(len(self.myrows), dtype=bool)
+		for myterm in myquery.split('&&'):
+			mymatch = re.match(r'\s*(\w+)\s*==\s*(-?\d+)\s*$', myterm)
+			if mymatch is not None:
+				mymask &= self.getcol(mymatch.group(1)) == int(mymatch.group(2))
+				continue
+			mymatch = re.match(r'\s*(\w+)\s+IN\s+\[([^\]]*)\]\s*$', myterm)
+			if mymatch is None:
+				raise ValueError('query not supported by the benchmark tables: '+myquery)
+			myvalues = [int(myvalue) for myvalue in mymatch.group(2).split(',') if myvalue.strip() != '']
+			mymask &= np.in1d(self.getcol(mymatch.group(1)), myvalues)
+		return benchsel(self.mypath, self.myrows[mymask], self.nomodify)
+	def selectrows(self,myrows):
+		return benchsel(self.mypath, self.myrows[np.asarray(myrows, dtype=int)], self.nomodify)
+	def removecols(self,mynames):
+		if type(mynames) == str:
+			mynames = [mynames]
+		for myname in mynames:
+			os.remove(os.path.join(self.mypath, myname+'.npy'))
+	def close(self):
+		pass
+
+
+class benchtb(benchsel):
+	'''stand-in for the CASA table tool on benchmark tables'''
+	def __init__(self):
+		benchsel.__init__(self, '', np.zeros(0, dtype=int))
+	def open(self,mypath,nomodify=True):
+		mypath = mypath.rstrip('/')
+		if os.path.exists(os.path.join(mypath, 'MAIN')):
+			mypath = os.path.join(mypath, 'MAIN')
+		self.mypath = mypath
+		self.nomodify = nomodify
+		mycols = [myname for myname in os.listdir(mypath) if myname.endswith('.npy')]
+		self.myrows = np.arange(np.load(os.path.join(mypath, mycols[0]), mmap_mode='r').shape[-1])
+	def copyrows(self,outtable,startrowin=0,startrowout=-1,nrow=-1):
+		myout = benchtb()
+		myout.open(outtable)
+		for myname in self.colnames():
+			myrows = self.getcol(myname, startrowin, nrow)
+			np.save(os.path.join(myout.mypath, myname+'.npy'), np.concatenate([myout.getcol(myname), myrows], axis=-1))
+
+
+class benchmsmd:
+	'''stand-in for the CASA msmetadata tool on benchmark measurement sets'''
+	def open(self,msfile):
+		self.msfile = msfile
+		self.mytb = benchtb()
+	def _getcol(self,mytable,mycol):
+		self.mytb.open(os.path.join(self.msfile, mytable))
+		return self.mytb.getcol(mycol)
+	def fieldnames(self):
+		return list(self._getcol('FIELD','NAME'))
+	def scansforfield(self,myfield):
+		myid = self.fieldnames().index(myfield)
+		return np.unique(self._getcol('MAIN','SCAN_NUMBER')[self._getcol('MAIN','FIELD_ID') == myid])
+	def phasecenter(self,myid):
+		mydir = self._getcol('FIELD','PHASE_DIR')[:,0,myid]
+		return {'m0': {'value': float(mydir[0]), 'unit': 'rad'}, 'm1': {'value': float(mydir[1]), 'unit': 'rad'}, 'refer': 'J2000'}
+	def antennanames(self):
+		return list(self._getcol('ANTENNA','NAME'))
+	def antennaposition(self,myid):
+		mypos = self._getcol('ANTENNA','POSITION')[:,myid]
+		return {'m0': {'value': float(mypos[0]), 'unit': 'm'}, 'm1': {'value': float(mypos[1]), 'unit': 'm'}, 'm2': {'value': float(mypos[2]), 'unit': 'm'}}
+	def scannumbers(self):
+		return np.unique(self._getcol('MAIN','SCAN_NUMBER'))
+	def antennasforscan(self,myscan):
+		mysel = self._getcol('MAIN','SCAN_NUMBER') == myscan
+		return np.unique(np.concatenate([self._getcol('MAIN','ANTENNA1')[mysel], self._getcol('MAIN','ANTENNA2')[mysel]]))
+	def nspw(self):
+		return self._getcol('SPECTRAL_WINDOW','CHAN_FREQ').shape[-1]
+	def nchan(self,myspw):
+		return self._getcol('SPECTRAL_WINDOW','CHAN_FREQ').shape[0]
+	def chanfreqs(self,myspw):
+		return self._getcol('SPECTRAL_WINDOW','CHAN_FREQ')[:,myspw]
+	def done(self):
+		pass
+
+
+class benchlog:
+	def filter(self,mylevel='INFO'):
+		pass
+	def post(self,mymessage,priority='INFO',origin=''):
+		pass
+
+
+class benchtasks:
+	'''stand-ins for the CASA tasks that the timed steps call. They do the file handling of the real tasks
+	(new tables, copied measurement sets, flag versions) but no processing of the visibilities.'''
+	def __init__(self):
+		self.ncleans = 0
+	def default(self,mytask=None):
+		pass
+	def flagdata(self,vis='',mode='manual',**kwargs):
+		if mode == 'summary':
+			mytb = benchtb()
+			mytb.open(vis)
+			myflag = mytb.getcol('FLAG')
+			myfields = benchmsmd()
+			myfields.open(vis)
+			return {'field': dict([(myfield, {'flagged': float(myflag.sum()), 'total': float(myflag.size)}) for myfield in myfields.fieldnames()])}
+		if mode == 'list' and kwargs.get('action') == 'apply':
+			mytb = benchtb()
+			mytb.open(vis, nomodify=False)
+			myamp = np.abs(mytb.getcol('DATA'))
+			for mycmd in kwargs.get('inpfile', []):	# every command flags the points above five times the median of their row
+				myamp[np.asarray(mytb.getcol('FLAG'))] = 0.0
+				mytb.putcol('FLAG', mytb.getcol('FLAG') | (myamp > 5.0*np.median(myamp, axis=1)[:,np.newaxis,:]))
+		return {}
+	def flagmanager(self,vis='',mode='list',versionname='',**kwargs):
+		myversion = os.path.join(vis.rstrip('/')+'.flagversions', 'flags.'+versionname)
+		if mode == 'save':
+			os.makedirs(myversion)
+			shutil.copy(os.path.join(vis, 'MAIN', 'FLAG.npy'), myversion)
+		elif mode == 'delete':
+			shutil.rmtree(myversion, True)
+		return {}
+	def tclean(self,vis='',imagename='',nterms=1,niter=0,**kwargs):
+		'''images whose peak stays put while the residual rms drops with every clean'''
+		self.ncleans += 1
+		if nterms > 1:
+			mysuffix = '.tt0'
+		else:
+			mysuffix = ''
+		writetable(imagename+'.image'+mysuffix, {'map': np.array([[1.0]])})
+		writetable(imagename+'.residual'+mysuffix, {'map': np.array([[1.0E-03/(1.0+0.5*self.ncleans)]])})
+		writetable(imagename+'.model'+mysuffix, {'map': np.zeros((1,1))})
+		if kwargs.get('savemodel') == 'modelcolumn':
+			mytb = benchtb()
+			mytb.open(vis)
+			mydata = mytb.getcol('DATA')
+			mymodel = np.lib.format.open_memmap(os.path.join(mytb.mypath, 'MODEL_DATA.npy'), mode='w+', dtype=mydata.dtype, shape=mydata.shape)
+			mymodel[:] = np.median(mydata.real, axis=2)[:,:,np.newaxis]	# the noiseless bandpass
+			mymodel.flush()
+	def clean(self,**kwargs):
+		self.tclean(**kwargs)
+	def imstat(self,imagename=''):
+		mymap = np.load(os.path.join(imagename, 'map.npy'))
+		return {'max': np.array([mymap.max()]), 'medabsdevmed': np.array([mymap.max()/1.4826])}
+	def exportfits(self,imagename='',fitsimage='',**kwargs):
+		open(fitsimage,'w').close()
+	def setjy(self,**kwargs):
+		return {}
+	def gaincal(self,vis='',caltable='',**kwargs):
+		mytb = benchtb()
+		mytb.open(vis)
+		nant = len(np.unique(np.concatenate([mytb.getcol('ANTENNA1'), mytb.getcol('ANTENNA2')])))
+		nsol = nant*len(np.unique(mytb.getcol('SCAN_NUMBER')))
+		myrandom = np.random.RandomState(nsol)
+		writetable(os.path.join(caltable, 'MAIN'), {'CPARAM': np.exp(1j*myrandom.normal(0.0, 0.1, (2,1,nsol))).astype(np.complex64),
+			'SNR': myrandom.uniform(5.0, 50.0, (2,1,nsol)), 'FLAG': np.zeros((2,1,nsol), dtype=bool),
+			'TIME': np.zeros(nsol), 'FIELD_ID': np.zeros(nsol, dtype=int), 'ANTENNA1': np.arange(nsol) % nant})
+	def bandpass(self,**kwargs):
+		self.gaincal(**kwargs)
+	def fluxscale(self,caltable='',fluxtable='',**kwargs):
+		shutil.rmtree(fluxtable, True)
+		shutil.copytree(caltable, fluxtable)
+		return {}
+	def applycal(self,**kwargs):
+		pass
+	def clearcal(self,**kwargs):
+		pass
+	def mstransform(self,vis='',outputvis='',scan='',**kwargs):
+		'''a copy of the ms; a scan selection keeps the rows of those scans, in reverse order as mstransform need not keep the order'''
+		shutil.rmtree(outputvis, True)
+		shutil.copytree(vis, outputvis)
+		if scan != '':
+			mytb = benchtb()
+			mytb.open(outputvis)
+			myrows = mytb.rownumbers()[np.in1d(mytb.getcol('SCAN_NUMBER'), [int(myscan) for myscan in scan.split(',')])][::-1]
+			for myname in mytb.colnames():
+				np.save(os.path.join(mytb.mypath, myname+'.npy'), mytb.getcol(myname)[...,myrows])
+	def importgmrt(self,fitsfile='',vis='',**kwargs):
+		'''the synthetic data sets stand in for the FITS files too'''
+		shutil.rmtree(vis, True)
+		shutil.copytree(fitsfile, vis)
+	def virtualconcat(self,vis=[],concatvis='',keepcopy=False,**kwargs):
+		shutil.rmtree(concatvis, True)
+		shutil.copytree(vis[0], concatvis)
+		if keepcopy == False:
+			for myvis in vis:
+				shutil.rmtree(myvis, True)
+
+
+#############################################################
+# Synthetic data
+#############################################################
+
+def makesynthms(msfile,nant,nchan,myscanlayout,ntime,myrfi,myband='band4',nbadants=2,myseed=1):
+	'''write a synthetic uGMRT-like measurement set: nant antennas with C/E/S/W arm positions, nchan channels
+	across the band with a bandpass that rolls off at the edges, one scan per letter of myscanlayout (F flux calibrator, P phase calibrator, T target) with
+	ntime integrations each, RR and LL with unit amplitude and noise, nbadants antennas with low amplitude,
+	strong RFI in the known RFI ranges and in a fraction myrfi of random channels and integrations'''
+	myrandom = np.random.RandomState(myseed)
+	myantnames = gmrtants[0:nant]
+	mypos = np.zeros((3,nant))
+	for j in range(0,nant):
+		myarm = {'C': (0.0, 1.0E03), 'E': (1.2, 14.0E03), 'S': (3.3, 14.0E03), 'W': (5.4, 14.0E03)}[myantnames[j][0]]
+		myradius = myrandom.uniform(0.1, 1.0)*myarm[1]
+		myangle = myarm[0]+myrandom.normal(0.0, 0.05)
+		if myantnames[j][0] == 'C':
+			myangle = myrandom.uniform(0.0, 2.0*np.pi)
+		mypos[:,j] = [myradius*np.cos(myangle), myradius*np.sin(myangle), myrandom.normal(0.0, 5.0)]
+	mypos += np.array([[1656342.3], [5797947.8], [2073243.2]])	# GMRT, ITRF
+	myant1, myant2 = np.triu_indices(nant, 1)
+	nbl = len(myant1)
+	myfields = []
+	for myletter in myscanlayout:
+		if myfieldlist[myletter][0] not in myfields:
+			myfields.append(myfieldlist[myletter][0])
+	nrows = len(myscanlayout)*ntime*nbl
+	myfreqs = np.linspace(mybands[myband][0], mybands[myband][1], nchan)
+	myrfichans = np.zeros(nchan, dtype=bool)
+	for k in range(0,len(rfifreqall),2):
+		myrfichans |= (myfreqs >= rfifreqall[k]) & (myfreqs <= rfifreqall[k+1])
+	myedge = np.minimum(np.arange(nchan), np.arange(nchan)[::-1])/(0.04*nchan)
+	mybandpass = (np.tanh(2.0*(myedge-1.0))+1.0)/2.0	# roll-off over the outer few per cent of the band
+	mybadants = myrandom.choice(nant, nbadants, replace=False)
+	os.makedirs(os.path.join(msfile, 'MAIN'))
+	mydata = np.lib.format.open_memmap(os.path.join(msfile, 'MAIN', 'DATA.npy'), mode='w+', dtype=np.complex64, shape=(2,nchan,nrows))
+	myflag = np.lib.format.open_memmap(os.path.join(msfile, 'MAIN', 'FLAG.npy'), mode='w+', dtype=bool, shape=(2,nchan,nrows))
+	mycols = {'FLAG_ROW': np.zeros(nrows, dtype=bool), 'ANTENNA1': np.zeros(nrows, dtype=np.int32), 'ANTENNA2': np.zeros(nrows, dtype=np.int32), 'SCAN_NUMBER': np.zeros(nrows, dtype=np.int32),
+		'FIELD_ID': np.zeros(nrows, dtype=np.int32), 'DATA_DESC_ID': np.zeros(nrows, dtype=np.int32), 'TIME': np.zeros(nrows), 'UVW': np.zeros((3,nrows))}
+	mytime0 = 58000.0*86400.0
+	myrow = 0
+	for myscan in range(0,len(myscanlayout)):
+		myfield = myfields.index(myfieldlist[myscanlayout[myscan]][0])
+		for mytime in range(0,ntime):
+			mytimestamp = mytime0+(myscan*ntime+mytime)*16.0
+			myrows = slice(myrow, myrow+nbl)
+			mycols['ANTENNA1'][myrows] = myant1
+			mycols['ANTENNA2'][myrows] = myant2
+			mycols['SCAN_NUMBER'][myrows] = myscan+1
+			mycols['FIELD_ID'][myrows] = myfield
+			mycols['TIME'][myrows] = mytimestamp
+			myha = 2.0*np.pi*(mytimestamp % 86400.0)/86400.0
+			mybl = mypos[:,myant2]-mypos[:,myant1]
+			mycols['UVW'][:,myrows] = [mybl[0]*np.cos(myha)-mybl[1]*np.sin(myha), mybl[0]*np.sin(myha)+mybl[1]*np.cos(myha), mybl[2]]
+			myvis = (mybandpass.reshape(1,nchan,1)+myrandom.normal(0.0, 0.1, (2,nchan,nbl))+1j*myrandom.normal(0.0, 0.1, (2,nchan,nbl))).astype(np.complex64)
+			mybad = np.in1d(myant1, mybadants) | np.in1d(myant2, mybadants)
+			myvis[:,:,mybad] *= 0.05
+			myvis[:,myrfichans,:] *= 50.0
+			myspikes = myrandom.uniform(0.0, 1.0, nchan) < myrfi
+			myvis[:,myspikes,:] *= 20.0
+			mydata[:,:,myrows] = myvis
+			myrow += nbl
+	myflag[:] = False
+	mydata.flush()
+	myflag.flush()
+	del mydata, myflag
+	writetable(os.path.join(msfile, 'MAIN'), mycols)
+	writetable(os.path.join(msfile, 'ANTENNA'), {'NAME': np.array(myantnames), 'POSITION': mypos})
+	myradec = dict([(myfieldlist[myletter][0], myfieldlist[myletter][1:]) for myletter in myfieldlist.keys()])
+	writetable(os.path.join(msfile, 'FIELD'), {'NAME': np.array(myfields),
+		'PHASE_DIR': np.array([myradec[myname] for myname in myfields]).T.reshape(2,1,len(myfields))})
+	writetable(os.path.join(msfile, 'SPECTRAL_WINDOW'), {'CHAN_FREQ': myfreqs.reshape(nchan,1)})
+	writetable(os.path.join(msfile, 'DATA_DESCRIPTION'), {'SPECTRAL_WINDOW_ID': np.array([0])})
+	writetable(os.path.join(msfile, 'POLARIZATION'), {'CORR_TYPE': np.array([[5],[8]])})
+	writetable(os.path.join(msfile, 'OBSERVATION'), {'TIME_RANGE': np.array([[mytime0],[mytime0+len(myscanlayout)*ntime*16.0]])})
+	return nrows, [myantnames[j] for j in mybadants]
+
+
+#############################################################
+# The pipeline functions with the stand-ins
+#############################################################
+
+def getstandins():
+	'''namespace with the stand-ins for the CASA tools and tasks'''
+	mytasks = benchtasks()
+	myns = {'os': os, 'np': np, 'tb': benchtb(), 'tbtool': benchtb, 'msmd': benchmsmd(), 'casalog': benchlog(),
+		'vis': ''}	# casa keeps the task parameters as globals, and default() sets vis to ''
+	for myname in ['default','flagdata','flagmanager','tclean','clean','imstat','exportfits','setjy','gaincal','bandpass','fluxscale',
+			'applycal','clearcal','mstransform','importgmrt','virtualconcat']:
+		myns[myname] = getattr(mytasks, myname)
+	return myns
+
+
+def loadpipeline():
+	'''namespace with the inputs and functions of the pipeline script, using the stand-ins instead of CASA'''
+	mytext = open(mypipeline).read()
+	mytext = mytext[0:mytext.index('#############End of functions')]
+	myns = getstandins()
+	myns['__name__'] = 'capture'
+	os.environ.pop('CAPTURE_STAGES', None)
+	exec(compile(mytext, mypipeline, 'exec'), myns)
+	myns['runreport'] = ''
+	myns['doresume'] = False
+	myns['imagepost'] = False	# the stand-in exportfits writes empty files
+	return myns
+
+
+def getchanwindow(nchan):
+	'''the visstat channel window that the pipeline uses for nchan channels'''
+	return '0:%d~%d' % (int(nchan*0.25), int(nchan*0.29))
+
+
+def benchfindbadants(myns,msfile):
+	myfields = myns['getfields'](msfile)
+	myampcals, mypcals, mytargets = myns['getfieldtypes'](msfile,'vla-cals.list',myns['calpostol'])
+	mycalscans = sum([myns['getscans'](msfile,myfield) for myfield in myampcals+mypcals], [])
+	mytgtscans = sum([myns['getscans'](msfile,myfield) for myfield in mytargets], [])
+	myantlist = myns['getantlist'](msfile,mycalscans[0])
+	return myns['getbadants'](msfile,getchanwindow(myns['getnchan'](msfile)),myantlist,mycalscans,mytgtscans,0.4,['rr','ll'])[1]
+
+
+def benchchanwindows(myns,msfile):
+	myampcals, mypcals, mytargets = myns['getfieldtypes'](msfile,'vla-cals.list',myns['calpostol'])
+	if os.path.exists(msfile+'.calcache.json'):
+		os.remove(msfile+'.calcache.json')	# time the derivation, not the cache
+	return myns['getchanwindows'](msfile,myns['getscans'](msfile,myampcals[0])[0:1]+myns['getscans'](msfile,mypcals[0])[0:1])
+
+
+def benchfindbadchans(myns,msfile):
+	return myns['getrfiflagspw'](msfile,rfifreqall,'')
+
+
+def benchgetbllists(myns,msfile):
+	return myns['getbllists'](msfile)
+
+
+def benchfieldtypes(myns,msfile):
+	return myns['getfieldtypes'](msfile,'vla-cals.list',myns['calpostol'])
+
+
+def benchselfcal(myns,msfile):
+	'''four self-cal loops, two of them phase-only, on a copy of the averaged target data'''
+	shutil.rmtree('selfcal-in.ms', True)
+	shutil.copytree(msfile, 'selfcal-in.ms')
+	myns['mymanifest'] = {'stages': {}}
+	return myns['myselfcal'](['selfcal-in.ms'],'C00',4,2,0.01,['1.0arcsec'],[1024],2,-1,
+		['8.0min','4.0min','8.0min','4.0min'],[0.0,10.0],'','',False)[2]
+
+
+def benchresidflag(myns,msfile):
+	'''residual flagging of the averaged target data against a model of the bandpass'''
+	shutil.rmtree('residflag-in.ms', True)
+	shutil.copytree(msfile, 'residflag-in.ms')
+	myns['tclean'](vis='residflag-in.ms', imagename='residflag-img', savemodel='modelcolumn')
+	return myns['flagresidualnp']('residflag-in.ms',[0.0,10.0])
+
+
+mybenchmarks = [('chanwindows', benchchanwindows, 'full'), ('findbadants', benchfindbadants, 'full'), ('findbadchans', benchfindbadchans, 'full'),
+	('getbllists', benchgetbllists, 'full'), ('getfieldtypes', benchfieldtypes, 'full'), ('selfcal', benchselfcal, 'avg'),
+	('residflag', benchresidflag, 'avg')]
+
+def runbenchmarks(mynants,mynchans,myscanlayout,ntime,myrfi,myband,nrepeat,myworkdir,myverbose=False):
+	'''time every step at every size; returns a list of result dictionaries. The files made for every size
+	are removed after it; what was in myworkdir before is left alone.'''
+	myresults = []
+	mystdout = sys.stdout
+	mycwd = os.getcwd()
+	os.chdir(myworkdir)
+	myoldnames = set(os.listdir('.'))
+	if not os.path.exists('vla-cals.list'):
+		shutil.copy(mycalfile, 'vla-cals.list')
+	try:
+		for nant in mynants:
+			for nchan in mynchans:
+				myns = loadpipeline()
+				mymsfile = 'synth-%dant-%dchan.ms' % (nant, nchan)
+				myavgfile = 'synth-%dant-%dchan-avg.ms' % (nant, nchan)
+				mytime0 = time.time()
+				nrows, mybadants = makesynthms(mymsfile,nant,nchan,myscanlayout,ntime,myrfi,myband)
+				makesynthms(myavgfile,nant,max(nchan/10,1),'T'*len(myscanlayout),ntime,0.0,myband,0)
+				print "Made %s (%d rows, bad antennas %s) in %.1f s." % (mymsfile, nrows, mybadants, time.time()-mytime0)
+				mytime0 = time.time()
+				myns['getmsmeta'](mymsfile)
+				myresults.append({'nant': nant, 'nchan': nchan, 'nrows': nrows, 'step': 'getmsmeta', 'seconds': time.time()-mytime0})
+				for mystep, myfunction, myinput in mybenchmarks:
+					mytimes = []
+					for k in range(0,nrepeat):
+						if myverbose == False:
+							sys.stdout = open(os.devnull,'w')	# the messages of the pipeline functions
+						mytime0 = time.time()
+						try:
+							if myinput == 'full':
+								myfunction(myns,mymsfile)
+							else:
+								myfunction(myns,myavgfile)
+						finally:
+							mytimes.append(time.time()-mytime0)
+							sys.stdout = mystdout
+					myresults.append({'nant': nant, 'nchan': nchan, 'nrows': nrows, 'step': mystep, 'seconds': min(mytimes)})
+					print "%-14s %4d antennas %6d channels: %.3f s" % (mystep, nant, nchan, min(mytimes))
+				for myname in os.listdir('.'):
+					if myname not in myoldnames and myname != 'vla-cals.list' and myname != 'vla-cals.list.pkl':
+						if os.path.isdir(myname):
+							shutil.rmtree(myname)
+						else:
+							os.remove(myname)
+	finally:
+		os.chdir(mycwd)
+	return myresults
+
+
+#############################################################
+# End-to-end runs of the pipeline script with the stand-ins
+#############################################################
+
+mycheckinputs = {'fromlta': False, 'fromraw': False, 'myfile1': 'multi.ms', 'myrefant': 'C00', 'mywidth2': 4, 'mycell': ['1.0arcsec'],
+	'myimsize': [64], 'scaloops': 2, 'mypcaloops': 1, 'mysolint2': ['8.0min','4.0min'], 'imagepost': False}
+mycheckstages = ['fromms','findbadants','flagbadants','findbadchans','flagbadfreq','myflaginit','doinitcal','mydoflag','redocal','dosplit',
+	'mysplitflag','dosplitavg','doflagavg','makedirty','doselfcal']
+
+def runcasa(myscriptfile):
+	'''stand-in for "casa -c script": runs a script with the stand-ins and, as casa does, prints an exception
+	raised by the script and exits with 0; with BENCH_FAILWORKERS set the scripts of worker processes fail'''
+	myns = getstandins()
+	myns['__name__'] = '__main__'
+	try:
+		if os.environ.has_key('BENCH_FAILWORKERS') and os.environ.has_key('CAPTURE_STAGES'):
+			raise RuntimeError('worker failed on purpose by the check')
+		execfile(myscriptfile, myns)
+	except Exception:
+		traceback.print_exc()
+	sys.stdout.flush()
+	sys.exit(0)
+
+
+def runcheckpipeline(myrundir,myinputs,mylog,myextraenv={}):
+	'''run the pipeline script in myrundir with the inputs of mycheckinputs and myinputs set after its input block and
+	the stand-ins as casa for it and for its worker processes; returns the output of the run'''
+	myinputs = dict(mycheckinputs, casabin='%s %s --casa' % (sys.executable, os.path.abspath(__file__)), **myinputs)
+	mytext = open(mypipeline).read()
+	mymarker = '# A pipeline started by runworkers gets its stages'
+	mylines = ['%s = %r' % (myname, myinputs[myname]) for myname in sorted(myinputs.keys())]
+	mytext = mytext.replace(mymarker, '\n'.join(mylines)+'\n'+mymarker, 1)
+	open(os.path.join(myrundir, 'capture-pipeline-V0.py'),'w').write(mytext)
+	myenv = dict(os.environ)
+	for myname in myenv.keys():
+		if myname.startswith('CAPTURE_'):
+			del myenv[myname]
+	myenv.update(myextraenv)
+	myout = open(os.path.join(myrundir, mylog),'w')
+	subprocess.call([sys.executable, os.path.abspath(__file__), '--casa', '-c', 'capture-pipeline-V0.py'], cwd=myrundir, env=myenv,
+		stdout=myout, stderr=subprocess.STDOUT)
+	myout.close()
+	return open(os.path.join(myrundir, mylog)).read()
+
+
+def getcheckmanifest(myrundir):
+	'''stages recorded in the manifest of a run'''
+	if not os.path.exists(os.path.join(myrundir, 'capture-manifest.json')):
+		return {}
+	return json.load(open(os.path.join(myrundir, 'capture-manifest.json')))['stages']
+
+
+def checkresume(myworkdir):
+	'''a full run, then a run that resumes after the split with fromms False, as a worker process does'''
+	myrundir = os.path.join(myworkdir, 'resume')
+	os.makedirs(myrundir)
+	shutil.copy(mycalfile, myrundir)
+	makesynthms(os.path.join(myrundir, 'multi.ms'), 8, 64, 'FPTPF', 2, 0.01)
+	myproblems = []
+	myoutput = runcheckpipeline(myrundir, dict([(mystage, mystage != 'makedirty') for mystage in mycheckstages]), 'run1.log')
+	if 'Traceback' in myoutput:
+		myproblems.append('the full run failed; see run1.log')
+	mystages = getcheckmanifest(myrundir)
+	for mystage in ['badants','badchans','flaginit','initcal','doflag','redocal','split','splitflag','splitavg','flagavg','selfcal0','selfcal1']:
+		if not mystages.has_key(mystage):
+			myproblems.append('the full run did not record the stage '+mystage)
+	if myproblems != []:
+		return myproblems
+	myinputs = dict([(mystage, mystage in ['mysplitflag','dosplitavg','doflagavg','doselfcal']) for mystage in mycheckstages])
+	myinputs['mysplitfile'] = str(mystages['split']['outputs']['mysplitfile'])
+	myoutput = runcheckpipeline(myrundir, myinputs, 'run2.log')
+	if 'Traceback' in myoutput:
+		myproblems.append('the resumed run with fromms False failed; see run2.log')
+	for mystage in ['splitflag','splitavg','flagavg','selfcal0','selfcal1','selfcal2']:
+		if 'Stage %s is up to date' % (mystage) not in myoutput:
+			myproblems.append('the resumed run did not skip the stage '+mystage)
+	return myproblems
+
+
+def checkpool(myworkdir):
+	'''two targets taken through the post-split stages by the target pool, each in its own worker process'''
+	myrundir = os.path.join(myworkdir, 'pool')
+	os.makedirs(myrundir)
+	shutil.copy(mycalfile, myrundir)
+	makesynthms(os.path.join(myrundir, 'multi.ms'), 8, 64, 'FPTPUPF', 2, 0.01)
+	myinputs = dict([(mystage, mystage != 'makedirty') for mystage in mycheckstages])
+	myinputs['dotargetpool'] = True
+	myoutput = runcheckpipeline(myrundir, myinputs, 'run1.log')
+	myproblems = []
+	if 'Traceback' in myoutput:
+		myproblems.append('the run failed; see run1.log')
+	for mytarget in ['TARGET','TARGET2']:
+		myworker = os.path.join(myrundir, mytarget+'split-work')
+		if not os.path.exists(os.path.join(myworker, 'capture-worker.done')):
+			myproblems.append('the worker of %s did not get to the end; see %s' % (mytarget, os.path.join(myworker, 'capture-worker.log')))
+			continue
+		mystages = getcheckmanifest(myworker)
+		for mystage in ['splitflag','splitavg','flagavg','selfcal0','selfcal1','selfcal2']:
+			if not mystages.has_key(mystage):
+				myproblems.append('the worker of %s did not record the stage %s' % (mytarget, mystage))
+		if not os.path.exists(os.path.join(myworker, 'selfcalimg2.fits')):
+			myproblems.append('the worker of %s did not make the last self-cal image' % (mytarget))
+	return myproblems
+
+
+def checksubbands(myworkdir):
+	'''the split file flagged and averaged in two subbands, once with workers that succeed and once with workers
+	that fail, after which the split file must be untouched and the whole band done in the main process'''
+	myproblems = []
+	for myrun in ['ok','fail']:
+		myrundir = os.path.join(myworkdir, 'subbands-'+myrun)
+		os.makedirs(myrundir)
+		shutil.copy(mycalfile, myrundir)
+		makesynthms(os.path.join(myrundir, 'multi.ms'), 8, 64, 'FPTPF', 2, 0.01)
+		myinputs = dict([(mystage, mystage in ['fromms','dosplit','mysplitflag','dosplitavg','doflagavg']) for mystage in mycheckstages])
+		myinputs['nsubbands'] = 2
+		myextraenv = {}
+		if myrun == 'fail':
+			myextraenv['BENCH_FAILWORKERS'] = '1'
+		myoutput = runcheckpipeline(myrundir, myinputs, 'run1.log', myextraenv)
+		if 'Traceback' in myoutput:
+			myproblems.append('the %s run failed; see %s' % (myrun, os.path.join(myrundir, 'run1.log')))
+			continue
+		mystages = getcheckmanifest(myrundir)
+		if not os.path.isdir(os.path.join(myrundir, 'TARGETsplit.ms', 'MAIN')):
+			myproblems.append('the %s run lost the split file' % (myrun))
+		if not os.path.isdir(os.path.join(myrundir, 'TARGETavg-split.ms', 'MAIN')):
+			myproblems.append('the %s run did not make the averaged file' % (myrun))
+		if myrun == 'ok':
+			if not mystages.has_key('subbands') or mystages.has_key('splitavg'):
+				myproblems.append('the ok run did not average in the subbands')
+			if [myname for myname in os.listdir(myrundir) if '-sb' in myname] != []:
+				myproblems.append('the ok run left subband directories behind')
+		else:
+			if mystages.has_key('subbands') or not mystages.has_key('splitavg') or not mystages.has_key('flagavg'):
+				myproblems.append('the fail run did not fall back to the whole band')
+			if 'Subband' not in myoutput or 'failed' not in myoutput:
+				myproblems.append('the fail run did not report the failed subbands')
+	return myproblems
+
+
+def checkflagshards(myworkdir):
+	'''the flaginit, doflag and split-file flagging run once on the whole ms and once in scan groups (flagshards);
+	the flags of the multi-source ms and of the split file must come out the same'''
+	myproblems = []
+	myflags = []
+	for nshards in [1,3]:
+		myrundir = os.path.join(myworkdir, 'flagshards'+str(nshards))
+		os.makedirs(myrundir)
+		shutil.copy(mycalfile, myrundir)
+		makesynthms(os.path.join(myrundir, 'multi.ms'), 8, 64, 'FPTPTPTPF', 2, 0.01)
+		myinputs = dict([(mystage, mystage in ['fromms','myflaginit','doinitcal','mydoflag','dosplit','mysplitflag']) for mystage in mycheckstages])
+		myinputs['flagshards'] = nshards
+		myoutput = runcheckpipeline(myrundir, myinputs, 'run1.log')
+		if 'Traceback' in myoutput:
+			myproblems.append('the run with flagshards %d failed; see %s' % (nshards, os.path.join(myrundir, 'run1.log')))
+			return myproblems
+		if nshards > 1 and myoutput.count('Sharded flagging of') < 2:
+			myproblems.append('the run with flagshards %d did not flag in scan groups' % (nshards))
+		myflags.append([np.load(os.path.join(myrundir, myname, 'MAIN', 'FLAG.npy')) for myname in ['multi.ms', 'TARGETsplit.ms']])
+	for k in range(0,2):
+		if not np.array_equal(myflags[0][k], myflags[1][k]):
+			myproblems.append('the flags of %s differ with scan groups' % (['multi.ms', 'TARGETsplit.ms'][k]))
+		elif not myflags[0][k].any():
+			myproblems.append('no flags were set in %s' % (['multi.ms', 'TARGETsplit.ms'][k]))
+	return myproblems
+
+
+def checklta(myworkdir):
+	'''a run from an lta file whose listscan fails must stop before it imports or flags anything'''
+	myrundir = os.path.join(myworkdir, 'lta')
+	os.makedirs(myrundir)
+	shutil.copy(mycalfile, myrundir)
+	open(os.path.join(myrundir, 'obs.lta'),'w').close()
+	makesynthms(os.path.join(myrundir, 'obs.FITS'), 8, 64, 'FPTPF', 2, 0.01)	# a stale FITS file that must not be imported
+	myinputs = dict([(mystage, mystage in ['fromms','myflaginit']) for mystage in mycheckstages])
+	myinputs.update({'fromlta': True, 'fromraw': True, 'ltafile': 'obs.lta', 'rawfile': 'obs.FITS', 'gvbinpath': ['false','false']})
+	myoutput = runcheckpipeline(myrundir, myinputs, 'run1.log')
+	myproblems = []
+	if 'listscan failed on obs.lta' not in myoutput:
+		myproblems.append('the run did not report the failed listscan; see run1.log')
+	if os.path.exists(os.path.join(myrundir, 'multi.ms')):
+		myproblems.append('the run imported the stale FITS file')
+	mystages = getcheckmanifest(myrundir)
+	for mystage in ['fromlta','fromraw','flaginit']:
+		if mystages.has_key(mystage):
+			myproblems.append('the run went on to record the stage '+mystage)
+	return myproblems
+
+
+def checkflagversions(myworkdir):
+	'''a full run with self-cal on new files every loop and flagkeep 2: at most two flag versions may be left on disk,
+	counted over all the ms of the run, and a deleted self-cal ms must take its flag versions with it'''
+	myrundir = os.path.join(myworkdir, 'flagversions')
+	os.makedirs(myrundir)
+	shutil.copy(mycalfile, myrundir)
+	makesynthms(os.path.join(myrundir, 'multi.ms'), 8, 64, 'FPTPF', 2, 0.01)
+	myinputs = dict([(mystage, mystage != 'makedirty') for mystage in mycheckstages])
+	myinputs.update({'flagkeep': 2, 'scaloops': 3, 'mysolint2': ['8.0min','4.0min','2.0min']})
+	myoutput = runcheckpipeline(myrundir, myinputs, 'run1.log')
+	myproblems = []
+	if 'Traceback' in myoutput:
+		myproblems.append('the run failed; see run1.log')
+		return myproblems
+	if not os.path.exists(os.path.join(myrundir, 'capture-flagstate.json')):
+		myproblems.append('the run did not record its flag versions in capture-flagstate.json')
+		return myproblems
+	myversions = json.load(open(os.path.join(myrundir, 'capture-flagstate.json')))['versions']
+	myondisk = []
+	for myname in os.listdir(myrundir):
+		if myname.endswith('.flagversions'):
+			myondisk += [myname[:-len('.flagversions')]+':'+myversion[len('flags.'):] for myversion in os.listdir(os.path.join(myrundir, myname))]
+	if len(myversions) > 2 or len(myondisk) > 2:
+		myproblems.append('%d flag versions are recorded and %d are on disk, more than flagkeep' % (len(myversions), len(myondisk)))
+	if sorted(myondisk) != sorted([myversion['vis']+':'+myversion['name'] for myversion in myversions]):
+		myproblems.append('the flag versions on disk %s are not the recorded ones' % (sorted(myondisk)))
+	for myname in ['vis-selfcal0.ms', 'vis-selfcal0.ms.flagversions', 'vis-selfcal1.ms', 'vis-selfcal1.ms.flagversions']:
+		if os.path.exists(os.path.join(myrundir, myname)):
+			myproblems.append('the old self-cal file %s was left behind' % (myname))
+	return myproblems
+
+
+def checkimagepost(myworkdir):
+	'''a full run with imagepost on: the stand-in exportfits writes empty FITS files, which the image reports
+	must skip with a warning instead of stopping the run'''
+	myrundir = os.path.join(myworkdir, 'imagepost')
+	os.makedirs(myrundir)
+	shutil.copy(mycalfile, myrundir)
+	makesynthms(os.path.join(myrundir, 'multi.ms'), 8, 64, 'FPTPF', 2, 0.01)
+	myinputs = dict([(mystage, mystage != 'makedirty') for mystage in mycheckstages])
+	myinputs.update({'imagepost': True, 'pbcorrect': True})
+	myoutput = runcheckpipeline(myrundir, myinputs, 'run1.log')
+	myproblems = []
+	if 'Traceback' in myoutput:
+		myproblems.append('the run failed; see run1.log')
+	for myimg in ['selfcalimg0','selfcalimg1','selfcalimg2']:
+		if 'Warning: skipping %s.fits' % (myimg) not in myoutput:
+			myproblems.append('the run did not warn about the unreadable %s.fits' % (myimg))
+	if 'Ran the selfcal loop' not in myoutput:
+		myproblems.append('the run did not get to the end of the self-cal')
+	return myproblems
+
+
+mychecks = [('resume', checkresume), ('pool', checkpool), ('subbands', checksubbands), ('flagshards', checkflagshards), ('lta', checklta),
+	('flagversions', checkflagversions), ('imagepost', checkimagepost)]
+
+def runchecks(mynames,myworkdir):
+	'''run the named end-to-end checks; returns True when all of them passed'''
+	myok = True
+	for myname, mycheck in mychecks:
+		if myname not in mynames:
+			continue
+		mytime0 = time.time()
+		myproblems = mycheck(myworkdir)
+		if myproblems == []:
+			print "%-12s passed in %.1f s" % (myname, time.time()-mytime0)
+		else:
+			print "%-12s FAILED: %s" % (myname, '; '.join(myproblems))
+			myok = False
+	return myok
+
+
+def printresults(myresults,myout=None):
+	'''table of the step times, one column per size'''
+	mysizes = []
+	for myresult in myresults:
+		if (myresult['nant'], myresult['nchan']) not in mysizes:
+			mysizes.append((myresult['nant'], myresult['nchan']))
+	mysteps = []
+	for myresult in myresults:
+		if myresult['step'] not in mysteps:
+			mysteps.append(myresult['step'])
+	mylines = ['%-14s' % ('step') + ''.join(['%14s' % ('%dx%d' % mysize) for mysize in mysizes])]
+	for mystep in mysteps:
+		myline = '%-14s' % (mystep)
+		for mysize in mysizes:
+			myseconds = [myresult['seconds'] for myresult in myresults if myresult['step'] == mystep and (myresult['nant'], myresult['nchan']) == mysize]
+			myline += '%14.3f' % (myseconds[0])
+		mylines.append(myline)
+	print "Seconds per step (columns are antennas x channels):"
+	print '\n'.join(mylines)
+	if myout is not None:
+		myfile = open(myout,'w')
+		myfile.write('\n'.join(mylines)+'\n')
+		for myresult in myresults:
+			myfile.write(json.dumps(myresult, sort_keys=True)+'\n')
+		myfile.close()
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '--casa':
+		runcasa(sys.argv[-1])
+	myparser = optparse.OptionParser(usage='%prog [options]')
+	myparser.add_option('--nants', default='16', help='comma separated antenna counts (at most 30) [%default]')
+	myparser.add_option('--nchans', default='128,1024,4096,16384', help='comma separated channel counts [%default]')
+	myparser.add_option('--scans', default='FPTPTPTPF', help='scan layout: F flux calibrator, P phase calibrator, T target [%default]')
+	myparser.add_option('--ntime', type='int', default=2, help='integrations per scan [%default]')
+	myparser.add_option('--rfi', type='float', default=0.01, help='fraction of channels with random RFI [%default]')
+	myparser.add_option('--band', default='band4', help='band3, band4 or band5 [%default]')
+	myparser.add_option('--repeat', type='int', default=3, help='runs of every step; the fastest is reported [%default]')
+	myparser.add_option('--workdir', default='', help='directory in which to make the temporary directory for the synthetic data [the system one]')
+	myparser.add_option('--verbose', action='store_true', default=False, help='show the messages of the pipeline functions')
+	myparser.add_option('--out', default=None, help='also write the table and the results as json lines to this file')
+	myparser.add_option('--check', default='', help='comma separated end-to-end checks to run instead of the timings (%s)' % (', '.join([mycheck[0] for mycheck in mychecks])))
+	myoptions, myargs = myparser.parse_args()
+	if myoptions.workdir != '' and not os.path.isdir(myoptions.workdir):
+		os.makedirs(myoptions.workdir)
+	if myoptions.workdir == '':
+		myoptions.workdir = None	# the system temporary directory
+	if myoptions.check != '':
+		myworkdir = tempfile.mkdtemp(prefix='capture-check-', dir=myoptions.workdir)
+		myok = runchecks(myoptions.check.split(','), myworkdir)
+		if myok == True:
+			shutil.rmtree(myworkdir, True)
+		else:
+			print "The runs are kept in "+myworkdir
+		sys.exit(int(myok == False))
+	myworkdir = tempfile.mkdtemp(prefix='capture-bench-', dir=myoptions.workdir)	# never the given directory itself
+	try:
+		myresults = runbenchmarks([int(n) for n in myoptions.nants.split(',')], [int(n) for n in myoptions.nchans.split(',')],
+			myoptions.scans, myoptions.ntime, myoptions.rfi, myoptions.band, myoptions.repeat, myworkdir, myoptions.verbose)
+	finally:
+		shutil.rmtree(myworkdir, True)
+	printresults(myresults, myoptions.out)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Flag plan check for CAPTURE: capture-flagcheck.py
+# It simulates a small uGMRT-like ms with the CASA simulator, adds RFI and dropouts, and runs the flaginit and
+# doflag style flag plans of capture-pipeline-V0.py three ways on copies of it: one flagdata call per operation
+# (as the pipeline did before the flag plans), the passes of getflagpasses that the pipeline uses now, and all the
+# operations in a single list-mode pass. The flags of the passes must be the same as the flags of the operations
+# one by one; the single pass is shown for comparison.
+# Run it inside CASA from the directory with capture-pipeline-V0.py, e.g.:
+#	casa --nogui -c capture-flagcheck.py
+# The synthetic ms and its copies are written below checkdir and removed at the end unless keepfiles is True.
+import os
+import shutil
+import numpy as np
+
+checkdir = 'flagcheck'				# working directory for the synthetic ms
+checknants = 12					# number of antennas
+checknchan = 256				# number of channels
+checkscans = 'FPTPTPF'				# scan layout: F flux cal, P phase cal, T target
+checkscanlen = 300.0				# scan length in seconds
+checkseed = 4					# seed for the RFI and the dropouts
+keepfiles = False				# True to keep the synthetic ms and the flagged copies
+
+mypipeline = 'capture-pipeline-V0.py'
+myfieldlist = {'F': ('3C286', '13h31m08.288', '30d30m32.96'), 'P': ('1330+251', '13h32m53.271', '25d07m49.50'),
+	'T': ('TARGET', '13h20m00.000', '27d00m00.000')}
+
+#############################################################
+# The pipeline functions
+#############################################################
+
+mytext = open(mypipeline).read()
+mytext = mytext[0:mytext.index('#############End of functions')]
+os.environ.pop('CAPTURE_STAGES', None)
+exec(compile(mytext, mypipeline, 'exec'))
+
+
+def makecheckms(msfile):
+	'''simulate a small band-4 ms with noise, a point source on the calibrators, RFI and dropouts'''
+	myrng = np.random.RandomState(checkseed)
+	myx = myrng.uniform(-6000.0, 6000.0, checknants)
+	myy = myrng.uniform(-6000.0, 6000.0, checknants)
+	sm.open(msfile)
+	sm.setconfig(telescopename='GMRT', x=myx.tolist(), y=myy.tolist(), z=[0.0]*checknants, dishdiameter=[45.0]*checknants,
+		mount=['alt-az'], antname=['A%02d' % j for j in range(checknants)], coordsystem='local',
+		referencelocation=me.observatory('GMRT'))
+	sm.setspwindow(spwname='band4', freq='550MHz', deltafreq='%fMHz' % (200.0/checknchan),
+		freqresolution='%fMHz' % (200.0/checknchan), nchannels=checknchan, stokes='RR LL')
+	sm.setfeed(mode='perfect R L')
+	for mykey in sorted(set(checkscans)):
+		myname, myra, mydec = myfieldlist[mykey]
+		sm.setfield(sourcename=myname, sourcedirection=me.direction('J2000', myra, mydec))
+	sm.setlimits(shadowlimit=0.001, elevationlimit='8deg')
+	sm.setauto(autocorrwt=0.0)
+	sm.settimes(integrationtime='16s', usehourangle=True, referencetime=me.epoch('utc', '2019/08/08/00:00:00'))
+	for k in range(len(checkscans)):
+		mystart = -0.5*len(checkscans)*checkscanlen + k*checkscanlen
+		sm.observe(myfieldlist[checkscans[k]][0], 'band4', starttime='%fs' % mystart, stoptime='%fs' % (mystart+checkscanlen))
+	sm.setnoise(mode='simplenoise', simplenoise='1Jy')
+	sm.corrupt()
+	sm.close()
+	tb.open(msfile, nomodify=False)
+	mydata = tb.getcol('DATA')
+	myfield = tb.getcol('FIELD_ID')
+	mydata[:,:,myfield != 2] += 10.0	# the calibrators
+	nrows = mydata.shape[2]
+	for j in range(checknchan/16):	# narrow band RFI in a few channels over stretches of rows
+		mychan = myrng.randint(1, checknchan)
+		myrow = myrng.randint(0, nrows)
+		mydata[:,mychan,myrow:myrow+myrng.randint(1,nrows/20)] += myrng.uniform(50.0, 500.0)
+	for j in range(checknchan/16):	# broad band RFI in single rows
+		myrow = myrng.randint(0, nrows)
+		mydata[:,:,myrow] += myrng.uniform(50.0, 500.0)
+	mydata[:,:,myrng.randint(0, nrows, nrows/50)] = 0.0	# dropouts
+	tb.putcol('DATA', mydata)
+	tb.close()
+
+
+def getcheckplan():
+	'''the flaginit and doflag plans of the pipeline for the fields of the synthetic ms, on the DATA column'''
+	myampcals = [myfieldlist['F'][0]]
+	mypcals = [myfieldlist['P'][0]]
+	mytargets = [myfieldlist['T'][0]]
+	myspw = '0:%d~%d' % (int(checknchan*0.05), int(checknchan*0.95))
+	myplan = []
+	myplan.append(myflagcmd('manual', spw='0:0', reason='badchan'))
+	myplan.append(myflagcmd('quack', spw='0', quackinterval=10.0, quackmode='beg', reason='quackbeg'))
+	myplan.append(myflagcmd('quack', spw='0', quackinterval=10.0, quackmode='endb', reason='quackendb'))
+	myplan.append(myflagcmd('clip', spw=myspw, field=str(','.join(myampcals)), clipminmax=[0.0, 60.0], datacolumn='DATA',
+		clipoutside=True, clipzeros=True, extendpols=False))
+	myplan.append(myflagcmd('clip', spw=myspw, field=str(','.join(mypcals)), clipminmax=[0.0, 60.0], datacolumn='DATA',
+		clipoutside=True, clipzeros=True, extendpols=False))
+	myplan.append(myflagcmd('tfcrop', datacolumn='DATA', field=str(','.join(mypcals)), ntime='scan',
+		timecutoff=5.0, freqcutoff=5.0, timefit='line', freqfit='line', flagdimension='freqtime',
+		extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False))
+	myplan.append(myflagcmd('extend', spw=myspw, field=str(','.join(mypcals)), datacolumn='DATA', clipzeros=True,
+		ntime='scan', extendflags=False, extendpols=True, growtime=80.0, growfreq=80.0, growaround=False,
+		flagneartime=False, flagnearfreq=False))
+	myplan.append(myflagcmd('clip', spw=myspw, field=str(','.join(mytargets)), clipminmax=[0.0, 60.0], datacolumn='DATA',
+		clipoutside=True, clipzeros=True, extendpols=False))
+	myplan.append(myflagcmd('tfcrop', datacolumn='DATA', field=str(','.join(mytargets)), ntime='scan',
+		timecutoff=6.0, freqcutoff=6.0, timefit='poly', freqfit='poly', flagdimension='freqtime',
+		extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False))
+	myplan.append(myflagcmd('rflag', datacolumn='DATA', field=str(','.join(mytargets)), timecutoff=5.0,
+		freqcutoff=5.0, timefit='poly', freqfit='line', flagdimension='freqtime', extendflags=False,
+		timedevscale=5.0, freqdevscale=5.0, spectralmax=500.0, extendpols=False, growaround=False,
+		flagneartime=False, flagnearfreq=False))
+	myplan.append(myflagcmd('extend', spw=myspw, field=str(','.join(mytargets)), datacolumn='DATA', clipzeros=True,
+		ntime='scan', extendflags=False, extendpols=True, growtime=80.0, growfreq=80.0, growaround=False,
+		flagneartime=False, flagnearfreq=False))
+	return myplan
+
+
+#############################################################
+# The check
+#############################################################
+
+if os.path.isdir(checkdir):
+	shutil.rmtree(checkdir)
+os.makedirs(checkdir)
+mycheckms = os.path.join(checkdir, 'flagcheck.ms')
+makecheckms(mycheckms)
+mycheckplan = getcheckplan()
+mycheckruns = [('one by one', [[mycmd] for mycmd in mycheckplan]), ('passes', getflagpasses(mycheckplan)),
+	('single pass', [mycheckplan])]
+mycheckfiles = []
+for myname, mypasses in mycheckruns:
+	mycheckfiles.append(os.path.join(checkdir, 'flagcheck-%s.ms' % myname.replace(' ', '')))
+	shutil.copytree(mycheckms, mycheckfiles[-1])
+	runflagpasses(mycheckfiles[-1], mypasses)
+	print "%s: %d operations in %d flagdata calls, flag fraction %.4f" % (myname, len(mycheckplan), len(mypasses),
+		getflagfraction(mycheckfiles[-1]))
+mycheckfailed = False
+for k in range(1, len(mycheckruns)):
+	ndiff, ntotal = compareflags(mycheckfiles[0], mycheckfiles[k])
+	print "%s vs %s: %d of %d flags differ" % (mycheckruns[k][0], mycheckruns[0][0], ndiff, ntotal)
+	if mycheckruns[k][0] == 'passes' and ndiff > 0:
+		mycheckfailed = True
+if keepfiles == False:
+	shutil.rmtree(checkdir)
+if mycheckfailed == True:
+	print "The flag passes of the pipeline do not give the same flags as the operations one by one."
+else:
+	print "The flag passes of the pipeline give the same flags as the operations one by one."
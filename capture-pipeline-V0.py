@@ -19,6 +19,10 @@
 ###### SET THE STAGE FOR DATA ANALYSIS #############################
 fromlta = False                               # If starting from lta file set it True. Provide the lta file name and check that the gvfits binaries are given properly.
 gvbinpath = ['./listscan','./gvfits']   # set the path to listscan and gvfits
+ltachunks = 1                             # Number of parts of the lta file to convert with gvfits in parallel and import into myfile1 as they finish (1 to convert it to rawfile in one go).
+ltasources = []                           # Sources to convert from the lta file, calibrators included (e.g. ['3C286','0837-198','TARGET']); [] converts all of them.
+ltadropsources = []                       # Sources not to convert from the lta file.
+ltaminscan = 0.0                          # Scans shorter than this many seconds are not converted from the lta file.
 fromraw = True                               # True if starting from FITS data. Otherwise keep it False.
 fromms = True                                # True If working with multi-source MS file.
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -40,6 +44,8 @@ doflagavg = True                              # True to flag on the channel aver
 makedirty = False                             # True only if you want to make a dirty image of your target source; you can do this before proceeding to self-calibration to check the field
 doselfcal = True                              # True if selfcal loop should be run: set inputs below regarding how many iterations you want.
 usetclean = True                              # True if you want to use tclean (recommended); False will use clean.
+selfcalinplace = False                        # True to keep one MS through the self-cal loops and apply the gain tables cumulatively instead of splitting a new MS every loop.
+doresume = True                               # True to skip stages (and self-cal loops) that finished in an earlier run with the same inputs; see capture-manifest.json
 ####################################################################
 # Please provide appropriate inputs below. No defaults.
 ###### INPUTS ######################################################
@@ -71,20 +77,78 @@ scaloops = 8                                   # Total number of self-cal loops
 mythresholds = 0.01                            # A starting thereshold in mJy- will reduce with scal iterations.              
 mypcaloops = 4                                 # Number of p-only selfcal loops; should be <= scaloops. The remaning loops will be a&p self-cal.
 mysolint2 = ['8.0min','4.0min','2.0min','1.0min','8.0min','4.0min','2.0min','1.0min']   # Solint used for self-cal: provide solints for each self-cal iteration : edit if scaloops changed. 
+adaptiveselfcal = False                        # True to set thresholds and solints from the measured rms and gain SNR and stop self-cal once the dynamic range stops improving.
 ##################################################################
 # For advanced control, you may modify the following inputs to the tasks. However you could go ahead without modifying these.
 ##################################################################
 mynterms = 2                                   # This is the nterms used in tclean. For uGMRT this needs to be 2 at least. A larger value implies very slow imaging.
 mywproj2 = -1                                  # Number of wprojection planes- leave it to -1 so that it is determined internally in tclean
 uvrascal=''                                    # uvrange cutoff used in self-calibration (Not tested enough.)
+rfitable = ''                                  # Optional table of known RFI ranges per band and epoch (band mjd_from mjd_to fmin fmax in Hz); replaces the built-in list when given.
+calpostol = 8.0                                # Tolerance in arcmin for recognising calibrators with non-standard field names by their position; the calibrator list names only give the position to a minute of RA and 0.1 deg of Dec, so it is measured from the centre of that cell.
+autochanwin = False                            # True to find the visstat, flagging and gaincal channel windows from the bandpass and SNR of the calibrator scans (changes the bad antenna search and the calibration); False to use the table for the usual channel counts.
+blbins = [1500.0]                              # Baseline lengths in m that separate the baseline groups flagged separately; the shortest group (about the central square) gets the tighter short-baseline flagging.
+blselect = 'antenna'                           # 'antenna' to select the baseline groups by antenna index from the antenna positions, 'uvrange' to select them by projected uv distance.
+checkflagplan = False                          # True to also run each flagging operation of a stage separately on a copy of the MS and compare the flags (slow; for testing).
+flagkeep = 0                                   # Number of flag versions to keep over all the MSs of the run (0 keeps all); versions are saved only at stage boundaries.
+flagbudget = 0.0                               # Disk space in GB allowed for the flag versions of all the MSs of the run (0 for no limit).
+flagstatefile = 'capture-flagstate.json'       # Record of the flag versions saved in this directory, which flagkeep and flagbudget apply to.
+dotargetpool = False                           # True to run the steps after the split on every target at once, each in its own CASA process and directory.
+poolmem = 0.0                                  # Memory in GB needed by one target or subband process; limits how many run at once (0 to use one per core).
+flagshards = 1                                 # Number of groups of scans cut into shard MSs and flagged in parallel CASA processes (1 to flag the whole MS in this process).
+nsubbands = 1                                  # Number of frequency chunks to flag and average in parallel CASA processes after the split (1 to process the whole band at once).
+casabin = 'casa'                               # Command that starts CASA for the worker processes.
+imageparallel = False                          # True to let tclean grid the data in parallel processes when there is enough memory (falls back to serial). The memory per process is taken from the peak of a serial run with the same image settings, so the first image is always made serially.
+mpicasabin = 'mpicasa'                         # Command that starts MPI CASA for parallel tclean when this script is not already run under mpicasa.
+imagememfile = 'capture-imagemem.json'         # Peak memory of the serial tclean runs, by image settings, used to size the parallel ones.
+myscript = 'capture-pipeline-V0.py'            # Name of this script, run again by the worker processes.
+workerdone = 'capture-worker.done'             # File that a worker process writes in its directory when it gets to the end of this script.
+gainsolints = {}                               # Solution interval of the calibrator gaincal per field, e.g. {'3C286':'60s'}; fields not given use 120s.
+gaincalparallel = False                        # True to solve the calibrator gains field by field in parallel CASA processes and merge the tables.
+gaincalmem = 2.0                               # Memory in GB needed by one parallel gaincal process; limits how many run at once.
+checkgaincal = False                           # True to also solve the calibrator gains one field at a time, time both and compare the tables (for testing).
+runreport = 'capture-report.jsonl'             # File to which the time, memory, I/O and flags of every stage and CASA task call are appended ('' for none).
+reportflags = False                            # True to also report the flagged fraction before and after every flagdata and applycal call (reads the whole FLAG column twice per call, so only for profiling runs).
+selfcaltol = 0.05                              # Adaptive self-cal: smallest fractional gain in dynamic range (peak/rms) that keeps the current kind of loop going.
+selfcalnsigma = 5.0                            # Adaptive self-cal: clean threshold in units of the residual rms of the previous loop.
+selfcalsnr = 5.0                               # Adaptive self-cal: median gain SNR to aim for when choosing the next solint.
+imagepost = True                               # True to find the peak, robust rms and dynamic range of every self-cal FITS image tile by tile and report them.
+pbcorrect = True                               # True to also write a primary beam corrected copy <image>-pbcor.fits of every self-cal FITS image.
+pblimit = 0.2                                  # Primary beam level below which the corrected images are blanked.
+asyncpost = False                              # True to export the self-cal images to FITS, get their statistics and delete old files in a background CASA process while the next loop runs.
+smearloss = 0.0                                # Largest fractional loss of the peak from bandwidth and from time smearing each at the image edge (myimsize x mycell); above 0 the split average picks its channel bin and baseline-dependent time averaging from it instead of mywidth2.
+smearmaxtime = 60.0                            # Longest time in s that the smearing-aware split average averages the shortest baselines over.
+fastresidflag = False                          # True to flag the self-cal residuals in one NumPy pass over the MS (not yet validated against rflag); False for the flagdata rflag, clip and summary passes.
 #######################################################################################################################
 # You can choose to not change anything below this line if you are not familiar with this pipeline.
 ########################################################################################################################
 target = True                                # Should be True when a target different from calibrators is being imaged. Leave it to true always.
+# A pipeline started by runworkers gets its stages and files from the environment; these override the settings above.
+if os.environ.has_key('CAPTURE_STAGES'):
+	for mystage in ['fromlta','fromraw','fromms','findbadants','flagbadants','findbadchans','flagbadfreq','myflaginit','doinitcal',
+			'mydoflag','redocal','dosplit','mysplitflag','dosplitavg','doflagavg','makedirty','doselfcal']:
+		globals()[mystage] = mystage in os.environ['CAPTURE_STAGES'].split(',')
+	mysplitfile = os.environ.get('CAPTURE_SPLITFILE', mysplitfile)
+	mysplitavgfile = os.environ.get('CAPTURE_SPLITAVGFILE', mysplitavgfile)
+	dotargetpool = False
+	nsubbands = 1
+	flagshards = 1
 ##################################################################
 # FUNCTIONS
 ###############################################################
 # A library of function that are used in the pipeline
+import re
+import json
+import pickle
+import hashlib
+import time
+import resource
+import warnings
+import subprocess
+import threading
+import Queue
+import multiprocessing
+import multiprocessing.pool
 
 def vislistobs(msfile):
 	'''Writes the verbose output of the task listobs.'''
@@ -94,72 +158,346 @@ def vislistobs(msfile):
 	print "A file containing listobs output is saved."
 	return outr
 
+mymsmeta = {}           # metadata snapshots of the MS files used in this run, keyed on the MS path
+
+def getmsmtime(msfile):
+	'''latest modification time of the MS and of the sub-tables that hold its metadata'''
+	mymtimes = [os.path.getmtime(msfile)]
+	for mysubtable in ['FIELD','ANTENNA','SPECTRAL_WINDOW','OBSERVATION']:
+		if os.path.exists(msfile+'/'+mysubtable):
+			mymtimes.append(os.path.getmtime(msfile+'/'+mysubtable))
+	return max(mymtimes)
+
+
+def mystrings(myobj):
+	'''turn the unicode strings json gives back into plain strings for the CASA tasks'''
+	if isinstance(myobj, dict):
+		return dict([(mystrings(k), mystrings(v)) for k, v in myobj.items()])
+	if isinstance(myobj, list):
+		return [mystrings(v) for v in myobj]
+	if isinstance(myobj, unicode):
+		return str(myobj)
+	return myobj
+
+
+def getmsmeta(msfile):
+	'''snapshot of the MS metadata, read in one msmd session and kept in memory and
+	in a json file next to the MS; it is read again only when the MS has changed'''
+	mymsfile = os.path.abspath(msfile.rstrip('/'))
+	mymtime = getmsmtime(mymsfile)
+	if mymsfile in mymsmeta and mymsmeta[mymsfile]['mtime'] == mymtime:
+		return mymsmeta[mymsfile]
+	mymetafile = mymsfile+'.meta.json'
+	if os.path.exists(mymetafile):
+		mymeta = mystrings(json.load(open(mymetafile)))
+		if mymeta.get('version') == 3 and mymeta['msfile'] == mymsfile and mymeta['mtime'] == mymtime:
+			mymsmeta[mymsfile] = mymeta
+			return mymeta
+	mymeta = {'version': 3, 'msfile': mymsfile, 'mtime': mymtime}
+	msmd.open(mymsfile)
+	mymeta['fieldnames'] = list(msmd.fieldnames())
+	mymeta['scansforfield'] = {}
+	for myfield in mymeta['fieldnames']:
+		mymeta['scansforfield'][myfield] = msmd.scansforfield(myfield).tolist()
+	mymeta['fieldradec'] = []
+	for j in range(0,len(mymeta['fieldnames'])):
+		myphasecenter = msmd.phasecenter(j)
+		mymeta['fieldradec'].append([myphasecenter['m0']['value'], myphasecenter['m1']['value']])
+	mymeta['antennanames'] = list(msmd.antennanames())
+	mymeta['antennasforscan'] = {}
+	for myscan in msmd.scannumbers().tolist():
+		myantids = msmd.antennasforscan(myscan).tolist()
+		mymeta['antennasforscan'][str(myscan)] = [mymeta['antennanames'][j] for j in myantids]
+	mymeta['nspw'] = msmd.nspw()
+	mymeta['nchan'] = [msmd.nchan(j) for j in range(0,mymeta['nspw'])]
+	mymeta['chanfreqs'] = [msmd.chanfreqs(j).tolist() for j in range(0,mymeta['nspw'])]
+	msmd.done()
+	tb.open(mymsfile+'/ANTENNA')
+	mymeta['antennapositions'] = tb.getcol('POSITION').T.tolist()	# ITRF x, y, z in m for every antenna
+	tb.close()
+	json.dump(mymeta, open(mymetafile,'w'))
+	mymsmeta[mymsfile] = mymeta
+	return mymeta
+
+
 def getfields(msfile):
 	'''get list of field names in the ms'''
-	msmd.open(msfile)  
-	fieldnames = msmd.fieldnames()
-	msmd.done()
-	return fieldnames
+	return list(getmsmeta(msfile)['fieldnames'])
 
 def getscans(msfile, mysrc):
 	'''get a list of scan numbers for the specified source'''
-	msmd.open(msfile)
-	myscan_numbers = msmd.scansforfield(mysrc)
-	myscanlist = myscan_numbers.tolist()
-	msmd.done()
-	return myscanlist
+	return list(getmsmeta(msfile)['scansforfield'][mysrc])
 
 def getantlist(myvis,scanno):
-	msmd.open(myvis)
-	antenna_name = msmd.antennasforscan(scanno)
-	antlist=[]
-	for i in range(0,len(antenna_name)):
-		antlist.append(msmd.antennanames(antenna_name[i])[0])
-	return antlist
+	return list(getmsmeta(myvis)['antennasforscan'][str(scanno)])
 
 
 def getnchan(msfile):
-	msmd.open(msfile)
-	nchan = msmd.nchan(0)
-	msmd.done()
-	return nchan
+	return getmsmeta(msfile)['nchan'][0]
 
 
-def freq_info(ms_file):									
-	sw = 0
-	msmd.open(ms_file)
-	freq=msmd.chanfreqs(sw)								
-	msmd.done()
-	return freq									
+def freq_info(ms_file,sw=0):
+	return np.array(getmsmeta(ms_file)['chanfreqs'][sw])
+
+def getnspw(msfile):
+	return getmsmeta(msfile)['nspw']
+
+
+def getobsmjd(msfile):
+	'''get the MJD at the start of the observation'''
+	tb.open(msfile+'/OBSERVATION')
+	mytimerange = tb.getcol('TIME_RANGE')
+	tb.close()
+	return mytimerange[0,0]/86400.0
+
+
+def getbandname(myfreqs):
+	'''name of the (u)GMRT band that contains the centre of the given channel frequencies'''
+	mycentre = np.median(myfreqs)
+	if mycentre < 0.25E09:
+		return 'band2'
+	elif mycentre < 0.5E09:
+		return 'band3'
+	elif mycentre < 1.0E09:
+		return 'band4'
+	else:
+		return 'band5'
+
+
+def readrfitable(myrfitable,myband,mymjd):
+	'''read the known RFI frequency pairs (fmin, fmax in Hz) that apply to a band and an epoch.
+	Each line of the table is: band  mjd_from  mjd_to  fmin  fmax ; * means any band or an open epoch.'''
+	myrfifreqs = []
+	for myline in open(myrfitable):
+		mywords = myline.split('#')[0].split()
+		if len(mywords) < 5:
+			continue
+		if mywords[0] != '*' and mywords[0].lower() != myband:
+			continue
+		if mywords[1] != '*' and mymjd < float(mywords[1]):
+			continue
+		if mywords[2] != '*' and mymjd > float(mywords[2]):
+			continue
+		myrfifreqs.extend([float(mywords[3]), float(mywords[4])])
+	return myrfifreqs
+
+
+def getrfichanranges(myfreqs,myrfifreqs):
+	'''first and last channel of each contiguous run of channels lying strictly inside one of the
+	frequency pairs (fmin, fmax) listed in myrfifreqs; works for increasing and decreasing frequencies'''
+	myfreqs = np.asarray(myfreqs)
+	nchan = len(myfreqs)
+	npair = len(myrfifreqs)//2
+	myorder = np.argsort(myfreqs, kind='mergesort')
+	mysorted = myfreqs[myorder]
+	mylo = np.asarray(myrfifreqs[0:2*npair:2], dtype=float)
+	myhi = np.asarray(myrfifreqs[1:2*npair:2], dtype=float)
+	mystarts = np.searchsorted(mysorted, mylo, side='right')
+	myends = np.searchsorted(mysorted, myhi, side='left')
+	myhit = myends > mystarts
+	mymark = np.zeros(nchan+1, dtype=int)
+	np.add.at(mymark, mystarts[myhit], 1)
+	np.add.at(mymark, myends[myhit], -1)
+	mybad = np.zeros(nchan, dtype=bool)
+	mybad[myorder] = np.cumsum(mymark[:-1]) > 0
+	myedges = np.diff(np.concatenate(([0], mybad.astype(int), [0])))
+	myfirst = np.where(myedges == 1)[0]
+	mylast = np.where(myedges == -1)[0] - 1
+	return zip(myfirst.tolist(), mylast.tolist())
+
+
+def getrfiflagspw(msfile,myrfifreqs,myrfitable=''):
+	'''spw selection covering the channels of all spws that fall in the known RFI frequency ranges,
+	written as compact first~last channel ranges'''
+	myspwsel = []
+	for myspwid in range(0,getnspw(msfile)):
+		myfreqs = freq_info(msfile,myspwid)
+		if myrfitable != '':
+			myrfifreqs = readrfitable(myrfitable,getbandname(myfreqs),getobsmjd(msfile))
+		for myfirst, mylast in getrfichanranges(myfreqs,myrfifreqs):
+			if myfirst == mylast:
+				myspwsel.append('%d:%d' % (myspwid, myfirst))
+			else:
+				myspwsel.append('%d:%d~%d' % (myspwid, myfirst, mylast))
+	return str(','.join(myspwsel))
+
+
+stdcals = frozenset(['3C48','3C147','3C286','0542+498','1331+305','0137+331'])     # flux calibrators and their J2000 names
+mycalcats = {}          # calibrator catalogues read in this run, keyed on the list file
+
+def getcalcat(calfile):
+	'''frozenset of the calibrator names in a VLA calibrator list; the list is parsed once and
+	cached in a pickle next to it, which is used until the list is modified'''
+	mymtime = os.path.getmtime(calfile)
+	if calfile in mycalcats and mycalcats[calfile]['mtime'] == mymtime:
+		return mycalcats[calfile]['names']
+	mypicklefile = calfile+'.pkl'
+	if os.path.exists(mypicklefile):
+		try:
+			mycat = pickle.load(open(mypicklefile,'rb'))
+		except (IOError, EOFError, pickle.UnpicklingError):
+			mycat = {'mtime': None}
+		if mycat['mtime'] == mymtime:
+			mycalcats[calfile] = mycat
+			return mycat['names']
+	mynames = []
+	for myline in open(calfile):
+		mywords = myline.split()
+		if mywords != []:
+			mynames.append(mywords[0])
+	mycat = {'mtime': mymtime, 'names': frozenset(mynames)}
+	try:
+		pickle.dump(mycat, open(mypicklefile,'wb'), 2)
+	except (IOError, OSError):
+		print "Could not save the parsed calibrator list in %s; it is read from %s again in the next run." % (mypicklefile, calfile)
+	mycalcats[calfile] = mycat
+	return mycat['names']
+
+
+def getcalname(myra,mydec):
+	'''J2000 calibrator list style name (HHMM+DDd) for a position given in radians'''
+	myhours = (np.degrees(myra)/15.0) % 24.0
+	mydeg = np.degrees(mydec)
+	myhh = int(myhours)
+	mymm = int((myhours-myhh)*60.0)
+	mysign = '-' if mydeg < 0 else '+'
+	mydd = int(abs(mydeg))
+	mytenths = int((abs(mydeg)-mydd)*10.0)
+	return '%02d%02d%s%02d%d' % (myhh, mymm, mysign, mydd, mytenths)
+
+
+def getcalradec(myname):
+	'''position in radians of the centre of the cell that a calibrator list style name stands for;
+	the names cut the J2000 position down to the minute of RA and the tenth of a degree of Dec'''
+	mymatch = re.match(r'(\d\d)(\d\d)([+-])(\d\d)(\d)$', myname)
+	if mymatch is None:
+		return None
+	myhours = int(mymatch.group(1)) + (int(mymatch.group(2))+0.5)/60.0
+	mydeg = int(mymatch.group(4)) + (int(mymatch.group(5))+0.5)/10.0
+	if mymatch.group(3) == '-':
+		mydeg = -mydeg
+	return np.radians(myhours*15.0), np.radians(mydeg)
+
+
+def getangsep(myra1,mydec1,myra2,mydec2):
+	'''angular separation in radians between two positions given in radians'''
+	myhav = np.sin((mydec2-mydec1)/2.0)**2 + np.cos(mydec1)*np.cos(mydec2)*np.sin((myra2-myra1)/2.0)**2
+	return 2.0*np.arcsin(min(np.sqrt(myhav), 1.0))
+
+
+def getcalnames(myra,mydec,mytol):
+	'''calibrator list style names whose cell centres are within mytol arcmin of the given position,
+	with the separations in arcmin'''
+	mystep = np.radians(1.0/60.0)	# smaller than the cells, which are 6 arcmin in Dec and a minute of time in RA
+	nsteps = int(np.ceil(mytol))
+	mynames = {}
+	for i in range(-nsteps, nsteps+1):
+		for j in range(-nsteps, nsteps+1):
+			myname = getcalname(myra+i*mystep/max(np.cos(mydec),1e-6), mydec+j*mystep)
+			if myname not in mynames:
+				mycentre = getcalradec(myname)
+				mynames[myname] = np.degrees(getangsep(myra, mydec, mycentre[0], mycentre[1]))*60.0
+	return dict([(myname, mynames[myname]) for myname in mynames.keys() if mynames[myname] <= mytol])
+
+
+def getfieldtypes(msfile,calfile,mytol=1.0):
+	'''split the fields of an ms into amplitude calibrators, phase calibrators and targets.
+	Fields are matched on name first and then on position, within mytol arcmin of the centre of a calibrator
+	list cell (see getcalradec), so that calibrators with non-standard field names are also found.'''
+	vlacals = getcalcat(calfile)
+	mymeta = getmsmeta(msfile)
+	myampcals =[]
+	mypcals=[]
+	mytargets=[]
+	for i in range(0,len(mymeta['fieldnames'])):
+		myfield = mymeta['fieldnames'][i]
+		if myfield in stdcals:
+			myampcals.append(myfield)
+		elif myfield in vlacals:
+			mypcals.append(myfield)
+		else:
+			mynames = getcalnames(mymeta['fieldradec'][i][0], mymeta['fieldradec'][i][1], mytol)
+			myamps = sorted(set(mynames.keys()) & stdcals, key=mynames.get)
+			mycals = sorted(set(mynames.keys()) & vlacals, key=mynames.get)
+			if myamps != []:
+				mymsg = "Field %s is %.1f arcmin from the calibrator list position of the flux calibrator %s; it is used as a flux calibrator." % (myfield, mynames[myamps[0]], myamps[0])
+				myampcals.append(myfield)
+			elif mycals != []:
+				mymsg = "Field %s is %.1f arcmin from the calibrator list position of %s; it is used as a phase calibrator." % (myfield, mynames[mycals[0]], mycals[0])
+				mypcals.append(myfield)
+			else:
+				mytargets.append(myfield)
+				continue
+			print "WARNING: "+mymsg
+	return myampcals, mypcals, mytargets
+
 
 def makebl(ant1,ant2):
 	mybl = ant1+'&'+ant2
 	return mybl
 
 
-def getbllists(myfile):
-	myfields = getfields(myfile)
-	myallscans =[]
-	for i in range(0,len(myfields)):
-		myallscans.extend(getscans(myfile, myfields[i]))
-	myantlist = getantlist(myfile1,int(myallscans[0]))
-	allbl=[]
-	for i in range(0,len(myantlist)):
-		for j in range(0,len(myantlist)):
-			if j>i:
-				allbl.append(makebl(myantlist[i],myantlist[j]))
-	mycc=[]
-	mycaa=[]
-	for i in range(0,len(allbl)):
-		if allbl[i].count('C')==2:
-			mycc.append(allbl[i])
+def getindexranges(myids):
+	'''compact CASA list of integers such as 0~4,7,9~12'''
+	myids = np.unique(myids)
+	mybreaks = np.nonzero(np.diff(myids) != 1)[0]
+	myfirsts = np.concatenate([[0], mybreaks+1])
+	mylasts = np.concatenate([mybreaks, [len(myids)-1]])
+	myranges = []
+	for k in range(0,len(myfirsts)):
+		if myfirsts[k] == mylasts[k]:
+			myranges.append('%d' % (myids[myfirsts[k]]))
 		else:
-			mycaa.append(allbl[i])
-	myshortbl =[]
-	myshortbl.append(str('; '.join(mycc)))
-	mylongbl =[]
-	mylongbl.append(str('; '.join(mycaa)))
-	return myshortbl, mylongbl
+			myranges.append('%d~%d' % (myids[myfirsts[k]], myids[mylasts[k]]))
+	return ','.join(myranges)
+
+
+def getbaselines(myfile,myantlist):
+	'''first and second antenna indices and length in m of every cross baseline between the given antennas'''
+	mymeta = getmsmeta(myfile)
+	myids = np.array(sorted([mymeta['antennanames'].index(myant) for myant in myantlist]))
+	mypos = np.array(mymeta['antennapositions'])[myids]
+	i, j = np.triu_indices(len(myids), 1)
+	return myids[i], myids[j], np.sqrt(((mypos[i]-mypos[j])**2).sum(axis=1))
+
+
+def getblselection(myant1,myant2):
+	'''CASA antenna selection of the given baselines by antenna index, one first&seconds entry per first antenna'''
+	mysel = []
+	for myant in np.unique(myant1):
+		mysel.append('%d&%s' % (myant, getindexranges(myant2[myant1 == myant])))
+	return str(';'.join(mysel))
+
+
+def getblgroups(myfile,mybinedges=[1500.0],mymode='antenna'):
+	'''flagdata selections of the baselines of the antennas in the first scan, grouped by baseline length with the bin
+	edges mybinedges (m), from short to long. mymode antenna selects the baselines by antenna index from their
+	length between the antenna positions, uvrange selects them by projected length. Empty groups are left out.'''
+	myallscans = []
+	for myfield in getfields(myfile):
+		myallscans.extend(getscans(myfile, myfield))
+	myant1, myant2, mylengths = getbaselines(myfile, getantlist(myfile,int(myallscans[0])))
+	mybins = np.digitize(mylengths, mybinedges)
+	myedges = [0.0]+list(mybinedges)
+	mygroups = []
+	for k in range(0,len(myedges)):
+		if np.count_nonzero(mybins == k) == 0:
+			continue
+		if mymode == 'uvrange' and k+1 < len(myedges):
+			mygroups.append({'uvrange': '%g~%gm' % (myedges[k], myedges[k+1])})
+		elif mymode == 'uvrange':
+			mygroups.append({'uvrange': '>%gm' % (myedges[k])})
+		else:
+			mygroups.append({'antenna': getblselection(myant1[mybins == k], myant2[mybins == k])})
+		print "Baseline group %d: %d baselines from %.0f m to %.0f m." % (len(mygroups)-1, np.count_nonzero(mybins == k), mylengths[mybins == k].min(), mylengths[mybins == k].max())
+	return mygroups
+
+
+def getbllists(myfile):
+	'''flagdata selections of the short baselines (the shortest length group, about the central square) and of the
+	longer baseline groups (arm antennas), see getblgroups'''
+	mygroups = getblgroups(myfile,blbins,blselect)
+	return mygroups[0:1], mygroups[1:]
 
 def myvisstatampraw1(myfile,myfield,myspw,myant,mycorr,myscan):
 	default(visstat)
@@ -182,6 +520,198 @@ def myvisstatampraw(myfile,myspw,myant,mycorr,myscan):
 	return mymean1
 
 
+def getchanrange(myspw):
+	'''split a single channel window like 0:250~300 into spw id, first and last channel'''
+	myspwid, mychans = myspw.split(':')
+	mystart, myend = mychans.split('~')
+	return int(myspwid), int(mystart), int(myend)
+
+
+mychantable = {128: ('0:50~70', '0:5~115', '0:11~115'), 256: ('0:100~120', '0:11~240', '0:21~230'),
+	512: ('0:200~240', '0:21~480', '0:41~460'), 1024: ('0:250~300', '0:51~950', '0:101~900'),
+	2048: ('0:500~600', '0:101~1900', '0:201~1800'), 4096: ('0:1000~1200', '0:41~4050', '0:201~3600'),
+	8192: ('0:2000~3000', '0:500~7800', '0:1000~7000'), 16384: ('0:4000~6000', '0:1000~14500', '0:2000~13500')}
+						# visstat, flagging and gaincal channel windows for the usual channel counts
+
+def getchantable(nchan):
+	'''visstat, flagging and gaincal channel windows from the table; other channel counts get the 1024 channel windows scaled'''
+	if mychantable.has_key(nchan):
+		return mychantable[nchan]
+	mywindows = []
+	for mywindow in mychantable[1024]:
+		myspwid, mystart, myend = getchanrange(mywindow)
+		mywindows.append('%d:%d~%d' % (myspwid, mystart*nchan/1024, myend*nchan/1024))
+	return tuple(mywindows)
+
+
+def getchanstats(msfile,myscans,mycorrs=['rr','ll'],nvischunk=20000000):
+	'''mean and standard deviation of the unflagged cross-correlation amplitudes of spw 0 in every channel,
+	over the rows of the given scans and the given correlations, from one chunked read of the data'''
+	nchan = getnchan(msfile)
+	mycorrids = getcorrids(msfile, mycorrs)
+	mycorridx = [k-min(mycorrids) for k in mycorrids]
+	myddid = getddid(msfile,0)
+	nrowchunk = max(100, nvischunk/(nchan*len(mycorrids)))
+	mysum = np.zeros(nchan)
+	mysumsq = np.zeros(nchan)
+	mycount = np.zeros(nchan)
+	tb.open(msfile)
+	mysel = tb.query('DATA_DESC_ID==%d && SCAN_NUMBER IN [%s]' % (myddid, ','.join([str(s) for s in myscans])))
+	nrows = mysel.nrows()
+	for startrow in range(0, nrows, nrowchunk):
+		nrow = min(nrowchunk, nrows-startrow)
+		mycross = mysel.getcol('ANTENNA1', startrow, nrow) != mysel.getcol('ANTENNA2', startrow, nrow)
+		myamp = np.abs(mysel.getcolslice('DATA', [min(mycorrids), 0], [max(mycorrids), nchan-1], [], startrow, nrow)[mycorridx][:,:,mycross])
+		myok = ~mysel.getcolslice('FLAG', [min(mycorrids), 0], [max(mycorrids), nchan-1], [], startrow, nrow)[mycorridx][:,:,mycross]
+		myamp[~myok] = 0.0
+		mysum += myamp.sum(axis=(0,2))
+		mysumsq += (myamp**2).sum(axis=(0,2))
+		mycount += myok.sum(axis=(0,2))
+	mysel.close()
+	tb.close()
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mymean = mysum/mycount
+		mystd = np.sqrt(np.maximum(mysumsq/mycount-mymean**2, 0.0))
+	return np.nan_to_num(mymean), np.nan_to_num(mystd)
+
+
+def getgoodrange(mygood,mywidth):
+	'''first and last channel of the span where most channels in every mywidth channels are good'''
+	mysmooth = np.convolve(mygood.astype(float), np.ones(mywidth)/mywidth, mode='same') >= 0.8
+	myindex = np.nonzero(mysmooth & mygood)[0]
+	if len(myindex) == 0:
+		return None, None
+	return myindex[0], myindex[-1]
+
+
+def getchanwindows(msfile,myscans,myedge=0.5,mygaincut=0.8):
+	'''visstat, flagging and gaincal channel windows of spw 0 from calibrator scans. The flagging window is where the
+	bandpass is above myedge of its median in the middle of the band, the gaincal window where it is above mygaincut and the
+	per-channel SNR (mean over scatter of the amplitudes) is above half its median; the visstat window is the run of
+	channels with the best SNR in the gaincal window. The windows are kept in the calibration cache of the ms.
+	Falls back to the channel table when the scans have no unflagged data or no good span of bandpass.'''
+	mycache = getcalcache(msfile)
+	mykey = getcalkey([myscans, myedge, mygaincut])
+	if mycache.get('chanwindows',{}).has_key(mykey):
+		return tuple(mycache['chanwindows'][mykey])
+	mymean, mystd = getchanstats(msfile,myscans)
+	nchan = len(mymean)
+	mycentre = mymean[nchan/4:3*nchan/4]
+	if np.count_nonzero(mycentre) == 0:
+		print "No unflagged calibrator data to find the channel windows in; using the channel table."
+		return getchantable(nchan)
+	myshape = mymean/np.median(mycentre[mycentre > 0])
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mysnr = np.nan_to_num(mymean/mystd)
+	mywidth = max(3, nchan/128)
+	myflagstart, myflagend = getgoodrange(myshape >= myedge, mywidth)
+	if myflagstart is None:
+		print "The bandpass of the calibrator scans is nowhere above %.2f of its median; using the channel table." % (myedge)
+		return getchantable(nchan)
+	mygaingood = (myshape >= mygaincut) & (mysnr >= 0.5*np.median(mysnr[myflagstart:myflagend+1]))
+	mygainstart, mygainend = getgoodrange(mygaingood, mywidth)
+	if mygainstart is None:
+		mygainstart, mygainend = myflagstart, myflagend
+	nwin = min(max(nchan/20, 8), mygainend-mygainstart+1)
+	mywinsnr = np.cumsum(np.concatenate([[0.0], mysnr[mygainstart:mygainend+1]]))
+	mywinstart = mygainstart+np.argmax(mywinsnr[nwin:]-mywinsnr[:-nwin])
+	mywindows = ('0:%d~%d' % (mywinstart, mywinstart+nwin-1), '0:%d~%d' % (myflagstart, myflagend), '0:%d~%d' % (mygainstart, mygainend))
+	print "Channel windows from the calibrator scans %s: visstat %s, flagging %s, gaincal %s." % (myscans, mywindows[0], mywindows[1], mywindows[2])
+	mycache.setdefault('chanwindows',{})[mykey] = list(mywindows)
+	savecalcache(msfile,mycache)
+	return mywindows
+
+
+def getddid(msfile, myspwid):
+	'''get the data description id that points to the given spw'''
+	tb.open(msfile+'/DATA_DESCRIPTION')
+	myspwids = tb.getcol('SPECTRAL_WINDOW_ID').tolist()
+	tb.close()
+	return myspwids.index(myspwid)
+
+
+def getcorrids(msfile, mycorrs):
+	'''get the positions of the requested correlations (e.g. rr, ll) on the correlation axis of the data'''
+	stokesids = {'RR':5, 'RL':6, 'LR':7, 'LL':8, 'XX':9, 'XY':10, 'YX':11, 'YY':12}
+	tb.open(msfile+'/POLARIZATION')
+	corrtypes = tb.getcol('CORR_TYPE')[:,0].tolist()
+	tb.close()
+	mycorrids = []
+	for i in range(0,len(mycorrs)):
+		mycorrids.append(corrtypes.index(stokesids[mycorrs[i].upper()]))
+	return mycorrids
+
+
+def getscanantmeans(msfile,myspw,myscans,mycorrs,nrowchunk=200000):
+	'''mean raw amplitude per scan, antenna and correlation from a single chunked read of the data.
+	Gives the same numbers as visstat(axis="amp",useflags=False) for each antenna, correlation and scan.'''
+	myspwid, mystart, myend = getchanrange(myspw)
+	myddid = getddid(msfile, myspwid)
+	mycorrids = getcorrids(msfile, mycorrs)
+	nant = len(getmsmeta(msfile)['antennanames'])
+	myscanarr = np.unique(np.array(myscans, dtype=int))
+	nscan = len(myscanarr)
+	nbins = nscan*nant
+	mysums = np.zeros((len(mycorrids), nbins))
+	mycounts = np.zeros(nbins)
+	tb.open(msfile)
+	mysel = tb.query('DATA_DESC_ID==%d && SCAN_NUMBER IN [%s]' % (myddid, ','.join([str(s) for s in myscanarr])))
+	nrows = mysel.nrows()
+	nchanwin = myend - mystart + 1
+	for startrow in range(0, nrows, nrowchunk):
+		nrow = min(nrowchunk, nrows-startrow)
+		myant1 = mysel.getcol('ANTENNA1', startrow, nrow)
+		myant2 = mysel.getcol('ANTENNA2', startrow, nrow)
+		myscanidx = np.searchsorted(myscanarr, mysel.getcol('SCAN_NUMBER', startrow, nrow))
+		mydata = mysel.getcolslice('DATA', [min(mycorrids), mystart], [max(mycorrids), myend], [], startrow, nrow)
+		myampsum = np.abs(mydata).sum(axis=1)          # (ncorr, nrow)
+		idx1 = myscanidx*nant + myant1
+		iscross = myant2 != myant1                      # autocorrelations count once for their antenna
+		idx2 = (myscanidx*nant + myant2)[iscross]
+		mycounts += nchanwin*(np.bincount(idx1, minlength=nbins) + np.bincount(idx2, minlength=nbins))
+		for k in range(0,len(mycorrids)):
+			myamp = myampsum[mycorrids[k]-min(mycorrids)]
+			mysums[k] += np.bincount(idx1, weights=myamp, minlength=nbins)
+			mysums[k] += np.bincount(idx2, weights=myamp[iscross], minlength=nbins)
+	mysel.close()
+	tb.close()
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mymeans = mysums/mycounts
+	return myscanarr, mymeans.reshape(len(mycorrids), nscan, nant)
+
+
+def getbadants(msfile,myspw,myantlist,mycalscans,mytgtscans,mycutoff,mycorrs=['rr','ll']):
+	'''find antennas with mean raw amplitude below mycutoff on the calibrator scans
+	and return manual flag commands for them, including the neighbouring target scans'''
+	myscanarr, mymeans = getscanantmeans(msfile,myspw,mycalscans,mycorrs)
+	allantnames = getmsmeta(msfile)['antennanames']
+	myantids = [allantnames.index(myantlist[i]) for i in range(0,len(myantlist))]
+	myminmeans = np.min(mymeans[:,:,myantids], axis=0)    # (nscan, nant in myantlist)
+	mycmds = []
+	allbadants = []
+	for j in range(0,len(mycalscans)):
+		myscanmeans = myminmeans[np.searchsorted(myscanarr, int(mycalscans[j]))]
+		badantlist = [myantlist[i] for i in range(0,len(myantlist)) if myscanmeans[i] < mycutoff]
+		allbadants.extend(badantlist)
+		print "The following antennas are bad for the given scan numbers."
+		print badantlist, str(mycalscans[j])
+		if badantlist!=[]:
+			myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]))
+			mycmds.append(myflgcmd)
+			print myflgcmd
+			onelessscan = mycalscans[j] - 1
+			onemorescan = mycalscans[j] + 1
+			if onelessscan in mytgtscans:
+				myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]-1))
+				mycmds.append(myflgcmd)
+				print myflgcmd
+			if onemorescan in mytgtscans:
+				myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]+1))
+				mycmds.append(myflgcmd)
+				print myflgcmd
+	return mycmds, allbadants
+
+
 def mygaincal_ap1(myfile,mycal,myref,myflagspw,myuvracal,calsuffix):
 	default(gaincal)
 #	gaincal(vis=myfile, caltable=str(myfile)+'.AP.G.', spw =myflagspw,uvrange=myuvracal,append=True,
@@ -207,6 +737,93 @@ def mygaincal_ap2(myfile,mycal,myref,myflagspw,myuvracal,calsuffix):
 		parang = True )
 	return gaintable
 
+def getcalrows(mytable):
+	'''TIME, FIELD_ID, ANTENNA1, CPARAM and FLAG of a gain table with the rows sorted on time, field and antenna'''
+	tb.open(mytable)
+	mytime = tb.getcol('TIME')
+	myfield = tb.getcol('FIELD_ID')
+	myant = tb.getcol('ANTENNA1')
+	mycparam = tb.getcol('CPARAM')
+	myflag = tb.getcol('FLAG')
+	tb.close()
+	myorder = np.lexsort((myant, myfield, mytime))
+	return mytime[myorder], myfield[myorder], myant[myorder], mycparam[:,:,myorder], myflag[:,:,myorder]
+
+
+def comparecaltables(mytable1,mytable2):
+	'''True when two gain tables hold the same solutions, whatever the order of their rows'''
+	myrows1 = getcalrows(mytable1)
+	myrows2 = getcalrows(mytable2)
+	for j in range(0,len(myrows1)):
+		if myrows1[j].shape != myrows2[j].shape or not np.allclose(myrows1[j], myrows2[j], rtol=1e-5, atol=1e-8):
+			return False
+	return True
+
+
+def mergecaltables(mytables,myouttable):
+	'''append the rows of several gain tables solved on the same ms into one table'''
+	os.system('rm -rf '+myouttable)
+	os.system('cp -r '+mytables[0]+' '+myouttable)
+	for mytable in mytables[1:]:
+		tb.open(mytable)
+		tb.copyrows(outtable=myouttable, startrowin=0, startrowout=-1, nrow=-1)
+		tb.close()
+
+
+def mygaincal_batch(myfile,mycals,myref,myflagspw,myuvracal,calsuffix,mysolints={}):
+	'''amplitude and phase gaincal on all calibrators, with K1 and B1 applied on the fly, written to .AP.G.<suffix>.
+	Calibrators that share a solution interval (mysolints, default 120s) are solved in one gaincal call;
+	with gaincalparallel each calibrator is solved in its own CASA process and the tables are merged.'''
+	mytable = str(myfile)+'.AP.G.'+calsuffix
+	mypars = {'vis': myfile, 'spw': myflagspw, 'uvrange': myuvracal, 'refant': myref, 'minsnr': 2.0, 'gaintype': 'G',
+		'calmode': 'ap', 'gaintable': [str(myfile)+'.K1'+calsuffix, str(myfile)+'.B1'+calsuffix],
+		'interp': ['nearest,nearestflag', 'nearest,nearestflag'], 'parang': True}
+	mytime0 = time.time()
+	os.system('rm -rf '+mytable)
+	mydone = False
+	if gaincalparallel == True and len(mycals) > 1:
+		myjobs = []
+		myfieldtables = []
+		for i in range(0,len(mycals)):
+			myfieldtable = os.path.abspath(mytable+'.'+str(i))
+			os.system('rm -rf '+myfieldtable)
+			myfieldpars = dict(mypars)
+			myfieldpars.update({'vis': os.path.abspath(myfile), 'caltable': myfieldtable, 'field': mycals[i],
+				'solint': mysolints.get(mycals[i], '120s'), 'append': False})
+			myjobfile = os.path.abspath('gaincal-'+calsuffix+str(i)+'.py')
+			open(myjobfile,'w').write('gaincal(**%r)\n' % (myfieldpars))
+			myjobs.append({'cmd': getcasacmd(myjobfile), 'dir': '.', 'log': 'gaincal-'+calsuffix+str(i)+'.log', 'env': {}})
+			myfieldtables.append(myfieldtable)
+		myexitcodes = runworkers(myjobs, getnworkers(len(myjobs), gaincalmem*1.0E09))
+		if max(myexitcodes) != 0 or False in [os.path.isdir(myfieldtable) for myfieldtable in myfieldtables]:
+			print "A parallel gaincal failed; see the gaincal-%s*.log files. Solving the gains in this process instead." % (calsuffix)
+		else:
+			mergecaltables(myfieldtables, mytable)
+			mydone = True
+		for i in range(0,len(mycals)):
+			os.system('rm -rf '+myfieldtables[i]+' gaincal-'+calsuffix+str(i)+'.py')
+	if mydone == False:
+		os.system('rm -rf '+mytable)
+		mygroups = {}
+		for i in range(0,len(mycals)):
+			mygroups.setdefault(mysolints.get(mycals[i], '120s'), []).append(mycals[i])
+		for mysolint in sorted(mygroups.keys()):
+			default(gaincal)
+			gaincal(caltable=mytable, append=True, field=str(','.join(mygroups[mysolint])), solint=mysolint, **mypars)
+	print "Gain solutions for %d calibrators took %.1f s." % (len(mycals), time.time()-mytime0)
+	if checkgaincal == True:
+		mytime0 = time.time()
+		os.system('rm -rf '+mytable+'.seq')
+		os.system('mv '+str(myfile)+'.AP.G.'+calsuffix+' '+mytable+'.batch')
+		for i in range(0,len(mycals)):
+			mygaincal_ap2(myfile,mycals[i],myref,myflagspw,myuvracal,calsuffix)
+		print "One gaincal per calibrator took %.1f s." % (time.time()-mytime0)
+		os.system('mv '+mytable+' '+mytable+'.seq')
+		os.system('mv '+mytable+'.batch '+mytable)
+		print "The batched and the one by one gain tables agree:", comparecaltables(mytable, mytable+'.seq')
+	return mytable
+
+
 def getfluxcal(myfile,mycalref,myscal):
 	myscale = fluxscale(vis=myfile, caltable=str(myfile)+'.AP.G.', fluxtable=str(myfile)+'.fluxscale', reference=mycalref, transfer=myscal,
                     incremental=False)
@@ -243,33 +860,498 @@ def getfluxcal_redo(myfile,mycalref,myscal):
                     transfer=myscal, incremental=False)
 	return myscale
 
-def mytfcrop(myfile,myfield,myants,tcut,fcut,mydatcol,myflagspw):
-	default(flagdata)
-	flagdata(vis=myfile, antenna = myants, field = myfield,	spw = myflagspw, mode='tfcrop', ntime='300s', combinescans=False,
+mynflagbackups = 0      # flagdata backups of the FLAG column that are no longer made, counted since the last flag version
+
+def getdirsize(mypath):
+	'''size in bytes of a file or of everything below a directory'''
+	if os.path.isfile(mypath):
+		return os.path.getsize(mypath)
+	mysize = 0
+	for mydir, mysubdirs, myfiles in os.walk(mypath):
+		for myname in myfiles:
+			mysize += os.path.getsize(os.path.join(mydir, myname))
+	return mysize
+
+
+def getflaghash(myfile,nrowchunk=100000):
+	'''md5 checksum of the FLAG column, read in chunks of rows'''
+	myhash = hashlib.md5()
+	tb.open(myfile)
+	nrows = tb.nrows()
+	for startrow in range(0, nrows, nrowchunk):
+		nrow = min(nrowchunk, nrows-startrow)
+		myhash.update(np.ascontiguousarray(tb.getcol('FLAG', startrow, nrow)).tostring())
+	tb.close()
+	return myhash.hexdigest()
+
+
+def getflagstate():
+	'''the record of the flag versions saved by mysaveflags in this directory, oldest first, for all the ms of the run'''
+	if os.path.exists(flagstatefile):
+		return mystrings(json.load(open(flagstatefile)))
+	return {'versions': []}
+
+
+def dropflagstate(myfile):
+	'''forget the flag versions of an ms that is deleted, so that they no longer count against flagkeep and flagbudget'''
+	mystate = getflagstate()
+	mystate['versions'] = [v for v in mystate['versions'] if v['vis'] != myfile.rstrip('/')]
+	json.dump(mystate, open(flagstatefile,'w'))
+
+
+def getmsfiles(myfile):
+	'''an ms and the files the pipeline keeps next to it, to be deleted with it'''
+	myvis = myfile.rstrip('/')
+	return [myvis, myvis+'.flagversions', myvis+'.meta.json', myvis+'.calcache.json']
+
+
+def mysaveflags(myfile,myversion):
+	'''save the flags of an ms as a flag version at a stage boundary. The version is not written
+	when the flags are the same as in an earlier version of the ms, and the oldest versions of any
+	ms of the run are deleted to stay within flagkeep versions and flagbudget GB on disk.'''
+	global mynflagbackups
+	mytime0 = time.time()
+	myvis = myfile.rstrip('/')
+	mystate = getflagstate()
+	myhash = getflaghash(myfile)
+	mysame = [v['name'] for v in mystate['versions'] if v['vis'] == myvis and v['hash'] == myhash]
+	if mysame != []:
+		print "Flags of %s are unchanged since flag version %s; %s is not saved." % (myfile, mysame[-1], myversion)
+		mysize = 0
+	else:
+		if os.path.isdir(myvis+'.flagversions/flags.'+myversion):
+			flagmanager(vis=myfile, mode='delete', versionname=myversion)	# also drops it from FLAG_VERSION_LIST
+		mystate['versions'] = [v for v in mystate['versions'] if v['vis'] != myvis or v['name'] != myversion]
+		flagmanager(vis=myfile, mode='save', versionname=myversion, comment='CAPTURE stage '+myversion, merge='replace')
+		mysize = getdirsize(myvis+'.flagversions/flags.'+myversion)
+		mystate['versions'].append({'vis': myvis, 'name': myversion, 'hash': myhash, 'bytes': mysize})
+	myoldversions = []
+	while len(mystate['versions']) > 1 and ((flagkeep > 0 and len(mystate['versions']) > flagkeep) or
+			(flagbudget > 0 and sum([v['bytes'] for v in mystate['versions']]) > flagbudget*1.0E09)):
+		myold = mystate['versions'].pop(0)
+		if os.path.isdir(myold['vis']):
+			flagmanager(vis=myold['vis'], mode='delete', versionname=myold['name'])
+		myoldversions.append(myold['vis']+':'+myold['name'])
+	json.dump(mystate, open(flagstatefile,'w'))
+	mytime = time.time()-mytime0
+	myversionsize = max([mysize]+[v['bytes'] for v in mystate['versions']])
+	print "Flag version %s: wrote %.1f MB in %.1f s; deleted old versions %s; %d versions use %.1f MB." % (myversion,
+		mysize/1.0E06, mytime, myoldversions, len(mystate['versions']), sum([v['bytes'] for v in mystate['versions']])/1.0E06)
+	print "Backups skipped since the previous flag version: %d, about %.1f MB of writes saved." % (mynflagbackups,
+		max(mynflagbackups*myversionsize-mysize,0)/1.0E06)
+	mynflagbackups = 0
+	return myhash
+
+
+def getcalmsid(myfile):
+	'''checksum of the number of rows of an ms and of its SPECTRAL_WINDOW and FIELD tables. Unlike the
+	modification time it stays the same when the data, model or flag columns are written.'''
+	myhash = hashlib.md5()
+	tb.open(myfile)
+	myhash.update(str(tb.nrows()))
+	tb.close()
+	for mytable, mycols in [('SPECTRAL_WINDOW', ['NUM_CHAN','CHAN_FREQ','CHAN_WIDTH']), ('FIELD', ['NAME','PHASE_DIR'])]:
+		tb.open(myfile.rstrip('/')+'/'+mytable)
+		for mycol in [mycol for mycol in mycols if mycol in tb.colnames()]:
+			for myrow in range(0,tb.nrows()):
+				myhash.update(np.asarray(tb.getcell(mycol,myrow)).tostring())
+		tb.close()
+	return myhash.hexdigest()
+
+
+def getcalcache(myfile):
+	'''record of the calibration tables made for an ms, kept in <ms>.calcache.json'''
+	mycachefile = myfile.rstrip('/')+'.calcache.json'
+	mymsid = getcalmsid(myfile)
+	if os.path.exists(mycachefile):
+		mycache = mystrings(json.load(open(mycachefile)))
+		if mycache['msid'] == mymsid:
+			return mycache
+	return {'msid': mymsid, 'tables': {}}
+
+
+def savecalcache(myfile,mycache):
+	json.dump(mycache, open(myfile.rstrip('/')+'.calcache.json','w'), indent=1, sort_keys=True)
+
+
+def getcalkey(myinputs):
+	'''key of a calibration solve: a checksum of the flags, the solve parameters and the keys of the tables applied on the fly'''
+	return hashlib.md5(json.dumps(myinputs, sort_keys=True)).hexdigest()
+
+
+def mysolveneeded(myfile,mytable,mykey):
+	'''False when mytable was already solved with the same key; a table solved with the same key
+	under another name is copied to mytable instead of solving again'''
+	mycache = getcalcache(myfile)
+	if os.path.exists(mytable) and mycache['tables'].get(mytable) == mykey:
+		print "Reusing %s; its flags and inputs have not changed." % (mytable)
+		return False
+	os.system('rm -rf '+mytable)
+	for myother in mycache['tables'].keys():
+		if myother != mytable and mycache['tables'][myother] == mykey and os.path.exists(myother):
+			print "Copying %s to %s; it was solved from the same flags and inputs." % (myother, mytable)
+			os.system('cp -r '+myother+' '+mytable)
+			mysolvedone(myfile,mytable,mykey)
+			return False
+	return True
+
+
+def mysolvedone(myfile,mytable,mykey):
+	mycache = getcalcache(myfile)
+	mycache['tables'][mytable] = mykey
+	savecalcache(myfile,mycache)
+
+
+def mysetjy(myfile,myfield,myspw):
+	'''setjy on a flux calibrator. It runs every time, as mycalibrate starts with clearcal.'''
+	default(setjy)
+	mysetjyout = setjy(vis=myfile, spw=myspw, field=myfield)
+	print "Done setjy on %s"%(myfield)
+
+
+def mycalibrate(myfile,myampcals,mypcals,mytargets,myref,myflagspw,mygainspw,myuvracal,mycalsuffix):
+	'''setjy, delay, bandpass, gain and flux calibration on the calibrators followed by applycal on all fields.
+	Each table is keyed on the flags of the ms and the inputs of its solve, and solves with unchanged keys are skipped.'''
+	mybpcals = myampcals
+	clearcal(vis=myfile)
+	myflaghash = getflaghash(myfile)
+#delmod step to keep model column free of spurious values
+	for i in range(0,len(myampcals)):
+		mysetjy(myfile,myampcals[i],myflagspw)
+# Delay calibration  using the first flux calibrator in the list - should depend on which is less flagged
+	myktable = str(myfile)+'.K1'+mycalsuffix
+	mykkey = getcalkey([myflaghash, 'K', myampcals[0], myflagspw, myref])
+	if mysolveneeded(myfile,myktable,mykkey):
+		default(gaincal)
+		gaincal(vis=myfile, caltable=myktable, spw =myflagspw, field=myampcals[0], 
+			solint='60s', refant=myref, solnorm= True, gaintype='K', gaintable=[], parang=True)
+		mysolvedone(myfile,myktable,mykkey)
+# an initial bandpass
+	myg0table = str(myfile)+'.AP.G0'+mycalsuffix
+	myg0key = getcalkey([myflaghash, 'G0', mybpcals, myflagspw, myref, mykkey])
+	if mysolveneeded(myfile,myg0table,myg0key):
+		default(gaincal)
+		gaincal(vis=myfile, caltable=myg0table, append=True, field=str(','.join(mybpcals)), 
+			spw =myflagspw, solint = 'int', refant = myref, minsnr = 2.0, gaintype = 'G', calmode = 'ap', gaintable = [myktable],
+			interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
+		mysolvedone(myfile,myg0table,myg0key)
+	mybtable = str(myfile)+'.B1'+mycalsuffix
+	mybkey = getcalkey([myflaghash, 'B', mybpcals, myflagspw, myref, mykkey, myg0key])
+	if mysolveneeded(myfile,mybtable,mybkey):
+		default(bandpass)
+		bandpass(vis=myfile, caltable=mybtable, spw =myflagspw, field=str(','.join(mybpcals)), solint='inf', refant=myref, solnorm = True,
+			minsnr=2.0, fillgaps=8, parang = True, gaintable=[myktable,myg0table], interp=['nearest,nearestflag','nearest,nearestflag'])
+		mysolvedone(myfile,mybtable,mybkey)
+# do a gaincal on all calibrators
+	mycals=myampcals+mypcals
+	mygtable = str(myfile)+'.AP.G.'+mycalsuffix
+	mygkey = getcalkey([myflaghash, 'G', mycals, mygainspw, myuvracal, myref, mykkey, mybkey, gainsolints])
+	if mysolveneeded(myfile,mygtable,mygkey):
+		mygaincal_batch(myfile,mycals,myref,mygainspw,myuvracal,mycalsuffix,gainsolints)
+		mysolvedone(myfile,mygtable,mygkey)
+# Get flux scale
+	if mypcals !=[]:
+		if '3C286' in myampcals:
+			myfluxscaleref = '3C286'
+		elif '3C147' in myampcals:
+			myfluxscaleref = '3C147'
+		else:
+			myfluxscaleref = myampcals[0]
+		myfluxtable = str(myfile)+'.fluxscale'+mycalsuffix
+		myfluxkey = getcalkey([myflaghash, 'fluxscale', myfluxscaleref, mypcals, mygkey])
+		if mysolveneeded(myfile,myfluxtable,myfluxkey):
+			myfluxscale= getfluxcal2(myfile,myfluxscaleref,str(', '.join(mypcals)),mycalsuffix)
+			print myfluxscale
+			mysolvedone(myfile,myfluxtable,myfluxkey)
+		mygaintables =[myfluxtable,myktable, mybtable]
+	else:
+		mygaintables =[mygtable,myktable, mybtable]
+	for i in range(0,len(myampcals)):
+		default(applycal)
+		applycal(vis=myfile, field=myampcals[i], spw = myflagspw, gaintable=mygaintables, gainfield=[myampcals[i],'',''], 
+				 interp=['nearest','',''], calwt=[False], parang=False)
+#For phase calibrator:
+	if mypcals !=[]:
+		default(applycal)
+		applycal(vis=myfile, field=str(', '.join(mypcals)), spw = myflagspw, gaintable=mygaintables, gainfield=str(', '.join(mypcals)), 
+				 interp=['nearest','','nearest'], calwt=[False], parang=False)
+#For the target:
+	if target ==True:
+		if mypcals !=[]:
+			default(applycal)
+			applycal(vis=myfile, field=str(', '.join(mytargets)), spw = myflagspw, gaintable=mygaintables,
+					 gainfield=[str(', '.join(mypcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
+		else:
+			default(applycal)
+			applycal(vis=myfile, field=str(', '.join(mytargets)), spw = myflagspw, gaintable=mygaintables,
+					 gainfield=[str(', '.join(myampcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)	
+	return mygaintables
+
+
+def mytfcrop(myfile,myfield,myants,tcut,fcut,mydatcol,myflagspw,myplan=None):
+	'''tfcrop on the selection; with myplan the flag command is only added to that list'''
+	global mynflagbackups
+	if type(myants) == dict:
+		mysel = myants	# baseline group from getbllists
+	else:
+		mysel = {'antenna': myants}
+	mypars = dict(field = myfield,	spw = myflagspw, ntime='300s', combinescans=False,
 		datacolumn=mydatcol, timecutoff=tcut, freqcutoff=fcut, timefit='line', freqfit='line', flagdimension='freqtime',
-		usewindowstats='sum', extendflags = False, action='apply', display='none')
+		usewindowstats='sum', extendflags = False, **mysel)
+	if myplan is not None:
+		myplan.append(myflagcmd('tfcrop', **mypars))
+		return
+	default(flagdata)
+	flagdata(vis=myfile, mode='tfcrop', action='apply', display='none', flagbackup=False, **mypars)
+	mynflagbackups += 1
 	return
 
 
-def myrflag(myfile,myfield, myants, mytimdev, myfdev,mydatcol,myflagspw):
-	default(flagdata)
-	flagdata(vis=myfile, field = myfield, spw = myflagspw, antenna = myants, mode='rflag', ntime='scan', combinescans=False,
+def myrflag(myfile,myfield, myants, mytimdev, myfdev,mydatcol,myflagspw,myplan=None):
+	'''rflag on the selection scan by scan; with myplan the flag command is only added to that list'''
+	global mynflagbackups
+	if type(myants) == dict:
+		mysel = myants	# baseline group from getbllists
+	else:
+		mysel = {'antenna': myants}
+	mypars = dict(field = myfield, spw = myflagspw, ntime='scan', combinescans=False,
 		datacolumn=mydatcol, winsize=3, timedevscale=mytimdev, freqdevscale=myfdev, spectralmax=1000000.0, spectralmin=0.0,
-		extendflags=False, channelavg=False, timeavg=False, action='apply', display='none')
+		extendflags=False, channelavg=False, timeavg=False, **mysel)
+	if myplan is not None:
+		myplan.append(myflagcmd('rflag', **mypars))
+		return
+	default(flagdata)
+	flagdata(vis=myfile, mode='rflag', action='apply', display='none', flagbackup=False, **mypars)
+	mynflagbackups += 1
 	return
 
 
 def myrflagavg(myfile,myfield, myants, mytimdev, myfdev,mydatcol,myflagspw):
+	global mynflagbackups
+	if type(myants) == dict:
+		mysel = myants	# baseline group from getbllists
+	else:
+		mysel = {'antenna': myants}
 	default(flagdata)
-	flagdata(vis=myfile, field = myfield, spw = myflagspw, antenna = myants, mode='rflag', ntime='300s', combinescans=True,
+	flagdata(vis=myfile, field = myfield, spw = myflagspw, mode='rflag', ntime='300s', combinescans=True,
 		datacolumn=mydatcol, winsize=3,	minchanfrac= 0.8, flagneartime = True, basecnt = True, fieldcnt = True,
 		timedevscale=mytimdev, freqdevscale=myfdev, spectralmax=1000000.0, spectralmin=0.0, extendflags=False,
-		channelavg=False, timeavg=False, action='apply', display='none')
+		channelavg=False, timeavg=False, action='apply', display='none', flagbackup=False, **mysel)
+	mynflagbackups += 1
 	return
 
 
 
 
+def myflagcmd(mymode,**mypars):
+	'''flagdata list-mode command for one flagging operation'''
+	mywords = ["mode='%s'" % mymode]
+	for mykey in sorted(mypars.keys()):
+		if isinstance(mypars[mykey], str):
+			mywords.append("%s='%s'" % (mykey, mypars[mykey]))
+		elif isinstance(mypars[mykey], list):
+			mywords.append("%s=[%s]" % (mykey, ','.join([repr(v) for v in mypars[mykey]])))
+		else:
+			mywords.append("%s=%s" % (mykey, repr(mypars[mykey])))
+	return ' '.join(mywords)
+
+
+def compareflags(myfile1,myfile2,nrowchunk=100000):
+	'''count the flags that differ between the FLAG columns of two copies of an ms'''
+	tb.open(myfile1)
+	nrows = tb.nrows()
+	mytb2 = tbtool()
+	mytb2.open(myfile2)
+	ndiff = 0
+	ntotal = 0
+	for startrow in range(0, nrows, nrowchunk):
+		nrow = min(nrowchunk, nrows-startrow)
+		myflag1 = tb.getcol('FLAG', startrow, nrow)
+		myflag2 = mytb2.getcol('FLAG', startrow, nrow)
+		ndiff += np.count_nonzero(myflag1 != myflag2)
+		ntotal += myflag1.size
+	mytb2.close()
+	tb.close()
+	return ndiff, ntotal
+
+
+def getflagpasses(myflagplan):
+	'''split a flag plan into flagdata list-mode passes that give the same flags as running the operations one by one.
+	The agents of one pass work side by side on the same data and do not see each other's flags, so an operation
+	that looks at the flags (tfcrop and rflag skip flagged data, extend grows the flags) gets a pass of its own;
+	the operations in between that do not look at the flags (manual, quack, clip, ...) share a pass.'''
+	mypasses = []
+	myshared = False
+	for mycmd in myflagplan:
+		mymode = re.match(r"mode='(\w+)'", mycmd).group(1)
+		if mymode in ['tfcrop','rflag','extend']:
+			mypasses.append([mycmd])
+			myshared = False
+		else:
+			if myshared == False:
+				mypasses.append([])
+				myshared = True
+			mypasses[-1].append(mycmd)
+	return mypasses
+
+
+def runflagplan(myfile,myflagplan,myplanname):
+	'''run the flagging operations collected in a plan in as few flagdata passes over the data as give the
+	same flags as the operations one by one (see getflagpasses).
+	With checkflagplan the operations are also run one by one on a copy of the ms and the flags compared.'''
+	global mynflagbackups
+	if myflagplan == []:
+		return ''
+	myplanfile = myplanname+'-flagplan.dat'
+	open(myplanfile,'w').write('\n'.join(myflagplan)+'\n')
+	mypasses = getflagpasses(myflagplan)
+	print "Running %d flagging operations in %d passes; the list is saved in %s." % (len(myflagplan), len(mypasses), myplanfile)
+	if checkflagplan == True:
+		mycheckfile = myfile.rstrip('/')+'.flagcheck'
+		os.system('rm -rf '+mycheckfile)
+		os.system('cp -r '+myfile+' '+mycheckfile)
+	if flagshards < 2 or runflagshards(myfile, mypasses, myplanname, flagshards) == False:
+		runflagpasses(myfile, mypasses)
+	mynflagbackups += len(myflagplan)
+	if checkflagplan == True:
+		for i in range(0,len(myflagplan)):
+			default(flagdata)
+			flagdata(vis=mycheckfile, mode='list', inpfile=[myflagplan[i]], action='apply', flagbackup=False, savepars=False)
+		ndiff, ntotal = compareflags(myfile, mycheckfile)
+		print "Flag plan %s: %d of %d flags differ from running the operations one by one." % (myplanname, ndiff, ntotal)
+		os.system('rm -rf '+mycheckfile)
+	return myplanfile
+
+
+def isscanlocal(mycmd):
+	'''True when a flag command looks at one scan at a time, so that its flags do not depend on the other scans in the ms,
+	and has no scan selection of its own, so that it can be run on a group of scans'''
+	return 'combinescans=True' not in mycmd and re.search(r"(^| )scan=", mycmd) is None
+
+
+def runflagpasses(myfile,mypasses):
+	'''run flag passes one after the other in this process; each pass is a list of flag commands run in one flagdata call'''
+	for mycmds in mypasses:
+		default(flagdata)
+		flagdata(vis=myfile, mode='list', inpfile=mycmds, action='apply', flagbackup=False, savepars=False)
+
+
+def getscanshards(myfile,nshards):
+	'''split the scans of an ms into at most nshards groups of consecutive scans with about the same number of rows'''
+	tb.open(myfile)
+	myscans, mycounts = np.unique(tb.getcol('SCAN_NUMBER'), return_counts=True)
+	tb.close()
+	mycum = np.cumsum(mycounts)
+	myshards = []
+	mystart = 0
+	for k in range(1,nshards+1):
+		myend = min(int(np.searchsorted(mycum, mycum[-1]*float(k)/nshards))+1, len(myscans))
+		if myend > mystart:
+			myshards.append(myscans[mystart:myend].tolist())
+			mystart = myend
+	return myshards
+
+
+def getshardrows(myfile,myshardfile,myscans):
+	'''row numbers in myfile of the rows of a shard ms cut out of it for the scans myscans. mstransform need not keep
+	the order of the rows, so they are matched on time, baseline and data description; None when they do not match one to one.'''
+	mykeycols = ['TIME','ANTENNA1','ANTENNA2','DATA_DESC_ID']
+	tb.open(myfile)
+	mysel = tb.query('SCAN_NUMBER IN ['+','.join([str(s) for s in myscans])+']')
+	myrows = np.asarray(mysel.rownumbers())
+	mykeys = [mysel.getcol(mycol) for mycol in mykeycols]
+	mysel.close()
+	tb.close()
+	tb.open(myshardfile)
+	myshardkeys = [tb.getcol(mycol) for mycol in mykeycols]
+	tb.close()
+	if len(myshardkeys[0]) != len(myrows) or len(myrows) == 0:
+		return None
+	myorder = np.lexsort(mykeys[::-1])
+	myshardorder = np.lexsort(myshardkeys[::-1])
+	myrepeat = np.ones(len(myrows)-1, dtype=bool)
+	for k in range(0,len(mykeycols)):
+		if not np.array_equal(mykeys[k][myorder], myshardkeys[k][myshardorder]):
+			return None
+		myrepeat &= np.diff(mykeys[k][myorder]) == 0
+	if myrepeat.any():
+		return None	# rows with the same keys could be swapped
+	myshardrows = np.zeros(len(myrows), dtype=int)
+	myshardrows[myshardorder] = myrows[myorder]
+	return myshardrows
+
+
+def putshardflags(myfile,myshardfile,myshardrows,nrowchunk=100000):
+	'''copy the FLAG and FLAG_ROW columns of a shard ms to the rows myshardrows (see getshardrows) of myfile'''
+	mytb2 = tbtool()
+	mytb2.open(myshardfile)
+	tb.open(myfile, nomodify=False)
+	for startrow in range(0, len(myshardrows), nrowchunk):
+		myrows = myshardrows[startrow:startrow+nrowchunk]
+		myorder = np.argsort(myrows)
+		myrows = myrows[myorder]
+		myflag = mytb2.getcol('FLAG', startrow, len(myrows))[...,myorder]
+		myflagrow = mytb2.getcol('FLAG_ROW', startrow, len(myrows))[myorder]
+		if myrows[-1]-myrows[0] == len(myrows)-1:
+			tb.putcol('FLAG', myflag, int(myrows[0]), len(myrows))
+			tb.putcol('FLAG_ROW', myflagrow, int(myrows[0]), len(myrows))
+		else:
+			mysub = tb.selectrows(myrows.tolist())
+			mysub.putcol('FLAG', myflag)
+			mysub.putcol('FLAG_ROW', myflagrow)
+			mysub.close()
+	tb.close()
+	mytb2.close()
+
+
+def runflagshards(myfile,mypasses,myname,nshards):
+	'''run flag passes on groups of scans in parallel CASA processes. Every process cuts the scans of its group out of
+	the ms into a shard ms of its own with mstransform and runs the passes on it, so the processes share no table;
+	the FLAG and FLAG_ROW columns of the shards are then put back into the ms, which is not touched before.
+	The flags are the same as from a run on the whole ms when every command works scan by scan (isscanlocal).
+	Returns False, with the ms untouched, when the passes cannot be sharded or a shard failed.'''
+	mycmds = sum(mypasses, [])
+	if nshards < 2:
+		return False
+	if False in [isscanlocal(mycmd) for mycmd in mycmds]:
+		print "Some flag commands of %s combine or select scans; flagging the whole ms in one process." % (myname)
+		return False
+	myshards = getscanshards(myfile, nshards)
+	if len(myshards) < 2:
+		return False
+	mytime0 = time.time()
+	myworkdir = os.path.abspath(myfile.rstrip('/')+'-'+myname+'-shards')
+	os.system('rm -rf '+myworkdir)
+	os.makedirs(myworkdir)
+	myjobs = []
+	for k in range(0,len(myshards)):
+		myshardfile = 'shard'+str(k)+'.ms'
+		myjobfile = os.path.join(myworkdir, 'flag-shard'+str(k)+'.py')
+		open(myjobfile,'w').write("mstransform(vis=%r, outputvis=%r, scan=%r, datacolumn='all', reindex=False)\n" % (os.path.abspath(myfile),
+			myshardfile, ','.join([str(s) for s in myshards[k]])) +
+			"for mycmds in %r:\n\tflagdata(vis=%r, mode='list', inpfile=mycmds, action='apply', flagbackup=False, savepars=False)\n" % (mypasses, myshardfile) +
+			"open(%r,'w').close()\n" % (myshardfile+'.done'))
+		myjobs.append({'cmd': getcasacmd(myjobfile), 'dir': myworkdir, 'log': 'flag-shard'+str(k)+'.log', 'done': myshardfile+'.done', 'env': {}})
+	nworkers = getnworkers(len(myjobs), 0)
+	print "Flagging %s in %d groups of scans with %d worker processes." % (myname, len(myjobs), nworkers)
+	myexitcodes = runworkers(myjobs, nworkers)
+	myfailed = [k for k in range(0,len(myjobs)) if myexitcodes[k] != 0]
+	if myfailed != []:
+		print "Flagging of the scan groups %s failed; see the logs in %s. Flagging the whole ms in this process instead." % (myfailed, myworkdir)
+		return False
+	mytime1 = time.time()
+	myshardrows = [getshardrows(myfile, os.path.join(myworkdir, 'shard'+str(k)+'.ms'), myshards[k]) for k in range(0,len(myshards))]
+	if [myrows for myrows in myshardrows if myrows is None] != []:
+		print "The rows of the shards in %s do not match the ms. Flagging the whole ms in this process instead." % (myworkdir)
+		return False
+	for k in range(0,len(myshards)):
+		putshardflags(myfile, os.path.join(myworkdir, 'shard'+str(k)+'.ms'), myshardrows[k])
+	os.system('rm -rf '+myworkdir)
+	print "Sharded flagging of %s: %.1f s cutting and flagging the shards, %.1f s putting the flags back." % (myname,
+		mytime1-mytime0, time.time()-mytime1)
+	return True
+
+
 def mysplitinit(myfile,myfield,myspw,mywidth):
 	'''function to split corrected data for any field'''
 	default(mstransform)
@@ -286,34 +1368,223 @@ def mysplitavg(myfile,myfield,myspw,mywidth):
 	return myoutname
 
 
+def getangle(myquantity):
+	'''angle in radians of a CASA angle such as 0.5arcsec'''
+	mymatch = re.match(r'\s*([0-9.eE+-]+)\s*(\w*)\s*$', myquantity)
+	myunits = {'rad': 1.0, 'deg': np.pi/180.0, 'arcmin': np.pi/180.0/60.0, 'arcsec': np.pi/180.0/3600.0}
+	return float(mymatch.group(1))*myunits[mymatch.group(2)]
+
+
+def getsmearloss(myphase):
+	'''fractional loss of the peak on one baseline when the fringe phase of the source turns by myphase radians during an average'''
+	if myphase <= 0.0:
+		return 0.0
+	return 1.0-abs(np.sin(myphase/2.0)/(myphase/2.0))
+
+
+def getsmearphase(myloss):
+	'''largest phase turn in radians that loses at most myloss of the peak'''
+	mylow, myhigh = 0.0, 2.0*np.pi
+	for k in range(0,50):
+		if getsmearloss((mylow+myhigh)/2.0) > myloss:
+			myhigh = (mylow+myhigh)/2.0
+		else:
+			mylow = (mylow+myhigh)/2.0
+	return mylow
+
+
+def getsmearavg(myfile,myimsize,mycell,myloss,mymaxtime,myfreqmax=0.0):
+	'''mstransform averaging that keeps the loss of the peak from bandwidth smearing and from time smearing each below
+	myloss at the edge of the image (half of myimsize times mycell from the centre). The fringe phase at the edge turns by
+	2 pi b theta dnu/c across the averaged channels, so the longest baseline sets the channel bin; it turns by
+	2 pi theta duvw/lambda while the uvw move, so averaging every baseline until its uvw have moved maxuvwdistance (at the
+	highest frequency, myfreqmax when given) bounds the time smearing on all of them, the short ones averaging up to
+	mymaxtime seconds. Returns the mstransform parameters and the smearing budget.'''
+	mymeta = getmsmeta(myfile)
+	myfreqs = np.array(mymeta['chanfreqs'][0])
+	mychanwidth = abs(myfreqs[-1]-myfreqs[0])/max(len(myfreqs)-1,1)
+	if myfreqmax <= 0.0:
+		myfreqmax = myfreqs.max()
+	myradius = 0.5*myimsize[0]*getangle(mycell[0])
+	mypos = np.array(mymeta['antennapositions'])
+	i, j = np.triu_indices(len(mypos), 1)
+	mymaxbl = np.sqrt(((mypos[i]-mypos[j])**2).sum(axis=1)).max()
+	myphase = getsmearphase(myloss)
+	mychanbin = max(1, int(myphase*299792458.0/(2.0*np.pi*mymaxbl*myradius)/mychanwidth))
+	mymaxuvw = myphase*(299792458.0/myfreqmax)/(2.0*np.pi*myradius)
+	mybudget = {'radius': myradius*180.0*60.0/np.pi, 'longestbaseline': mymaxbl, 'chanbin': mychanbin,
+		'bandwidthloss': getsmearloss(2.0*np.pi*mymaxbl*myradius*mychanbin*mychanwidth/299792458.0),
+		'timeloss': getsmearloss(myphase), 'maxuvwdistance': mymaxuvw,
+		'longbltime': mymaxuvw/(mymaxbl*7.2921E-05)}	# time in s the longest baseline averages at most (earth rotation rate)
+	mypars = {'chanaverage': mychanbin > 1, 'chanbin': mychanbin, 'timeaverage': True,
+		'timebin': '%.0fs' % (mymaxtime), 'maxuvwdistance': mymaxuvw}
+	return mypars, mybudget
+
+
+def mysplitsmear(myfile,myimsize,mycell,myloss,mymaxtime,myfreqmax=0.0):
+	'''split with the channel and baseline-dependent time averaging of getsmearavg; returns the file name and the smearing budget'''
+	myoutname=myfile.split('s')[0]+'avg-split.ms'
+	mypars, mybudget = getsmearavg(myfile,myimsize,mycell,myloss,mymaxtime,myfreqmax)
+	default(mstransform)
+	mstransform(vis=myfile, field='', spw='', datacolumn='data', outputvis=myoutname, **mypars)
+	mynvis = []
+	for myvis in [myfile, myoutname]:
+		tb.open(myvis)
+		mynvis.append(float(tb.nrows())*getnchan(myvis))
+		tb.close()
+	mybudget['reduction'] = mynvis[0]/max(mynvis[1],1.0)
+	print "Smearing budget at %.1f arcmin from the centre: bandwidth loss %.3f with %d channels averaged (longest baseline %.0f m)," % (
+		mybudget['radius'], mybudget['bandwidthloss'], mybudget['chanbin'], mybudget['longestbaseline'])
+	print "time loss at most %.3f with maxuvwdistance %.2f m (%.1f s on the longest baseline, up to %.0f s on the shortest)." % (
+		mybudget['timeloss'], mybudget['maxuvwdistance'], mybudget['longbltime'], mymaxtime)
+	print "Visibilities reduced by a factor of %.1f." % (mybudget['reduction'])
+	return myoutname, mybudget
+
+
+def getimagemem(myimsize,mynterms,mywproj,mynscales):
+	'''rough memory in bytes of an mtmfs/multiscale wproject tclean run: (memory of the process that runs
+	the minor cycle, memory of each process that grids a chunk of the data)'''
+	mynpix = float(myimsize[0])*float(myimsize[-1])
+	if mywproj < 0:
+		mywproj = 256	# tclean chooses the number of w-planes itself; assume a wide field
+	npsf = 2*mynterms-1
+	mygrid = 1.44*mynpix*8.0*npsf + mywproj*2.0**20	# padded complex grids of the psf terms and the w-projection convolution functions
+	myimages = 4.0*mynpix*(npsf + 3*mynterms + 4 + mynscales*mynscales*npsf)	# psf, residual, model, image, weight, sumwt, pb, mask and the scale-convolved psfs
+	mypartial = 4.0*mynpix*(npsf + 2*mynterms + 2)	# partial psf, residual, model and weight images of one data chunk
+	return myimages+mygrid, mygrid+mypartial
+
+
+def getprocmem(mykey='VmRSS'):
+	'''memory in bytes of this process from /proc/self/status: VmRSS now, VmHWM the peak since the start or
+	since the last resetpeakmem; 0 where that is not available'''
+	if not os.path.exists('/proc/self/status'):
+		return 0.0
+	for myline in open('/proc/self/status'):
+		if myline.startswith(mykey+':'):
+			return float(myline.split()[1])*1024.0
+	return 0.0
+
+
+def resetpeakmem():
+	'''start a new peak memory (VmHWM) measurement; False where the kernel does not allow it'''
+	try:
+		open('/proc/self/clear_refs','w').write('5')
+	except IOError:
+		return False
+	return getprocmem('VmHWM') > 0.0
+
+
+def getimagekey(myimsize,mynterms,mywproj,mynscales):
+	'''key of the tclean memory measurements for a set of image settings'''
+	return '%dx%d nterms=%d wprojplanes=%d nscales=%d' % (myimsize[0], myimsize[-1], mynterms, mywproj, mynscales)
+
+
+def getimagemeas(mykey):
+	'''measured memory of a serial tclean run with the settings of mykey from imagememfile, or None'''
+	if not os.path.exists(imagememfile):
+		return None
+	return json.load(open(imagememfile)).get(mykey)
+
+
+def saveimagemeas(mykey,mypeak,mybase):
+	'''store the peak memory that a serial tclean run added to this process and the memory the process had before'''
+	mymeas = {}
+	if os.path.exists(imagememfile):
+		mymeas = json.load(open(imagememfile))
+	if mykey in mymeas and mymeas[mykey]['peak'] > mypeak:
+		return	# keep the largest peak seen for these settings
+	mymeas[mykey] = {'peak': mypeak, 'base': mybase}
+	json.dump(mymeas, open(imagememfile,'w'), indent=1, sort_keys=True)
+	print "Serial tclean with %s peaked at %.1f GB above the %.1f GB the process used before." % (mykey, mypeak/1.0e9, mybase/1.0e9)
+
+
+def getmpiservers():
+	'''number of MPI servers when this script runs under mpicasa, 0 otherwise'''
+	try:
+		from mpi4casa.MPIEnvironment import MPIEnvironment
+	except ImportError:
+		return 0
+	if MPIEnvironment.is_mpi_enabled:
+		return MPIEnvironment.mpi_world_size-1
+	return 0
+
+
+def getimagingworkers(myimsize,mynterms,mywproj,mynscales):
+	'''number of processes that should grid the data in parallel, 0 to image serially.
+	The memory comes from the measured peak of a serial run with the same settings (see mytclean): the process
+	that runs the minor cycle needs that peak again, and each gridding process, which holds its own grids and
+	psf, residual, model and weight images, is counted at the same peak on top of a fresh CASA process.
+	Without a measurement the image is made serially and measured.'''
+	myclientmem, myservermem = getimagemem(myimsize,mynterms,mywproj,mynscales)
+	myavail = getavailmem()
+	print "tclean needs about %.1f GB serially and %.1f GB per extra gridding process; %.1f GB is available." % (myclientmem/1.0e9, myservermem/1.0e9, myavail/1.0e9)
+	if imageparallel == False:
+		return 0
+	mymeas = getimagemeas(getimagekey(myimsize,mynterms,mywproj,mynscales))
+	if mymeas is None:
+		print "No measured tclean memory for these image settings yet; imaging serially to measure it."
+		return 0
+	myclientmem = max(myclientmem, mymeas['peak'])
+	myservermem = max(myservermem, mymeas['peak']+mymeas['base'])
+	print "Measured: %.1f GB for the minor cycle process and %.1f GB per gridding process." % (myclientmem/1.0e9, myservermem/1.0e9)
+	nworkers = min(getncores()-1, int((myavail-myclientmem)/myservermem))
+	if getmpiservers() > 0:
+		nworkers = min(nworkers, getmpiservers())
+	if nworkers < 2:
+		return 0
+	return nworkers
+
+
 def mytclean(myfile,myniter,mythresh,srno,cell,imsize, mynterms1,mywproj):    # you may change the multi-scale inputs as per your field
+	'''tclean of field 0. The gridding runs in parallel when imageparallel is set and memory allows it: inside mpicasa
+	with the MPI servers already there, otherwise in a separate mpicasa process; else tclean runs serially.'''
 	if myniter==0:
 		myoutimg = 'dirty-img'
 	else:
 		myoutimg = 'selfcal'+'img'+str(srno)
-	default(tclean)
+	myscales = [0,5,15]
 	if mynterms1 > 1:
-		tclean(vis=myfile,
-       			imagename=myoutimg, selectdata= True, field='0', spw='0', imsize=imsize, cell=cell, robust=0, weighting='briggs', 
-       			specmode='mfs',	nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1, sidelobethreshold = 1.5,
-#			minpsffraction=0.05,
-#			maxpsffraction=0.8,
-			smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-1,
-	        	deconvolver='mtmfs', gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
-			restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=False,
-       			interactive=False)
+		mydeconvolver = 'mtmfs'
 	else:
-		tclean(vis=myfile,
-       			imagename=myoutimg, selectdata= True, field='0', spw='0', imsize=imsize, cell=cell, robust=0, weighting='briggs', 
-       			specmode='mfs',	nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1,sidelobethreshold = 1.5,
+		mydeconvolver = 'multiscale'
+	mypars = {'vis': myfile, 'imagename': myoutimg, 'selectdata': True, 'field': '0', 'spw': '0', 'imsize': imsize, 'cell': cell,
+		'robust': 0, 'weighting': 'briggs', 'specmode': 'mfs', 'nterms': mynterms1, 'niter': myniter, 'usemask': 'auto-multithresh',
+		'minbeamfrac': 0.1, 'sidelobethreshold': 1.5, 'smallscalebias': 0.6, 'threshold': mythresh, 'aterm': True, 'pblimit': -1,
+		'deconvolver': mydeconvolver, 'gridder': 'wproject', 'wprojplanes': mywproj, 'scales': myscales, 'wbawp': False,
+		'restoration': True, 'savemodel': 'modelcolumn', 'cyclefactor': 0.5, 'interactive': False}
+	if myniter == 0:
+		mypars['savemodel'] = 'none'	# a dirty image has no model, and writing one would change the ms behind the manifest's back
 #			minpsffraction=0.05,
 #			maxpsffraction=0.8,
-			smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-1,
-	        	deconvolver='multiscale', gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
-			restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=False,
-       			interactive=False)
+	nworkers = getimagingworkers(imsize,mynterms1,mywproj,len(myscales))
+	mytime0 = time.time()
+	if nworkers > 0 and getmpiservers() > 0:
+		default(tclean)
+		tclean(parallel=True, **mypars)
+	elif nworkers > 0:
+		os.system('rm -rf '+myoutimg+'.*')
+		myjobfile = 'tclean-'+myoutimg+'.py'
+		mypars['vis'] = os.path.abspath(myfile)
+		open(myjobfile,'w').write('tclean(parallel=True, **%r)\n' % (mypars))
+		mycmd = mpicasabin.split()+['-n', str(nworkers+1)]+getcasacmd(myjobfile)
+		myexitcodes = runworkers([{'cmd': mycmd, 'dir': '.', 'log': 'tclean-'+myoutimg+'.log', 'env': {}}], 1)
+		os.system('rm -f '+myjobfile)
+		if myexitcodes[0] != 0:
+			print "Parallel tclean failed (see tclean-%s.log); imaging serially." % (myoutimg)
+			nworkers = 0
+			mytime0 = time.time()
+			os.system('rm -rf '+myoutimg+'.*')
+	if nworkers == 0:
+		mybase = getprocmem('VmRSS')
+		mymeasure = resetpeakmem()
+		default(tclean)
+		tclean(parallel=False, **mypars)
+		if mymeasure == True and myniter > 0:	# a dirty image has no minor cycle and would understate the peak
+			saveimagemeas(getimagekey(imsize,mynterms1,mywproj,len(myscales)), getprocmem('VmHWM')-mybase, mybase)
+	print "tclean of %s with %d gridding processes took %.1f min." % (myoutimg, max(nworkers,1), (time.time()-mytime0)/60.0)
 	return myoutimg
 
+
 def myonlyclean(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj):
 	default(clean)
 	clean(vis=myfile,
@@ -336,6 +1607,19 @@ def myonlyclean(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj):
 	return myname
 
 
+def getwrittenbytes():
+	'''bytes this process has written to disk so far; 0 where that is not available'''
+	return getprocio()[1]
+
+
+def mydropcorrected(myfile):
+	'''remove a CORRECTED_DATA column left in an ms so that imaging and gaincal start from DATA'''
+	tb.open(myfile, nomodify=False)
+	if 'CORRECTED_DATA' in tb.colnames():
+		tb.removecols('CORRECTED_DATA')
+	tb.close()
+
+
 def mysplit(myfile,srno):
 	default(mstransform)
 	mstransform(vis=myfile, field='0', spw='0', datacolumn='corrected', outputvis='vis-selfcal'+str(srno)+'.ms')
@@ -343,7 +1627,8 @@ def mysplit(myfile,srno):
 	return myoutvis
 
 
-def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw):
+def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw,myinplace=False):
+	'''self-cal gaincal; with myinplace the gain tables of the earlier loops (mygtable) are applied on the fly'''
 	if pap=='ap':
 		mycalmode='ap'
 		mysol= mysolint[srno] 
@@ -361,9 +1646,15 @@ def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw):
 # new options in gaincal
 #		calmode = mycalmode, gaintable = [], interp = ['nearest,nearestflag', 'nearest,nearestflag' ], 
 #		parang = True )
+	if myinplace == True:
+		mypretables = list(mygtable)
+		mypreinterp = ['linear']*len(mygtable)
+	else:
+		mypretables = []
+		mypreinterp = ['nearest,nearestflag', 'nearest,nearestflag' ]
 	gaincal(vis=myfile, caltable=str(pap)+str(srno)+'.GT', append=False, field='0', spw=mygainspw,
 		uvrange=myuvrascal, solint = mysol, refant = myref, minsnr = 2.0, gaintype = 'G',
-		solnorm= mysolnorm, calmode = mycalmode, gaintable = [], interp = ['nearest,nearestflag', 'nearest,nearestflag' ], 
+		solnorm= mysolnorm, calmode = mycalmode, gaintable = mypretables, interp = mypreinterp, 
 		parang = True )
 	mycal = str(pap)+str(srno)+'.GT'
 	return mycal
@@ -371,32 +1662,400 @@ def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw):
 
 def myapplycal(myfile,mygaintables):
 	# applycal
+	if type(mygaintables) == str:
+		mygaintables = [mygaintables]
 	default(applycal)
-	applycal(vis=myfile, field='0', gaintable=mygaintables, gainfield=['0'], applymode='calflag', 
-	         interp=['linear'], calwt=False, parang=False)
+	applycal(vis=myfile, field='0', gaintable=mygaintables, gainfield=['0']*len(mygaintables), applymode='calflag', 
+	         interp=['linear']*len(mygaintables), calwt=False, parang=False)
 	print 'Did applycal.'
 
 
 
 
+def getwindowrms(myvis,myok,myaxis,mywinsize=3):
+	'''rms about the local mean of the unflagged complex values in a sliding window of mywinsize along myaxis;
+	nan where the value is flagged or fewer than two values are in the window'''
+	myvis = np.where(myok, myvis, 0.0)
+	mysum = np.zeros(myvis.shape, dtype=myvis.dtype)
+	mysumsq = np.zeros(myvis.shape)
+	mycount = np.zeros(myvis.shape)
+	nlen = myvis.shape[myaxis]
+	for myshift in range(-(mywinsize/2), mywinsize/2+1):
+		mysrc = [slice(None)]*myvis.ndim
+		mydst = [slice(None)]*myvis.ndim
+		mysrc[myaxis] = slice(max(myshift,0), nlen+min(myshift,0))
+		mydst[myaxis] = slice(max(-myshift,0), nlen+min(-myshift,0))
+		mysum[tuple(mydst)] += myvis[tuple(mysrc)]
+		mysumsq[tuple(mydst)] += np.abs(myvis[tuple(mysrc)])**2
+		mycount[tuple(mydst)] += myok[tuple(mysrc)]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		myrms = np.sqrt(np.maximum(mysumsq/mycount-np.abs(mysum/mycount)**2, 0.0))
+	myrms[~myok | (mycount < 2)] = np.nan
+	return myrms
+
+
+def getrowchunks(mytime,myscan,nrowchunk):
+	'''start and end rows of chunks of at most about nrowchunk rows that hold whole integrations of one scan'''
+	nrows = len(mytime)
+	mytimeedges = np.append(np.nonzero((mytime[1:] != mytime[:-1]) | (myscan[1:] != myscan[:-1]))[0]+1, nrows)
+	myscanedges = np.append(np.nonzero(myscan[1:] != myscan[:-1])[0]+1, nrows)
+	mychunks = []
+	startrow = 0
+	while startrow < nrows:
+		myscanend = myscanedges[np.searchsorted(myscanedges, startrow, side='right')]
+		k = np.searchsorted(mytimeedges, startrow+nrowchunk, side='right')-1
+		if k >= 0 and mytimeedges[k] > startrow:
+			endrow = mytimeedges[k]
+		else:
+			endrow = mytimeedges[np.searchsorted(mytimeedges, startrow, side='right')]	# one integration longer than nrowchunk
+		endrow = int(min(endrow, myscanend))
+		mychunks.append((startrow, endrow))
+		startrow = endrow
+	return mychunks
+
+
+def flagresidualnp(myfile,myclipresid,mytimedev=6.0,myfreqdev=6.0,nvischunk=4000000):
+	'''flag the residuals (CORRECTED_DATA, or DATA, minus MODEL_DATA) in one chunked pass over the ms. Like rflag, the rms
+	in a window of 3 integrations and in a window of 3 channels is compared to mytimedev times its median over the chunk
+	for every channel and myfreqdev times its median for every integration; like clip, residual amplitudes outside
+	myclipresid and zeros are flagged. Chunks hold whole integrations of one scan. Returns the flag counts.'''
+	tb.open(myfile, nomodify=False)
+	mydatacol = 'DATA'
+	if 'CORRECTED_DATA' in tb.colnames():
+		mydatacol = 'CORRECTED_DATA'
+	mytime = tb.getcol('TIME')
+	myscan = tb.getcol('SCAN_NUMBER')
+	mybl = tb.getcol('ANTENNA1')*10000+tb.getcol('ANTENNA2')
+	ncorr, nchan = tb.getcell('FLAG', 0).shape
+	mystats = {'total': 0, 'before': 0, 'after': 0, 'time': 0, 'freq': 0, 'clip': 0}
+	for startrow, endrow in getrowchunks(mytime, myscan, max(1, nvischunk/(ncorr*nchan))):
+		nrow = endrow-startrow
+		myflag = tb.getcol('FLAG', startrow, nrow)
+		myresid = tb.getcol(mydatacol, startrow, nrow)-tb.getcol('MODEL_DATA', startrow, nrow)
+		myblids, myblidx = np.unique(mybl[startrow:endrow], return_inverse=True)
+		mytimes, mytimeidx = np.unique(mytime[startrow:endrow], return_inverse=True)
+		mycube = np.zeros((ncorr, nchan, len(myblids), len(mytimes)), dtype=myresid.dtype)
+		myok = np.zeros(mycube.shape, dtype=bool)
+		mycube[:,:,myblidx,mytimeidx] = myresid
+		myok[:,:,myblidx,mytimeidx] = ~myflag
+		mytimerms = getwindowrms(mycube, myok, 3)
+		myfreqrms = getwindowrms(mycube, myok, 1)
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore')	# all-nan slices for channels or integrations that are fully flagged
+			mytimethr = np.nanmedian(mytimerms.reshape(ncorr, nchan, -1), axis=2)
+			myfreqthr = np.nanmedian(myfreqrms.transpose(0,3,1,2).reshape(ncorr, len(mytimes), -1), axis=2)
+		myamp = np.abs(mycube)
+		with np.errstate(invalid='ignore'):
+			mytimeflag = myok & (mytimerms > mytimedev*mytimethr[:,:,None,None])
+			myfreqflag = myok & (myfreqrms > myfreqdev*myfreqthr[:,None,None,:])
+		myclipflag = myok & ((myamp < myclipresid[0]) | (myamp > myclipresid[1]) | (myamp == 0.0))
+		mystats['total'] += myflag.size
+		mystats['before'] += np.count_nonzero(myflag)
+		mystats['time'] += np.count_nonzero(mytimeflag)
+		mystats['freq'] += np.count_nonzero(myfreqflag)
+		mystats['clip'] += np.count_nonzero(myclipflag)
+		myflag |= (mytimeflag | myfreqflag | myclipflag)[:,:,myblidx,mytimeidx]
+		mystats['after'] += np.count_nonzero(myflag)
+		tb.putcol('FLAG', myflag, startrow, nrow)
+		tb.putcol('FLAG_ROW', tb.getcol('FLAG_ROW', startrow, nrow) | myflag.all(axis=(0,1)), startrow, nrow)
+	tb.close()
+	return mystats
+
+
 def flagresidual(myfile,myclipresid,myflagspw):
+	'''flag the residuals of a self-cal loop; returns the flag counts when they were found in the NumPy pass'''
+	global mynflagbackups
+	if fastresidflag == True and myflagspw == '' and getnspw(myfile) == 1:
+		mytime0 = time.time()
+		mystats = flagresidualnp(myfile,myclipresid)
+		print "Residual flagging: %.2f%% flagged before, %.2f%% after (time %d, frequency %d, clip %d new points) in %.1f s." % (
+			100.0*mystats['before']/max(mystats['total'],1), 100.0*mystats['after']/max(mystats['total'],1),
+			mystats['time'], mystats['freq'], mystats['clip'], time.time()-mytime0)
+		return mystats
 	default(flagdata)
 	flagdata(vis=myfile, mode ='rflag', datacolumn="RESIDUAL_DATA", field='', timecutoff=6.0,  freqcutoff=6.0,
 		timefit="line", freqfit="line",	flagdimension="freqtime", extendflags=False, timedevscale=6.0,
 		freqdevscale=6.0, spectralmax=500.0, extendpols=False, growaround=False, flagneartime=False,
-		flagnearfreq=False, action="apply", flagbackup=True, overwrite=True, writeflags=True)
+		flagnearfreq=False, action="apply", flagbackup=False, overwrite=True, writeflags=True)
 	default(flagdata)
 	flagdata(vis=myfile, mode ='clip', datacolumn="RESIDUAL_DATA", clipminmax=myclipresid,
 		clipoutside=True, clipzeros=True, field='', spw=myflagspw, extendflags=False,
 		extendpols=False, growaround=False, flagneartime=False,	flagnearfreq=False,
-		action="apply",	flagbackup=True, overwrite=True, writeflags=True)
+		action="apply",	flagbackup=False, overwrite=True, writeflags=True)
 	flagdata(vis=myfile,mode="summary",datacolumn="RESIDUAL_DATA", extendflags=False, 
-		name=myfile+'temp.summary', action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		name=myfile+'temp.summary', action="apply", flagbackup=False,overwrite=True, writeflags=True)
+	mynflagbackups += 3
+	return {}
 #
 
 
 	 
 
+def getimagemetrics(myimg,mynterms):
+	'''peak of the restored image and robust rms (from the median absolute deviation) of the residual image'''
+	if mynterms > 1:
+		mysuffix = '.tt0'
+	else:
+		mysuffix = ''
+	myrms = 1.4826*imstat(imagename=myimg+'.residual'+mysuffix)['medabsdevmed'][0]
+	mypeak = imstat(imagename=myimg+'.image'+mysuffix)['max'][0]
+	return float(mypeak), float(myrms)
+
+
+def getpostscript(myimg,mynterms,myresult):
+	'''CASA script that exports the restored image to FITS, through a temporary name so that an interrupted
+	export leaves no FITS file, and writes the peak and robust rms of getimagemetrics to myresult'''
+	if mynterms > 1:
+		mysuffix = '.tt0'
+	else:
+		mysuffix = ''
+	mylines = ['import os, json',
+		'os.system(%r)' % ('rm -rf '+myimg+'.fits.part'),
+		'exportfits(imagename=%r, fitsimage=%r)' % (myimg+'.image'+mysuffix, myimg+'.fits.part'),
+		'os.rename(%r, %r)' % (myimg+'.fits.part', myimg+'.fits'),
+		'myrms = 1.4826*imstat(imagename=%r)[\'medabsdevmed\'][0]' % (myimg+'.residual'+mysuffix),
+		'mypeak = imstat(imagename=%r)[\'max\'][0]' % (myimg+'.image'+mysuffix),
+		'json.dump([float(mypeak), float(myrms)], open(%r,\'w\'))' % (myresult)]
+	return '\n'.join(mylines)+'\n'
+
+
+class mypostqueue:
+	'''post-processing of the self-cal products in a background thread while the next steps run: CASA scripts
+	(FITS export, image statistics) run as separate processes and old files are removed, one job at a time in
+	the order they were queued. wait returns the result of one job, drain waits for all of them.'''
+	def __init__(self):
+		self.myqueue = Queue.Queue()
+		self.myjobs = []
+		self.mywaited = 0.0
+		self.mythread = threading.Thread(target=self.run)
+		self.mythread.daemon = True
+		self.mythread.start()
+	def submit(self,myname,myscript='',myremove=[],myresult=''):
+		myjob = {'name': myname, 'script': myscript, 'remove': myremove, 'result': myresult, 'output': None,
+			'seconds': 0.0, 'done': threading.Event()}
+		self.myjobs.append(myjob)
+		self.myqueue.put(myjob)
+		return myjob
+	def run(self):
+		while True:
+			myjob = self.myqueue.get()
+			mytime0 = time.time()
+			try:
+				if myjob['script'] != '':
+					open(myjob['name']+'.py','w').write(myjob['script'])
+					mylog = open(myjob['name']+'.log','w')
+					myexitcode = subprocess.call(getcasacmd(myjob['name']+'.py'), stdout=mylog, stderr=subprocess.STDOUT)
+					mylog.close()
+					if myexitcode != 0:
+						print "Background job %s failed with exit code %d; see %s.log." % (myjob['name'], myexitcode, myjob['name'])
+					if myjob['result'] != '' and os.path.exists(myjob['result']):
+						myjob['output'] = json.load(open(myjob['result']))
+				for myfile in myjob['remove']:
+					os.system('rm -rf '+myfile)
+			finally:
+				myjob['seconds'] = time.time()-mytime0
+				myjob['done'].set()
+				self.myqueue.task_done()
+	def wait(self,myjob):
+		mytime0 = time.time()
+		while not myjob['done'].wait(1.0):	# with a timeout so that the wait can be interrupted
+			pass
+		self.mywaited += time.time()-mytime0
+		return myjob['output']
+	def drain(self):
+		for myjob in self.myjobs:
+			self.wait(myjob)
+		print "Background post-processing: %d jobs took %.1f s, of which the self-cal loop waited %.1f s." % (len(self.myjobs),
+			sum([myjob['seconds'] for myjob in self.myjobs]), self.mywaited)
+
+
+gmrtpbcoeffs = {'band2': [-2.83, 33.564, -18.026, 3.588], 'band3': [-2.939, 33.312, -16.659, 3.006],
+	'band4': [-3.190, 38.642, -20.471, 3.964], 'band5': [-2.608, 27.357, -13.091, 2.368]}	# a, b, c, d of the GMRT primary beam polynomial
+
+def readfitsheader(myfits):
+	'''keywords of the primary header of a FITS file and the header as bytes (the data start right after it)'''
+	myheader = {}
+	myblocks = ''
+	myfile = open(myfits,'rb')
+	while True:
+		myblock = myfile.read(2880)
+		if len(myblock) < 2880:
+			myfile.close()
+			raise IOError('no END card in the header of '+myfits)
+		myblocks += myblock
+		for k in range(0,36):
+			mycard = myblock[80*k:80*k+80]
+			if mycard[0:8].strip() == 'END':
+				myfile.close()
+				return myheader, myblocks
+			if mycard[8:10] != '= ':
+				continue
+			myvalue = mycard[10:].strip()
+			if myvalue.startswith("'"):
+				myvalue = myvalue[1:myvalue.index("'",1)].strip()
+			else:
+				myvalue = myvalue.split('/')[0].strip()
+				if myvalue in ['T','F']:
+					myvalue = myvalue == 'T'
+				else:
+					try:
+						myvalue = int(myvalue)
+					except ValueError:
+						myvalue = float(myvalue)
+			myheader[mycard[0:8].strip()] = myvalue
+
+
+def getfitsplanes(myfits,myheader,myoffset,mymode='r'):
+	'''the image planes of a FITS file as a memory map of shape (planes, rows, columns)'''
+	mydtype = {-32: '>f4', -64: '>f8', 16: '>i2', 32: '>i4'}[myheader['BITPIX']]
+	myshape = [myheader['NAXIS'+str(n)] for n in range(myheader['NAXIS'],0,-1)]
+	mydata = np.memmap(myfits, dtype=mydtype, mode=mymode, offset=myoffset, shape=tuple(myshape))
+	return mydata.reshape(-1, myshape[-2], myshape[-1])
+
+
+def getfitsstats(myplane,mytilerows=256,nthreads=1,nbins=100000):
+	'''peak and robust rms (1.4826 times the median absolute deviation) of an image plane, read in strips of
+	mytilerows rows in nthreads threads. A sparse sample gives a first median and rms, a histogram of 100000
+	bins across 50 of those rms either side of it then gives the median and the deviation to within 1/1000 rms.'''
+	mystrips = [(k, min(k+mytilerows, myplane.shape[0])) for k in range(0, myplane.shape[0], mytilerows)]
+	mypool = multiprocessing.pool.ThreadPool(nthreads)
+	def getsample(mystrip):
+		mytile = np.array(myplane[mystrip[0]:mystrip[1]], dtype=float)
+		mygood = np.isfinite(mytile)
+		if not mygood.any():
+			return -np.inf, np.zeros(0)
+		mysample = mytile[::8,::8]
+		return mytile[mygood].max(), mysample[np.isfinite(mysample)]
+	mysamples = mypool.map(getsample, mystrips)
+	mypeak = max([myresult[0] for myresult in mysamples])
+	mysample = np.concatenate([myresult[1] for myresult in mysamples])
+	if len(mysample) == 0:
+		mypool.close()
+		return None, None
+	mymedian = np.median(mysample)
+	mymad = max(np.median(np.abs(mysample-mymedian)), 1.0E-12)
+	mylow, myhigh = mymedian-50.0*mymad, mymedian+50.0*mymad
+	def gethist(mystrip):
+		mytile = np.array(myplane[mystrip[0]:mystrip[1]], dtype=float)
+		mytile = mytile[np.isfinite(mytile)]
+		return np.histogram(mytile, nbins, (mylow, myhigh))[0], np.count_nonzero(mytile < mylow), np.count_nonzero(mytile > myhigh)
+	myhists = mypool.map(gethist, mystrips)
+	mypool.close()
+	myhist = sum([myresult[0] for myresult in myhists])
+	nbelow = sum([myresult[1] for myresult in myhists])
+	ntotal = myhist.sum()+nbelow+sum([myresult[2] for myresult in myhists])
+	mywidth = (myhigh-mylow)/nbins
+	mycum = np.concatenate([[0], np.cumsum(myhist)])+nbelow	# values below the lower edge of every bin
+	j = min(max(np.searchsorted(mycum, ntotal/2.0)-1, 0), nbins-1)
+	mymedian = mylow+(j+0.5)*mywidth
+	myhalf = np.arange(0, nbins)
+	mywithin = mycum[np.minimum(j+myhalf+1, nbins)]-mycum[np.maximum(j-myhalf, 0)]	# values within half bins of the median bin
+	k = np.searchsorted(mywithin, ntotal/2.0)
+	if k < nbins:
+		mymad = (k+0.5)*mywidth
+	return mypeak, 1.4826*mymad
+
+
+def getgmrtpb(myband,myx):
+	'''GMRT primary beam at myx = distance from the pointing centre in arcmin times frequency in GHz'''
+	a, b, c, d = gmrtpbcoeffs[myband]
+	return 1.0+(a/1.0E03)*myx**2+(b/1.0E07)*myx**4+(c/1.0E10)*myx**6+(d/1.0E13)*myx**8
+
+
+def writepbcor(myfits,myoutfits,mytilerows=256,nthreads=1):
+	'''copy of a FITS image divided by the GMRT primary beam of the band of its frequency axis, blanked where the
+	beam is below pblimit, written strip by strip in nthreads threads. Returns the band, or '' without a frequency axis.'''
+	myheader, myheaderbytes = readfitsheader(myfits)
+	myfreq = 0.0
+	for n in range(1,myheader['NAXIS']+1):
+		if str(myheader.get('CTYPE'+str(n),'')).startswith('FREQ'):
+			myfreq = float(myheader['CRVAL'+str(n)])
+	if myfreq <= 0.0:
+		return ''
+	myband = getbandname([myfreq])
+	myplanes = getfitsplanes(myfits, myheader, len(myheaderbytes))
+	myend = myheaderbytes.index('END'+' '*77)
+	if (myend/80) % 36 != 35:	# room for one more card before the end of the block
+		mycard = ('HISTORY GMRT primary beam of %s at %.4f GHz divided out, blanked below %.2f' % (myband, myfreq/1.0E09, pblimit)).ljust(80)[0:80]
+		myheaderbytes = myheaderbytes[0:myend]+mycard+'END'.ljust(80)+myheaderbytes[myend+160:]
+	nbytes = myplanes.size*myplanes.dtype.itemsize
+	myout = open(myoutfits,'wb')
+	myout.write(myheaderbytes)
+	myout.truncate(len(myheaderbytes)+2880*((nbytes+2879)/2880))	# the data padded to whole blocks with zeros
+	myout.close()
+	myoutplanes = getfitsplanes(myoutfits, myheader, len(myheaderbytes), 'r+')
+	nrows, ncols = myplanes.shape[1], myplanes.shape[2]
+	myxoff = ((np.arange(ncols)-(myheader['CRPIX1']-1.0))*myheader['CDELT1']*60.0)**2
+	def pbcorstrip(mystrip):
+		myyoff = ((np.arange(mystrip[0],mystrip[1])-(myheader['CRPIX2']-1.0))*myheader['CDELT2']*60.0)**2
+		mybeam = getgmrtpb(myband, np.sqrt(myyoff[:,np.newaxis]+myxoff[np.newaxis,:])*myfreq/1.0E09)
+		for p in range(0,myplanes.shape[0]):
+			with np.errstate(invalid='ignore', divide='ignore'):
+				myoutplanes[p,mystrip[0]:mystrip[1]] = np.where(mybeam >= pblimit, myplanes[p,mystrip[0]:mystrip[1]]/mybeam, np.nan)
+	mypool = multiprocessing.pool.ThreadPool(nthreads)
+	mypool.map(pbcorstrip, [(k, min(k+mytilerows, nrows)) for k in range(0, nrows, mytilerows)])
+	mypool.close()
+	myoutplanes.flush()
+	return myband
+
+
+def postimages(myimages):
+	'''peak, robust rms and dynamic range of the FITS files of the self-cal images, and with pbcorrect a primary
+	beam corrected copy <image>-pbcor.fits of each; the metrics go to the run report. A FITS file that cannot be
+	read is skipped with a warning, as these are only reports on the images.'''
+	for myimg in myimages:
+		if not os.path.exists(myimg+'.fits'):
+			continue
+		mystart = getresources()
+		try:
+			myheader, myheaderbytes = readfitsheader(myimg+'.fits')
+			mypeak, myrms = getfitsstats(getfitsplanes(myimg+'.fits', myheader, len(myheaderbytes))[0], nthreads=getncores())
+			mymetrics = {'peak': mypeak, 'rms': myrms}
+			if myrms is not None and myrms > 0:
+				mymetrics['dynamicrange'] = mypeak/myrms
+				print "%s.fits: peak %.4f Jy/beam, robust rms %.4f mJy/beam, dynamic range %.0f." % (myimg, mypeak, myrms*1000.0, mypeak/myrms)
+			if pbcorrect == True:
+				mymetrics['band'] = writepbcor(myimg+'.fits', myimg+'-pbcor.fits', nthreads=getncores())
+				if mymetrics['band'] == '':
+					print "%s.fits has no frequency axis; no primary beam correction." % (myimg)
+				else:
+					print "Wrote %s-pbcor.fits with the %s primary beam." % (myimg, mymetrics['band'])
+		except (IOError, ValueError, KeyError, IndexError) as myerror:
+			print "Warning: skipping %s.fits, which cannot be read as a FITS image: %s" % (myimg, myerror)
+			os.system('rm -f '+myimg+'-pbcor.fits')	# a half written copy
+			continue
+		if runreport != '':
+			writereport('image', myimg+'.fits', mystart, mymetrics)
+
+
+def getgainmetrics(mytable,mypap):
+	'''median SNR of the unflagged solutions of a self-cal gain table and their scatter: rms phase in degrees
+	for p tables, rms deviation of the amplitude from one for ap tables'''
+	tb.open(mytable)
+	mycparam = tb.getcol('CPARAM')
+	mysnr = tb.getcol('SNR')
+	mygood = ~tb.getcol('FLAG')
+	tb.close()
+	if mygood.sum() == 0:
+		return 0.0, 0.0
+	if mypap == 'p':
+		myscatter = np.degrees(np.sqrt(np.mean(np.angle(mycparam[mygood])**2)))
+	else:
+		myscatter = np.sqrt(np.mean((np.abs(mycparam[mygood])-1.0)**2))
+	return float(np.median(mysnr[mygood])), float(myscatter)
+
+
+def getsolintsec(mysolint):
+	'''a solint such as '8.0min', '30s' or '1h' in seconds; None for 'int', 'inf' and other forms'''
+	for myunit, myscale in [('min',60.0), ('s',1.0), ('h',3600.0)]:
+		if mysolint.endswith(myunit):
+			try:
+				return float(mysolint[:-len(myunit)])*myscale
+			except ValueError:
+				return None
+	return None
+
+
 def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynterms2,mywproj1,mysolint1,myclipresid,myflagspw,mygainspw2,mymakedirty):
 	myref = myref
 	nscal = nloops # number of selfcal loops
@@ -404,6 +2063,11 @@ def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynte
 	# selfcal loop
 	myimages=[]
 	mygt=[]
+	mysolint1 = list(mysolint1)	# adaptive self-cal may change the solints
+	myrecord = {}	# image and gain metrics of every loop
+	mypost = None
+	if asyncpost == True:
+		mypost = mypostqueue()	# FITS export, image statistics and removal of old files while the loops go on
 	myniterstart = 1500
 	myniterend = 200000	
 #	myval= myvalinit # mJy
@@ -420,6 +2084,8 @@ def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynte
 		exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
 	else:
 		for i in range(0,nscal+1): # plan 4 P and 4AP iterations
+			if i > nscal:
+				break	# adaptive self-cal stopped early
 			if mymakedirty == True:
 				if i == 0:
 					myniter = 0 # this is to make a dirty image
@@ -430,7 +2096,9 @@ def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynte
 						myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # clean
 					else:
 						myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # tclean
-					if mynterms2 > 1:
+					if mypost is not None:
+						mypost.submit('post-'+myimg, getpostscript(myimg,mynterms2,myimg+'-stats.json'), [], myimg+'-stats.json')
+					elif mynterms2 > 1:
 						exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
 					else:
 						exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
@@ -442,56 +2110,111 @@ def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynte
 #				mythresh = myval[i]
 				mythresh = str(myvalinit/(i+1))+'mJy'
 #				print i, 'mythreshold=',mythresh
+				if adaptiveselfcal == True and myrecord.get(i-1,{}).get('rms') is not None:
+					mythresh = str(selfcalnsigma*myrecord[i-1]['rms']*1000.0)+'mJy'
+					if myrecord.get(i-2,{}).get('rms') is not None:
+						mydrgain = (myrecord[i-1]['peak']/myrecord[i-1]['rms'])/(myrecord[i-2]['peak']/myrecord[i-2]['rms']) - 1.0
+						print "Dynamic range changed by %.1f%% in the last loop." % (100.0*mydrgain)
+						if mydrgain < selfcaltol and i < npal and npal < nscal:
+							print "Phase-only self-cal has converged; going on to the amplitude and phase loops."
+							npal = i
+						elif mydrgain < selfcaltol and (i < npal or i-2 >= npal):
+							print "Self-cal has converged; this is the last loop."
+							nscal = i
 				if i < npal:
 					mypap = 'p'
-					print "Using "+ myfile[i]+" for imaging."
-					if usetclean == False:
-						myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # clean
-					else:
-						myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # tclean
-					if mynterms2 > 1:
-						exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-					else:
-						exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
-					myimages.append(myimg)	# list of all the images created so far
-					flagresidual(myfile[i],clipresid,'')
-					if i>0:
-						myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,uvrascal,mygainspw2)
-					else:					
-						myctables = mygaincal_ap(myfile[i],myref,mygt,i,mypap,mysolint1,uvrascal,mygainspw2)						
-					mygt.append(myctables) # full list of gaintables
-					if i < nscal+1:
-						myapplycal(myfile[i],mygt[i])
-						myoutfile= mysplit(myfile[i],i)
-						myfile.append(myoutfile)
-#						print i, myfile1
+					myuvrascal = uvrascal
+					mysolve = True
 				else:
 					mypap = 'ap'
-					print "Using "+ myfile[i]+" for imaging."
-					if usetclean == False:
-						myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # clean
-					else:
-						myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # tclean
-					if mynterms2 > 1:
-						exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
+					myuvrascal = ''
+					mysolve = i != nscal
+				if adaptiveselfcal == True and mysolve == True and myrecord.get(i-1,{}).get('mode') == mypap and myrecord[i-1].get('snr',0) > 0:
+					myprevsec = getsolintsec(myrecord[i-1]['solint'])
+					if myprevsec is not None:
+						mysec = myprevsec*(selfcalsnr/myrecord[i-1]['snr'])**2
+						mysolint1[i] = '%.0fs' % (min(max(mysec, myprevsec/4.0, 8.0), myprevsec*4.0))
+						print "Gain SNR was %.1f with solint %s; using %s." % (myrecord[i-1]['snr'], myrecord[i-1]['solint'], mysolint1[i])
+				mystage = 'selfcal'+str(i)
+				if mystagetorun(mystage, True, {'vis': myfile[i], 'niter': myniter, 'threshold': mythresh, 'mode': mypap,
+						'solve': mysolve, 'solint': mysolint1[i] if mysolve else '', 'uvrange': myuvrascal, 'cell': mycellsize,
+						'imsize': myimagesize, 'nterms': mynterms2, 'wproj': mywproj1, 'clipresid': myclipresid,
+						'inplace': selfcalinplace}) == False:
+					myoutputs = mystageoutputs(mystage)
+					myrecord[i] = myoutputs
+					myimages.append(myoutputs['image'])
+					if mysolve == True:
+						mygt.append(myoutputs['gaintable'])
+						myfile.append(myoutputs['vis'])
+					continue
+				if not os.path.exists(myfile[i]):
+					raise IOError("Cannot resume self-cal at loop %d: %s is missing. Remove capture-manifest.json to start the self-cal again." % (i, myfile[i]))
+				if mygt == []:
+					clearcal(vis = myfile[i])	# only when the first loop runs, so that a resumed run keeps the files of the finished loops as they were
+				if selfcalinplace == True and mygt == []:
+					mydropcorrected(myfile[i])
+				mywritten = getwrittenbytes()
+				mysaveflags(myfile[i],mystage)
+				print "Using "+ myfile[i]+" for imaging."
+				if usetclean == False:
+					myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # clean
+				else:
+					myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1)   # tclean
+				if mypost is not None:
+					mypostjob = mypost.submit('post-'+myimg, getpostscript(myimg,mynterms2,myimg+'-stats.json'), [], myimg+'-stats.json')
+				elif mynterms2 > 1:
+					exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
+				else:
+					exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
+				myimages.append(myimg)	# list of all the images created so far
+				if mypost is None:
+					mypeak, myrms = getimagemetrics(myimg,mynterms2)
+					print "Loop %d: peak %.4f Jy/beam, residual rms %.4f mJy/beam, dynamic range %.0f." % (i, mypeak, myrms*1000.0, mypeak/myrms)
+				myresidflags = flagresidual(myfile[i],clipresid,'')
+				myoutputs = {'image': myimg, 'mode': mypap}
+				if mypost is None:
+					myoutputs['peak'], myoutputs['rms'] = mypeak, myrms
+				if myresidflags != {}:
+					myoutputs['residflagged'] = float(myresidflags['after'])/max(myresidflags['total'],1)
+				myoutfiles = [myimg+'.fits']
+				if mysolve == True:
+					myctables = mygaincal_ap(myfile[i],myref,mygt,i,mypap,mysolint1,myuvrascal,mygainspw2,selfcalinplace)
+					mygt.append(myctables) # full list of gaintables
+					if selfcalinplace == True:
+						myapplycal(myfile[i],mygt)	# all the tables so far, so CORRECTED_DATA is DATA with every loop applied
+						myoutfile = myfile[i]
 					else:
-						exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
-					myimages.append(myimg)	# list of all the images created so far
-					flagresidual(myfile[i],clipresid,'')
-					if i!= nscal:
-						myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,'',mygainspw2)
-						mygt.append(myctables) # full list of gaintables
-						if i < nscal+1:
-							myapplycal(myfile[i],mygt[i])
-							myoutfile= mysplit(myfile[i],i)
-							myfile.append(myoutfile)
-							print i, myfile1
-				print "Visibilities from the previous selfcal will be deleted."
-				if i < nscal:
+						myapplycal(myfile[i],mygt[i])
+						myoutfile= mysplit(myfile[i],i)
+					myfile.append(myoutfile)
+					myoutputs['gaintable'] = myctables
+					myoutputs['vis'] = myoutfile
+					myoutputs['solint'] = mysolint1[i]
+					myoutputs['snr'], myoutputs['scatter'] = getgainmetrics(myctables,mypap)
+					print "Loop %d: median gain SNR %.1f, gain scatter %.3f." % (i, myoutputs['snr'], myoutputs['scatter'])
+					myoutfiles.append(myctables)
+				if mypost is not None:
+					myoutputs['peak'], myoutputs['rms'] = mypost.wait(mypostjob) or (None, None)	# needed by the manifest and the next loop
+					if myoutputs['rms'] is not None:
+						print "Loop %d: peak %.4f Jy/beam, residual rms %.4f mJy/beam, dynamic range %.0f." % (i, myoutputs['peak'],
+							myoutputs['rms']*1000.0, myoutputs['peak']/myoutputs['rms'])
+				myrecord[i] = myoutputs
+				mystagedone(mystage, myoutputs, myoutfiles)
+				print "Self-cal loop %d wrote %.1f MB; the visibilities take %.1f MB on disk." % (i, (getwrittenbytes()-mywritten)/1.0e6, getdirsize(myfile[-1])/1.0e6)
+				if selfcalinplace == False and i < nscal:
+					print "Visibilities from the previous selfcal will be deleted."
 					myoldvis = 'vis-selfcal'+str(i-1)+'.ms'
 					print "Deleting "+str(myoldvis)
-					os.system('rm -rf '+str(myoldvis))
+					dropflagstate(myoldvis)
+					if mypost is not None:
+						mypost.submit('rm-'+myoldvis, '', getmsfiles(myoldvis))
+					else:
+						os.system('rm -rf '+' '.join(getmsfiles(myoldvis)))
 			print 'Ran the selfcal loop'
+	if mypost is not None:
+		mypost.drain()
+	if imagepost == True:
+		postimages(myimages)
 	return myfile, mygt, myimages
 
 def myflagsum(myfile,myfields):
@@ -502,22 +2225,584 @@ def myflagsum(myfile,myfields):
 #		print("\n %2.1f%% of the source are flagged.\n" % (100.0 * flagsum['field'][src]['flagged'] / flagsum['field'][src]['total']))
 	return flagpercentage
 
+mymanifest = {}         # stages finished in this directory, as recorded in capture-manifest.json
+mystagesigs = {}        # signatures of the stages seen in this run
+mystageinputs = {}      # files named in the parameters of the stages that are running
+mylaststagesig = ''     # signature of the last stage that ran or was found up to date, with the state of its files
+
+def getmanifest():
+	'''the run manifest of this directory'''
+	global mymanifest
+	if mymanifest == {}:
+		if os.path.exists('capture-manifest.json'):
+			mymanifest = mystrings(json.load(open('capture-manifest.json')))
+		else:
+			mymanifest = {'stages': {}}
+	return mymanifest
+
+
+def getartifactstate(mypath):
+	'''size in bytes and latest modification time of a file or of the files below a directory, leaving out
+	the table.lock files that CASA writes whenever it opens a table; None when the path does not exist'''
+	if not os.path.exists(mypath):
+		return None
+	if os.path.isfile(mypath):
+		return [os.path.getsize(mypath), os.path.getmtime(mypath)]
+	mysize = 0
+	mymtime = 0.0
+	for mydir, mysubdirs, myfiles in os.walk(mypath):
+		for myname in myfiles:
+			if myname != 'table.lock':
+				mysize += os.path.getsize(os.path.join(mydir, myname))
+				mymtime = max(mymtime, os.path.getmtime(os.path.join(mydir, myname)))
+	return [mysize, mymtime]
+
+
+def getparpaths(mypars):
+	'''existing files and directories named in the parameters of a stage'''
+	mypaths = []
+	for myvalue in mypars.values():
+		if not isinstance(myvalue, list):
+			myvalue = [myvalue]
+		mypaths.extend([v for v in myvalue if isinstance(v, str) and v != '' and os.path.exists(v)])
+	return mypaths
+
+
+def getlateststate(mypath):
+	'''state of a file as the stage that finished last with it left it'''
+	mystate = None
+	myseq = -1
+	for myrecord in getmanifest()['stages'].values():
+		if myrecord.get('states',{}).has_key(mypath) and myrecord.get('seq',0) > myseq:
+			mystate = myrecord['states'][mypath]
+			myseq = myrecord.get('seq',0)
+	return mystate
+
+
+def mystagetorun(mystage,mydostage,mypars):
+	'''True when a stage that is switched on has to run. With doresume a stage is skipped when it
+	finished before with the same parameters after the same upstream stages and its files are still there
+	and unchanged: the size and modification time of every input and output file must be those the last
+	stage that used the file left it with, so files remade or edited outside the pipeline are noticed.
+	The signature of a stage includes the state of the files of the stage before it, so the stages after
+	one that ran again run again too. A stage that is switched off counts as unchanged for the stages after it.
+	mypars can also be a function that returns the parameters, for stages whose parameters only exist when
+	the stages before them run (e.g. the channel windows of the calibration stages when fromms is False).'''
+	global mylaststagesig, mycurrentstage
+	myrecord = getmanifest()['stages'].get(mystage)
+	if mydostage == False:
+		if myrecord != None:
+			mylaststagesig = myrecord.get('chainsig', myrecord['sig'])
+		return False
+	if callable(mypars):
+		mypars = mypars()
+	mysig = hashlib.md5(json.dumps([mylaststagesig, mystage, mypars], sort_keys=True)).hexdigest()
+	mystagesigs[mystage] = mysig
+	mystageinputs[mystage] = getparpaths(mypars)
+	mylaststagesig = mysig
+	if doresume == True and myrecord != None and myrecord['sig'] == mysig:
+		mymissing = [f for f in myrecord['files'] if not os.path.exists(f)]
+		mychanged = []	# inputs that the pipeline removed later, such as old self-cal files, need not be there
+		for myfile in sorted(myrecord.get('states',{}).keys()):
+			mystate = getartifactstate(myfile)
+			if mystate is not None and mystate != getlateststate(myfile):
+				mychanged.append(myfile)
+		if mymissing == [] and mychanged == []:
+			print "Stage %s is up to date (finished %s); skipping it." % (mystage, myrecord['time'])
+			mylaststagesig = myrecord.get('chainsig', mysig)
+			return False
+		if mymissing != []:
+			print "Stage %s has to run again: %s missing." % (mystage, ', '.join(mymissing))
+		else:
+			print "Stage %s has to run again: %s changed outside the pipeline." % (mystage, ', '.join(mychanged))
+	mycurrentstage = mystage
+	if runreport != '':
+		mystagestarts[mystage] = getresources()
+	return True
+
+
+def mystagedone(mystage,myoutputs={},myfiles=[]):
+	'''record a finished stage with the names it produced and the files that have to exist to skip it next time'''
+	global mylaststagesig
+	mymanifest = getmanifest()
+	mystates = {}
+	for myfile in myfiles+mystageinputs.pop(mystage, []):
+		mystates[myfile] = getartifactstate(myfile)
+	mychainsig = hashlib.md5(json.dumps([mystagesigs[mystage], mystates], sort_keys=True)).hexdigest()
+	myseq = max([myrecord.get('seq',0) for myrecord in mymanifest['stages'].values()]+[0])+1
+	mymanifest['stages'][mystage] = {'sig': mystagesigs[mystage], 'outputs': myoutputs, 'files': myfiles,
+		'states': mystates, 'chainsig': mychainsig, 'seq': myseq, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+	mylaststagesig = mychainsig
+	json.dump(mymanifest, open('capture-manifest.json.tmp','w'), indent=1, sort_keys=True)
+	os.rename('capture-manifest.json.tmp', 'capture-manifest.json')
+	if runreport != '' and mystagestarts.has_key(mystage):
+		writereport('stage', mystage, mystagestarts.pop(mystage))
+
+
+def mystageoutputs(mystage):
+	'''names recorded by a stage that finished in an earlier run'''
+	return getmanifest()['stages'][mystage]['outputs']
+
+
+def getmtime(myfile):
+	'''modification time of a file, or 0 when it does not exist'''
+	if os.path.exists(myfile):
+		return os.path.getmtime(myfile)
+	return 0
+
+
+myrunid = time.strftime('%Y-%m-%d %H:%M:%S')	# start of this run, as written in the run report
+mystagestarts = {}	# resource counters at the start of every stage that is running
+mycurrentstage = ''	# stage that the CASA task calls belong to
+
+def getprocio():
+	'''bytes this process has read from and written to disk so far, from /proc/self/io; zeros where that is not available'''
+	myio = {}
+	try:
+		for myline in open('/proc/self/io'):
+			mywords = myline.split()
+			myio[mywords[0].rstrip(':')] = int(mywords[1])
+	except IOError:
+		pass
+	return myio.get('read_bytes',0), myio.get('write_bytes',0)
+
+
+def getresources():
+	'''wall time, CPU time of this process and its children, peak RSS in MB and bytes read and written so far'''
+	mytimes = os.times()
+	mymaxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024.0
+	myread, mywritten = getprocio()
+	return {'wall': time.time(), 'cpu': mytimes[0]+mytimes[1]+mytimes[2]+mytimes[3], 'maxrss': mymaxrss, 'read': myread, 'written': mywritten}
+
+
+def getflagfraction(myfile,nrowchunk=100000):
+	'''fraction of the visibilities of an ms that are flagged, read in chunks of rows'''
+	nflagged = 0
+	ntotal = 0
+	tb.open(myfile)
+	nrows = tb.nrows()
+	for startrow in range(0, nrows, nrowchunk):
+		myflag = tb.getcol('FLAG', startrow, min(nrowchunk, nrows-startrow))
+		nflagged += np.count_nonzero(myflag)
+		ntotal += myflag.size
+	tb.close()
+	return nflagged/max(float(ntotal),1.0)
+
+
+def writereport(mykind,myname,mystart,myextra={}):
+	'''append the resources used since mystart by a task call or a stage to the run report'''
+	myend = getresources()
+	myrecord = {'run': myrunid, 'kind': mykind, 'name': myname, 'stage': mycurrentstage,
+		'wall': myend['wall']-mystart['wall'], 'cpu': myend['cpu']-mystart['cpu'], 'maxrss_mb': myend['maxrss'],
+		'read_mb': (myend['read']-mystart['read'])/1.0e6, 'written_mb': (myend['written']-mystart['written'])/1.0e6}
+	myrecord.update(myextra)
+	myout = open(runreport,'a')
+	myout.write(json.dumps(myrecord, sort_keys=True)+'\n')
+	myout.close()
+
+
+class mytaskprofile:
+	'''a CASA task whose calls are written to the run report; anything else is passed on to the task'''
+	def __init__(self,mytask,myname):
+		self.mytask = mytask
+		self.__name__ = myname
+	def __getattr__(self,myname):
+		return getattr(self.mytask, myname)
+	def __call__(self,*args,**kwargs):
+		myvis = kwargs.get('vis','')
+		if type(myvis) != str:
+			myvis = ''
+		myflagcheck = reportflags == True and self.__name__ in ['flagdata','applycal'] and kwargs.get('mode') != 'summary' and os.path.isdir(myvis)
+		myextra = {'vis': myvis}
+		if myflagcheck == True:
+			myextra['flagged_before'] = getflagfraction(myvis)
+		mystart = getresources()
+		myresult = self.mytask(*args, **kwargs)
+		if myflagcheck == True:
+			myextra['flagged_after'] = getflagfraction(myvis)
+		writereport('task', self.__name__, mystart, myextra)
+		return myresult
+
+
+def startprofiling(mytasks=['importgmrt','flagdata','setjy','gaincal','bandpass','fluxscale','applycal','clearcal','mstransform',
+		'virtualconcat','tclean','clean','exportfits']):
+	'''write every call of the given CASA tasks and every stage to the run report'''
+	for myname in mytasks:
+		if globals().has_key(myname) and not isinstance(globals()[myname], mytaskprofile):
+			globals()[myname] = mytaskprofile(globals()[myname], myname)
+	print "Writing the resources used by every stage and task to "+runreport
+
+
+def printreport():
+	'''table of the time, memory and I/O that went into every stage and every kind of task in this run'''
+	if not os.path.exists(runreport):
+		return
+	myrecords = [json.loads(myline) for myline in open(runreport)]
+	myrecords = [myrecord for myrecord in myrecords if myrecord['run'] == myrunid]
+	print "%-8s %-24s %6s %10s %10s %10s %10s %10s" % ('kind', 'name', 'calls', 'wall(min)', 'cpu(min)', 'rss(MB)', 'read(MB)', 'write(MB)')
+	for mykind in ['stage', 'task']:
+		mytotals = {}
+		for myrecord in myrecords:
+			if myrecord['kind'] != mykind:
+				continue
+			mytotal = mytotals.setdefault(myrecord['name'], [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+			mytotal[0] += 1
+			mytotal[1] += myrecord['wall']
+			mytotal[2] += myrecord['cpu']
+			mytotal[3] = max(mytotal[3], myrecord['maxrss_mb'])
+			mytotal[4] += myrecord['read_mb']
+			mytotal[5] += myrecord['written_mb']
+		for myname in sorted(mytotals.keys(), key=lambda myname: -mytotals[myname][1]):
+			mytotal = mytotals[myname]
+			print "%-8s %-24s %6d %10.1f %10.1f %10.0f %10.0f %10.0f" % (mykind, myname, mytotal[0], mytotal[1]/60.0, mytotal[2]/60.0, mytotal[3], mytotal[4], mytotal[5])
+	myflagrecords = [myrecord for myrecord in myrecords if myrecord.has_key('flagged_after')]
+	for myrecord in myflagrecords:
+		print "%s in %s on %s: flagged %.1f%% -> %.1f%%" % (myrecord['name'], myrecord['stage'], myrecord['vis'], 100.0*myrecord['flagged_before'], 100.0*myrecord['flagged_after'])
+	for myrecord in myrecords:
+		if myrecord['kind'] == 'image' and myrecord.get('dynamicrange') is not None:
+			print "%s: peak %.4f Jy/beam, robust rms %.4f mJy/beam, dynamic range %.0f" % (myrecord['name'], myrecord['peak'], 1000.0*myrecord['rms'], myrecord['dynamicrange'])
+
+
+def getncores():
+	'''number of cores on this machine'''
+	return multiprocessing.cpu_count()
+
+
+def getavailmem():
+	'''memory in bytes that is available for new processes (Linux /proc/meminfo)'''
+	for myline in open('/proc/meminfo'):
+		if myline.startswith('MemAvailable:'):
+			return float(myline.split()[1])*1024.0
+	return os.sysconf('SC_PAGE_SIZE')*float(os.sysconf('SC_PHYS_PAGES'))
+
+
+def getnworkers(njobs,myworkermem):
+	'''number of worker processes to run at once for njobs jobs that need myworkermem bytes each'''
+	nworkers = min(njobs, getncores())
+	if myworkermem > 0:
+		nworkers = min(nworkers, int(getavailmem()/myworkermem))
+	return max(nworkers, 1)
+
+
+def runworkers(myjobs,nworkers,mydone=None):
+	'''run jobs as separate processes, at most nworkers at a time. Each job is a dictionary with the
+	command to run, the working directory, the extra environment variables and a log file name.
+	A job can also name a file in its working directory that it writes when it gets to the end ('done'):
+	casa -c exits with 0 even when the script raises, so such a job only counts as finished without it.
+	mydone, when given, is called with every job that finishes with exit code 0 while the others run on.
+	Returns the exit codes in the order of the jobs.'''
+	myexitcodes = [None]*len(myjobs)
+	myrunning = {}
+	mynext = 0
+	while mynext < len(myjobs) or myrunning != {}:
+		while mynext < len(myjobs) and len(myrunning) < nworkers:
+			myjob = myjobs[mynext]
+			myenv = dict(os.environ)
+			myenv.update(myjob['env'])
+			if not os.path.isdir(myjob['dir']):
+				os.makedirs(myjob['dir'])
+			if myjob.has_key('done'):
+				os.system('rm -f '+os.path.join(myjob['dir'], myjob['done']))
+			mylog = open(os.path.join(myjob['dir'], myjob['log']), 'w')
+			myproc = subprocess.Popen(myjob['cmd'], cwd=myjob['dir'], env=myenv, stdout=mylog, stderr=subprocess.STDOUT)
+			myrunning[mynext] = (myproc, mylog, time.time())
+			print "Started job %d in %s (log %s)." % (mynext, myjob['dir'], myjob['log'])
+			mynext += 1
+		time.sleep(5)
+		for j in myrunning.keys():
+			myproc, mylog, mystart = myrunning[j]
+			if myproc.poll() is not None:
+				mylog.close()
+				myexitcodes[j] = myproc.returncode
+				if myexitcodes[j] == 0 and myjobs[j].has_key('done') and not os.path.exists(os.path.join(myjobs[j]['dir'], myjobs[j]['done'])):
+					print "Job %d in %s did not get to the end of its script." % (j, myjobs[j]['dir'])
+					myexitcodes[j] = 1
+				print "Job %d in %s finished with exit code %d after %.1f min." % (j, myjobs[j]['dir'], myexitcodes[j], (time.time()-mystart)/60.0)
+				del myrunning[j]
+				if mydone is not None and myexitcodes[j] == 0:
+					mydone(myjobs[j])
+	return myexitcodes
+
+
+def getcasacmd(myscriptfile):
+	'''command that runs a script with CASA without the GUI'''
+	return casabin.split()+['--nogui','--nologger','--log2term','-c',os.path.abspath(myscriptfile)]
+
+
+def runtargetpool(mysplitfiles,mystages,myworkermem=0):
+	'''take every split target file through the given post-split stages, each target in its own
+	CASA process and working directory so that the self-cal file names do not collide'''
+	myjobs = []
+	for mysplitfile in mysplitfiles:
+		myworkdir = mysplitfile.rstrip('/').replace('.ms','')+'-work'
+		if not os.path.isdir(myworkdir):
+			os.makedirs(myworkdir)
+		if os.path.exists(mysplitfile):
+			os.system('rm -rf '+os.path.join(myworkdir, mysplitfile))
+			os.rename(mysplitfile, os.path.join(myworkdir, mysplitfile))
+		myjobs.append({'cmd': getcasacmd(myscript), 'dir': myworkdir, 'log': 'capture-worker.log', 'done': workerdone,
+			'env': {'CAPTURE_STAGES': ','.join(mystages), 'CAPTURE_SPLITFILE': mysplitfile}})
+	nworkers = getnworkers(len(myjobs), myworkermem)
+	print "Processing %d targets with %d worker processes." % (len(myjobs), nworkers)
+	myexitcodes = runworkers(myjobs, nworkers)
+	for j in range(0,len(myjobs)):
+		if myexitcodes[j] != 0:
+			print "The pipeline on %s failed; see %s." % (mysplitfiles[j], os.path.join(myjobs[j]['dir'], myjobs[j]['log']))
+	return myexitcodes
+
+
+def getsubbandspws(msfile,nsub,mywidth=1):
+	'''channel selections that cut spw 0 into nsub contiguous chunks with edges on multiples of mywidth,
+	so that averaging the chunks by mywidth gives the same channels as averaging the whole band'''
+	nchan = len(freq_info(msfile))
+	nblock = nchan//mywidth
+	myedges = [int(round(k*nblock/float(nsub)))*mywidth for k in range(0,nsub)]+[nchan]
+	return ['0:%d~%d' % (myedges[k], myedges[k+1]-1) for k in range(0,nsub) if myedges[k+1] > myedges[k]]
+
+
+def runsubbands(mysplitfile,nsub,mystages,myworkermem=0):
+	'''cut the split target file into nsub frequency chunks, take every chunk through the given flagging and
+	averaging stages in its own CASA process and join the chunks again into one spw.
+	Returns the name of the joined file (the averaged file when averaging is one of the stages), or '' on failure.
+	The joined file is written under a temporary name and only replaces the file of that name when it is complete,
+	so a failed run leaves the split file as it was; the subband directories are then kept for their logs.'''
+	myenv = {'CAPTURE_STAGES': ','.join(mystages)}
+	if 'dosplitavg' in mystages:
+		mywidth = mywidth2
+		if smearloss > 0.0:
+			mywidth = getsmearavg(mysplitfile,myimsize,mycell,smearloss,smearmaxtime)[0]['chanbin']
+			myenv['CAPTURE_SMEARFREQ'] = str(max(freq_info(mysplitfile)))	# the same time averaging in every subband
+		myoutname = mysplitfile.split('s')[0]+'avg-split.ms'
+	else:
+		mywidth = 1
+		myoutname = mysplitfile
+	myspws = getsubbandspws(mysplitfile,nsub,mywidth)
+	mysplitjobs = []
+	myjobs = []
+	for k in range(0,len(myspws)):
+		myworkdir = mysplitfile.rstrip('/').replace('.ms','')+'-sb'+str(k)
+		os.system('rm -rf '+myworkdir)
+		os.makedirs(myworkdir)
+		open(os.path.join(myworkdir,'subband-split.py'),'w').write("mstransform(vis=%r, outputvis=%r, spw=%r, datacolumn='data')\n" % (os.path.abspath(mysplitfile), mysplitfile, myspws[k]))
+		mysplitjobs.append({'cmd': getcasacmd(os.path.join(myworkdir,'subband-split.py')), 'dir': myworkdir, 'log': 'subband-split.log', 'env': {}})
+		myjobs.append({'cmd': getcasacmd(myscript), 'dir': myworkdir, 'log': 'capture-worker.log', 'done': workerdone,
+			'env': dict(myenv, CAPTURE_SPLITFILE=mysplitfile)})
+	nworkers = getnworkers(len(myjobs), myworkermem)
+	print "Processing %d subbands (%s) with %d worker processes." % (len(myjobs), ', '.join(myspws), nworkers)
+	mytime0 = time.time()
+	myexitcodes = runworkers(mysplitjobs, nworkers)
+	for j in range(0,len(myjobs)):
+		if myexitcodes[j] == 0 and not os.path.isdir(os.path.join(myjobs[j]['dir'], mysplitfile)):
+			myexitcodes[j] = 1	# casa -c exits with 0 even when mstransform raised
+	mytime1 = time.time()
+	if max(myexitcodes) == 0:
+		myexitcodes = runworkers(myjobs, nworkers)
+	mytime2 = time.time()
+	myparts = [os.path.join(myjob['dir'], myoutname) for myjob in myjobs]
+	for j in range(0,len(myjobs)):
+		if myexitcodes[j] == 0 and not os.path.isdir(myparts[j]):
+			myexitcodes[j] = 1
+	if max(myexitcodes) != 0:
+		for j in range(0,len(myjobs)):
+			if myexitcodes[j] != 0:
+				print "Subband %s failed; see the logs in %s." % (myspws[j], myjobs[j]['dir'])
+		return ''
+	os.system('rm -rf '+myoutname+'.concat '+myoutname+'.joined')
+	default(virtualconcat)
+	virtualconcat(vis=myparts, concatvis=myoutname+'.concat', keepcopy=False)
+	default(mstransform)
+	mstransform(vis=myoutname+'.concat', outputvis=myoutname+'.joined', combinespws=True, datacolumn='data')
+	os.system('rm -rf '+myoutname+'.concat')
+	if not os.path.isdir(myoutname+'.joined'):
+		print "Joining the subbands into %s failed; the subband directories are kept." % (myoutname)
+		return ''
+	os.system('rm -rf '+myoutname)
+	os.rename(myoutname+'.joined', myoutname)
+	for myjob in myjobs:
+		os.system('rm -rf '+myjob['dir'])
+	print "Subbands took %.1f min to cut, %.1f min to flag and average and %.1f min to join." % ((mytime1-mytime0)/60.0, (mytime2-mytime1)/60.0, (time.time()-mytime2)/60.0)
+	return myoutname
+
+
+def getscantimes(myline):
+	'''start and end in seconds of the day, and the duration in seconds, from the first and last hh:mm:ss
+	times on a listscan scan line; None when the line has fewer than two times'''
+	mytimes = re.findall(r'(\d+):(\d\d):(\d\d(?:\.\d*)?)', myline)
+	if len(mytimes) < 2:
+		return None, None, None
+	mystart = int(mytimes[0][0])*3600.0+int(mytimes[0][1])*60.0+float(mytimes[0][2])
+	myend = int(mytimes[-1][0])*3600.0+int(mytimes[-1][1])*60.0+float(mytimes[-1][2])
+	myduration = myend-mystart
+	if myduration < 0:
+		myduration += 86400.0	# the scan runs over midnight
+	return mystart, myend, myduration
+
+
+def readltalog(mylogfile):
+	'''lines of a listscan log: the header lines and the scan lines. A scan is a dictionary with its line,
+	scan number, source, start, end and duration; scans switched off by a leading * have 'use' False.'''
+	myheader = []
+	myscans = []
+	for myline in open(mylogfile):
+		mymatch = re.match(r'^(\*?)\s*scan\s+(\d+)\s+(\S+)', myline, re.IGNORECASE)
+		if mymatch is None:
+			myheader.append(myline)
+		else:
+			mystart, myend, myduration = getscantimes(myline)
+			myscans.append({'line': myline.lstrip('*'), 'scan': int(mymatch.group(2)), 'source': mymatch.group(3), 'use': mymatch.group(1) == '',
+				'start': mystart, 'end': myend, 'duration': myduration})
+	return myheader, myscans
+
+
+def writeltalog(mylogfile,myheader,myscans,mykeys={}):
+	'''write a listscan log for gvfits; header keys in mykeys (e.g. FITS) get new values and scans with
+	'use' False are commented out with *'''
+	myout = open(mylogfile,'w')
+	for myline in myheader:
+		mywords = myline.split()
+		if mywords != [] and mykeys.has_key(mywords[0]):
+			myline = mywords[0]+'\t'+mykeys[mywords[0]]+'\n'
+		myout.write(myline)
+	for myscan in myscans:
+		if myscan['use'] == True:
+			myout.write(myscan['line'])
+		else:
+			myout.write('*'+myscan['line'])
+	myout.close()
+
+
+def editltalog(mylogfile,mysources=[],mydropsources=[],mymindur=0.0):
+	'''switch off the scans of a listscan log that are not on mysources (when given), are on mydropsources or
+	are shorter than mymindur seconds, and write the log back so that gvfits converts only the scans left.
+	The original log is kept as <log>.orig. Returns the number of scans switched off.'''
+	myheader, myscans = readltalog(mylogfile)
+	ndropped = 0
+	mydroptime = 0.0
+	for myscan in myscans:
+		if myscan['use'] == False:
+			continue
+		if (mysources != [] and myscan['source'] not in mysources) or myscan['source'] in mydropsources or \
+				(myscan['duration'] is not None and myscan['duration'] < mymindur):
+			myscan['use'] = False
+			ndropped += 1
+			if myscan['duration'] is not None:
+				mydroptime += myscan['duration']
+			print "Dropping scan %d on %s." % (myscan['scan'], myscan['source'])
+	if ndropped > 0:
+		if not os.path.exists(mylogfile+'.orig'):
+			os.system('cp '+mylogfile+' '+mylogfile+'.orig')
+		writeltalog(mylogfile, myheader, myscans)
+	print "%d of %d scans (%.1f min) will not be converted." % (ndropped, len(myscans), mydroptime/60.0)
+	return ndropped
+
+
+def runconverter(mycmd,mylog=''):
+	'''run an external program such as listscan or gvfits, print its run time and return its exit code'''
+	mytime0 = time.time()
+	if mylog == '':
+		myexitcode = subprocess.call(mycmd)
+	else:
+		myout = open(mylog,'w')
+		myexitcode = subprocess.call(mycmd, stdout=myout, stderr=subprocess.STDOUT)
+		myout.close()
+	print "%s finished with exit code %d after %.1f min." % (' '.join(mycmd), myexitcode, (time.time()-mytime0)/60.0)
+	return myexitcode
+
+
+def myimportpart(myjob):
+	'''import the FITS file of a finished gvfits job and remove the FITS file'''
+	mytime0 = time.time()
+	os.system('rm -rf '+myjob['vis'])
+	default(importgmrt)
+	importgmrt(fitsfile=myjob['fits'], vis=myjob['vis'])
+	os.system('rm -f '+myjob['fits'])
+	print "Imported %s in %.1f min." % (myjob['vis'], (time.time()-mytime0)/60.0)
+
+
+def runltachunks(mylogfile,nchunks,myoutvis):
+	'''convert the scans of a listscan log in nchunks parts with parallel gvfits processes, import every part as
+	soon as its FITS file is written and join the parts into myoutvis. Returns True when all parts worked.
+	gvfits writes its log and scratch files in the working directory, so every part runs in a directory of its
+	own (<log>-part<k>); the gvfits logs of the parts are joined into <log>-gvfits.log at the end.'''
+	myheader, myscans = readltalog(mylogfile)
+	myused = [j for j in range(0,len(myscans)) if myscans[j]['use'] == True]
+	nchunks = max(1, min(nchunks, len(myused)))
+	mybase = mylogfile.rsplit('.',1)[0]
+	mykeys = {}
+	for myline in myheader:	# files named in the header, such as the lta file, as seen from the part directories
+		mywords = myline.split()
+		if len(mywords) > 1 and not os.path.isabs(mywords[1]) and os.path.exists(mywords[1]):
+			mykeys[mywords[0]] = os.path.abspath(mywords[1])
+	mygvfits = gvbinpath[1]
+	if os.path.exists(mygvfits):
+		mygvfits = os.path.abspath(mygvfits)
+	myjobs = []
+	for k in range(0,nchunks):
+		mypart = set(myused[len(myused)*k/nchunks:len(myused)*(k+1)/nchunks])
+		mypartscans = [dict(myscans[j], use=(j in mypart)) for j in range(0,len(myscans))]
+		mypartdir = os.path.abspath(mybase+'-part'+str(k))
+		os.system('rm -rf '+mypartdir)
+		os.makedirs(mypartdir)
+		myfits = os.path.join(mypartdir, os.path.basename(mybase)+'-part'+str(k)+'.FITS')
+		writeltalog(os.path.join(mypartdir, 'part.log'), myheader, mypartscans, dict(mykeys, FITS=myfits))
+		myjobs.append({'cmd': [mygvfits, 'part.log'], 'dir': mypartdir, 'log': 'gvfits.out', 'env': {},
+			'fits': myfits, 'vis': mybase+'-part'+str(k)+'.ms'})
+	mytime0 = time.time()
+	myexitcodes = runworkers(myjobs, getnworkers(len(myjobs), 0), myimportpart)
+	if max(myexitcodes) != 0:
+		for j in range(0,len(myjobs)):
+			if myexitcodes[j] != 0:
+				print "gvfits failed on part %d; see %s." % (j, os.path.join(myjobs[j]['dir'], myjobs[j]['log']))
+		return False
+	os.system('rm -rf '+myoutvis)
+	default(virtualconcat)
+	virtualconcat(vis=[myjob['vis'] for myjob in myjobs], concatvis=myoutvis, keepcopy=False)
+	myout = open(mybase+'-gvfits.log','w')
+	for j in range(0,len(myjobs)):
+		for myname in sorted(os.listdir(myjobs[j]['dir'])):
+			if myname.endswith('.log') or myname.endswith('.out'):
+				myout.write('######## part %d: %s\n' % (j, myname))
+				myout.write(open(os.path.join(myjobs[j]['dir'], myname)).read())
+		os.system('rm -rf '+myjobs[j]['dir'])
+	myout.close()
+	print "Converted and imported %d parts of the lta file in %.1f min; the gvfits logs are in %s." % (len(myjobs),
+		(time.time()-mytime0)/60.0, mybase+'-gvfits.log')
+	return True
+
+
 #############End of functions##############################################################################
 print "#######################################################################################"
 print "You are using CAPTURE: CAsa Pipeline-cum-Toolkit for Upgraded GMRT data REduction."
 print "This has been developed at NCRA by Ruta Kale and Ishwara Chandra."
 print "#######################################################################################"
 
-if fromlta == True:
-	os.system(gvbinpath[0]+' '+ltafile)
-	os.system(gvbinpath[1]+' '+ltafile.split('.')[0]+'.log')
+if runreport != '':
+	startprofiling()
+
+if mystagetorun('fromlta', fromlta, {'ltafile': ltafile, 'mtime': getmtime(ltafile), 'chunks': ltachunks,
+		'sources': ltasources, 'dropsources': ltadropsources, 'minscan': ltaminscan}):
+	mylistlog = ltafile.split('.')[0]+'.log'
+	if runconverter([gvbinpath[0], ltafile]) != 0:	# stop here: fromraw would import a missing or stale file
+		raise RuntimeError("listscan failed on "+ltafile)
+	editltalog(mylistlog,ltasources,ltadropsources,ltaminscan)
+	if ltachunks > 1:
+		if runltachunks(mylistlog,ltachunks,myfile1) == False:
+			raise RuntimeError("gvfits failed on parts of "+mylistlog)
+		mystagedone('fromlta', {}, [myfile1])
+	else:
+		if runconverter([gvbinpath[1], mylistlog]) != 0:
+			raise RuntimeError("gvfits failed on "+mylistlog)
+		mystagedone('fromlta', {}, [rawfile])
 
 # Step 0. Importgmrt  - will also create a .list file 
-if fromraw == True:
-	myfitsfile = rawfile
-	myoutvis = myfile1
-	default(importgmrt)
-	importgmrt(fitsfile=myfitsfile, vis = myoutvis)
+if mystagetorun('fromraw', fromraw, {'rawfile': rawfile, 'mtime': getmtime(rawfile), 'vis': myfile1}):
+	if fromlta == True and ltachunks > 1:
+		print "The lta file was imported in parts into "+myfile1
+	else:
+		myfitsfile = rawfile
+		myoutvis = myfile1
+		default(importgmrt)
+		importgmrt(fitsfile=myfitsfile, vis = myoutvis)
 	# create a dummy flagdata table
 	os.system("rm -rf dummy-flg.dat")
 	default(flagdata)
@@ -525,67 +2810,19 @@ if fromraw == True:
 		action='apply',	savepars=True,	cmdreason='dummy', flagbackup=False, outfile='dummy-flg.dat')
 	vislistobs(myfile1)
 	print "You have the following fields in your file:",getfields(myfile1)
+	mystagedone('fromraw', {}, [myfile1])
 
 ############################################3
 
 if fromms == True:
 	mynchan = getnchan(myfile1)
 	print "The number of channels in your file:", mynchan
-	if mynchan == 1024:
-		mygoodchans = '0:250~300'   # used for visstat
-		flagspw = '0:51~950'
-		gainspw = '0:101~900'
-		gainspw2 = ''   # central good channels after split file for self-cal	
-	elif mynchan == 2048:
-		mygoodchans = '0:500~600'   # used for visstat
-		flagspw = '0:101~1900'
-		gainspw = '0:201~1800'
-		gainspw2 = ''   # central good channels after split file for self-cal
-	elif mynchan == 4096:
-		mygoodchans = '0:1000~1200'
-		flagspw = '0:41~4050'
-		gainspw = '0:201~3600'
-		gainspw2 = ''   # central good channels after split file for self-cal
-	elif mynchan == 8192:
-		mygoodchans = '0:2000~3000'
-		flagspw = '0:500~7800'
-		gainspw = '0:1000~7000'
-		gainspw2 = ''   # central good channels after split file for self-cal
-	elif mynchan == 16384:
-		mygoodchans = '0:4000~6000'
-		flagspw = '0:1000~14500'
-		gainspw = '0:2000~13500'
-		gainspw2 = ''   # central good channels after split file for self-cal
-	elif mynchan == 128:
-		mygoodchans = '0:50~70'
-		flagspw = '0:5~115'
-		gainspw = '0:11~115'
-		gainspw2 = ''   # central good channels after split file for self-cal
-	elif mynchan == 256:
-		mygoodchans = '0:100~120'
-		flagspw = '0:11~240'
-		gainspw = '0:21~230'
-		gainspw2 = ''   # central good channels after split file for self-cal	
-	elif mynchan == 512:
-		mygoodchans = '0:200~240'
-		flagspw = '0:21~480'
-		gainspw = '0:41~460'
-		gainspw2 = ''   # central good channels after split file for self-cal	
+	mygoodchans, flagspw, gainspw = getchantable(mynchan)	# visstat, flagging and gaincal windows until the calibrator scans are known
+	gainspw2 = ''   # central good channels after split file for self-cal
 
 # fix targets
 	myfields = getfields(myfile1)
-	stdcals = ['3C48','3C147','3C286','0542+498','1331+305','0137+331']
-	vlacals = np.loadtxt('./vla-cals.list',dtype='string')
-	myampcals =[]
-	mypcals=[]
-	mytargets=[]
-	for i in range(0,len(myfields)):
-		if myfields[i] in stdcals:
-			myampcals.append(myfields[i])
-		elif myfields[i] in vlacals:
-			mypcals.append(myfields[i])
-		else:
-			mytargets.append(myfields[i])
+	myampcals, mypcals, mytargets = getfieldtypes(myfile1,'./vla-cals.list',calpostol)
 	mybpcals = myampcals
 ##################################
 #	if mypcals==[]:
@@ -615,6 +2852,8 @@ if fromms == True:
 	print pcalscans	
 	print tgtscans
 	allscanlist= ampcalscans+pcalscans+tgtscans
+	if autochanwin == True:
+		mygoodchans, flagspw, gainspw = getchanwindows(myfile1,ampcalscans[0:1]+pcalscans[0:1])
 ###################################
 # get a list of antennas
 	antsused = getantlist(myfile1,int(allscanlist[0]))
@@ -623,10 +2862,9 @@ if fromms == True:
 # find band ants
 	if flagbadants==True:
 		findbadants = True
-	if findbadants == True:
+	if mystagetorun('badants', findbadants, {'vis': myfile1, 'chans': mygoodchans, 'scans': allscanlist, 'flag': flagbadants}):
 		myantlist = antsused
 #['C00', 'C01', 'C02', 'C03', 'C04', 'C05', 'C06', 'C08', 'C09', 'C10', 'C11', 'C12', 'C13', 'C14', 'E02', 'E03', 'E04', 'E05', 'E06', 'S01', 'S02', 'S03', 'S04', 'S06', 'W01', 'W02', 'W03', 'W04', 'W05', 'W06']
-		mycmds = []
 		meancutoff = 0.4    # uncalibrated mean cutoff
 		mycorr1='rr'
 		mycorr2='ll'
@@ -634,116 +2872,75 @@ if fromms == True:
 		mycalscans = ampcalscans+pcalscans
 		print mycalscans
 #		myscan1 = pcalscans
-		allbadants=[]
-		for j in range(0,len(mycalscans)):
-			myantmeans = []
-			badantlist = []
-			for i in range(0,len(myantlist)):
-				oneantmean1 = myvisstatampraw(myfile1,mygoodchans,myantlist[i],mycorr1,str(mycalscans[j]))
-				oneantmean2 = myvisstatampraw(myfile1,mygoodchans,myantlist[i],mycorr2,str(mycalscans[j]))
-				oneantmean = min(oneantmean1,oneantmean2)
-				myantmeans.append(oneantmean)
-#				print myantlist[i], oneantmean1, oneantmean2
-				if oneantmean < meancutoff:
-					badantlist.append(myantlist[i])
-					allbadants.append(myantlist[i])
-			print "The following antennas are bad for the given scan numbers."
-			print badantlist, str(mycalscans[j])
-			if badantlist!=[]:
-				myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]))
-				mycmds.append(myflgcmd)
-				print myflgcmd
-				onelessscan = mycalscans[j] - 1
-				onemorescan = mycalscans[j] + 1
-				if onelessscan in tgtscans:
-					myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]-1))
-					mycmds.append(myflgcmd)
-					print myflgcmd
-				if onemorescan in tgtscans:
-					myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]+1))
-					mycmds.append(myflgcmd)
-					print myflgcmd
+		mycmds, allbadants = getbadants(myfile1,mygoodchans1,myantlist,mycalscans,tgtscans,meancutoff,[mycorr1,mycorr2])
 # execute the flagging commands accumulated in cmds
 		print mycmds
 		if flagbadants==True:
 			print "Now flagging the bad antennas."
 			default(flagdata)
-			flagdata(vis=myfile1,mode='list', inpfile=mycmds)	
+			flagdata(vis=myfile1,mode='list', inpfile=mycmds, flagbackup=False)	
+		mystagedone('badants', {'cmds': mycmds}, [myfile1])
 ######### Bad channel flagging for known persistent RFI.
 	if flagbadfreq==True:
 		findbadchans = True
-	if findbadchans ==True:
+	if mystagetorun('badchans', findbadchans, {'vis': myfile1, 'rfitable': rfitable, 'flag': flagbadfreq}):
 		rfifreqall =[0.36E09,0.3796E09,0.486E09,0.49355E09,0.8808E09,0.885596E09,0.7646E09,0.769092E09] # always bad
-		myfreqs =  freq_info(myfile1)
-		mybadchans=[]
-		for j in range(0,len(rfifreqall)-1,2):
-#			print rfifreqall[j]
-			for i in range(0,len(myfreqs)):
-				if (myfreqs[i] > rfifreqall[j] and myfreqs[i] < rfifreqall[j+1]): #(myfreqs[i] > 0.486E09 and myfreqs[i] < 0.49355E09):
-					mybadchans.append('0:'+str(i))
-		mychanflag = str(', '.join(mybadchans))
+		mychanflag = getrfiflagspw(myfile1,rfifreqall,rfitable)
 #		print mychanflag
-		if mybadchans!=[]:
-#			print mychanflag
+		if mychanflag!='':
 			myflgcmd = ["mode='manual' spw='%s'" % (mychanflag)]
 			if flagbadfreq==True:
 				default(flagdata)
-				flagdata(vis=myfile1,mode='list', inpfile=myflgcmd)
+				flagdata(vis=myfile1,mode='list', inpfile=myflgcmd, flagbackup=False)
 		else:
 			print "No bad frequencies found in the range."
+		mystagedone('badchans', {}, [myfile1])
 
 ############ Initial flagging ################
 
-if myflaginit == True:
+if mystagetorun('flaginit', myflaginit, lambda: {'vis': myfile1, 'quack': myquackinterval, 'clipfluxcal': clipfluxcal, 'clipphasecal': clipphasecal,
+		'cliptarget': cliptarget, 'flagspw': flagspw, 'fields': [myampcals, mypcals, mytargets]}):
 	casalog.filter('INFO')
+	myflagplan = []
 #Step 1 : Flag the first channel.
-	default(flagdata)
-	flagdata(vis=myfile1, mode='manual', field='', spw='0:0', antenna='', correlation='', action='apply', savepars=True,
-		cmdreason='badchan', outfile='flg1.dat')
+	myflagplan.append(myflagcmd('manual', spw='0:0', reason='badchan'))
 #Step 3: Do a quack step 
-	default(flagdata)
-	flagdata(vis=myfile1, mode='quack', field='', spw='0', antenna='', correlation='', timerange='',
-		quackinterval=myquackinterval, quackmode='beg', action='apply', savepars=True, cmdreason='quackbeg',
-	        outfile='flg3.dat')
-	default(flagdata)
-	flagdata(vis=myfile1, mode='quack', field='', spw='0', antenna='', correlation='', timerange='', quackinterval=myquackinterval,
-		quackmode='endb', action='apply', savepars=True, cmdreason='quackendb', outfile='flg3.dat')
+	myflagplan.append(myflagcmd('quack', spw='0', quackinterval=myquackinterval, quackmode='beg', reason='quackbeg'))
+	myflagplan.append(myflagcmd('quack', spw='0', quackinterval=myquackinterval, quackmode='endb', reason='quackendb'))
 # Clip at high amp levels
 	if myampcals !=[]:
-		default(flagdata)
-		flagdata(vis=myfile1,mode="clip", spw=flagspw,field=str(','.join(myampcals)), clipminmax=clipfluxcal, datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        		action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('clip', spw=flagspw, field=str(','.join(myampcals)), clipminmax=clipfluxcal, datacolumn='DATA',
+			clipoutside=True, clipzeros=True, extendpols=False))
 	if mypcals !=[]:
-		default(flagdata)
-		flagdata(vis=myfile1,mode="clip", spw=flagspw,field=str(','.join(mypcals)), clipminmax=clipphasecal, datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        		action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('clip', spw=flagspw, field=str(','.join(mypcals)), clipminmax=clipphasecal, datacolumn='DATA',
+			clipoutside=True, clipzeros=True, extendpols=False))
 # After clip, now flag using 'tfcrop' option for flux and phase cal tight flagging
-		flagdata(vis=myfile1,mode="tfcrop", datacolumn="DATA", field=str(','.join(mypcals)), ntime="scan",
-		        timecutoff=5.0, freqcutoff=5.0, timefit="line",freqfit="line",flagdimension="freqtime", 
-		        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-		        action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('tfcrop', datacolumn='DATA', field=str(','.join(mypcals)), ntime='scan',
+			timecutoff=5.0, freqcutoff=5.0, timefit='line', freqfit='line', flagdimension='freqtime',
+			extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False))
 # Now extend the flags (80% more means full flag, change if required)
-		flagdata(vis=myfile1,mode="extend",spw=flagspw,field=str(','.join(mypcals)),datacolumn="DATA",clipzeros=True,
-		         ntime="scan", extendflags=False, extendpols=True,growtime=80.0, growfreq=80.0,growaround=False,
-		         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('extend', spw=flagspw, field=str(','.join(mypcals)), datacolumn='DATA', clipzeros=True,
+			ntime='scan', extendflags=False, extendpols=True, growtime=80.0, growfreq=80.0, growaround=False,
+			flagneartime=False, flagnearfreq=False))
 ######### target flagging ### clip first
 	if target == True:
 		if mytargets !=[]:
-			flagdata(vis=myfile1,mode="clip", spw=flagspw,field=str(','.join(mytargets)), clipminmax=cliptarget, datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-		        	action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+			myflagplan.append(myflagcmd('clip', spw=flagspw, field=str(','.join(mytargets)), clipminmax=cliptarget, datacolumn='DATA',
+				clipoutside=True, clipzeros=True, extendpols=False))
 # flagging with tfcrop before calibration
-			default(flagdata)
-			flagdata(vis=myfile1,mode="tfcrop", datacolumn="DATA", field=str(','.join(mytargets)), ntime="scan",
-		        	timecutoff=6.0, freqcutoff=6.0, timefit="poly",freqfit="poly",flagdimension="freqtime", 
-		        	extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-		        	action="apply", flagbackup=True,overwrite=True, writeflags=True)
+			myflagplan.append(myflagcmd('tfcrop', datacolumn='DATA', field=str(','.join(mytargets)), ntime='scan',
+				timecutoff=6.0, freqcutoff=6.0, timefit='poly', freqfit='poly', flagdimension='freqtime',
+				extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False))
 # Now extend the flags (80% more means full flag, change if required)
-			flagdata(vis=myfile1,mode="extend",spw=flagspw,field=str(','.join(mytargets)),datacolumn="DATA",clipzeros=True,
-		        	 ntime="scan", extendflags=False, extendpols=True,growtime=80.0, growfreq=80.0,growaround=False,
-		        	 flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
+			myflagplan.append(myflagcmd('extend', spw=flagspw, field=str(','.join(mytargets)), datacolumn='DATA', clipzeros=True,
+				ntime='scan', extendflags=False, extendpols=True, growtime=80.0, growfreq=80.0, growaround=False,
+				flagneartime=False, flagnearfreq=False))
+	runflagplan(myfile1, myflagplan, 'flaginit')
 # Now summary
-		flagdata(vis=myfile1,mode="summary",datacolumn="DATA", extendflags=True, 
-	        	 name=vis+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)	
+	flagdata(vis=myfile1,mode="summary",datacolumn="DATA", extendflags=True, 
+			 name=vis+'summary.split', action="apply", flagbackup=False,overwrite=True, writeflags=True)	
+	mysaveflags(myfile1,'flaginit')
+	mystagedone('flaginit', {}, [myfile1])
 #####################################################################
 #if doinitcal==True:
 #	print "After initial flagging:"
@@ -751,82 +2948,15 @@ if myflaginit == True:
 #	print 'myflagtabs=',myflagtabs
 
 # Calibration begins.
-if doinitcal == True:
-	mycalsuffix = ''
+if mystagetorun('initcal', doinitcal, lambda: {'vis': myfile1, 'refant': myrefant, 'flagspw': flagspw, 'gainspw': gainspw, 'uvrange': uvracal,
+		'fields': [myampcals, mypcals, mytargets]}):
 	casalog.filter('INFO')
 #	print "Summary of flagtables before initial calibration:"
 #	myflagtabs = flagmanager(vis = myfile1, mode ='list')
 #	print 'myflagtabs=',myflagtabs
-	clearcal(vis=myfile1)
-#delmod step to keep model column free of spurious values
-	for i in range(0,len(myampcals)):
-#		delmod(vis=myfile1)	
-		default(setjy)
-		setjy(vis=myfile1, spw=flagspw, field=myampcals[i])
-		print "Done setjy on %s"%(myampcals[i])
-# Delay calibration  using the first flux calibrator in the list - should depend on which is less flagged
-	os.system('rm -rf '+str(myfile1)+'.K1'+mycalsuffix)
-	gaincal(vis=myfile1, caltable=str(myfile1)+'.K1'+mycalsuffix, spw =flagspw, field=myampcals[0], 
-		solint='60s', refant=myrefant,	solnorm= True, gaintype='K', gaintable=[], parang=True)
-	kcorrfield =myampcals[0]
-#	print 'wrote table',str(myfile1)+'.K1'
-# an initial bandpass
-	os.system('rm -rf '+str(myfile1)+'.AP.G0'+mycalsuffix)
-	default(gaincal)
-#	gaincal(vis=myfile1, caltable=str(myfile1)+'.AP.G0', append=True, field=str(','.join(mybpcals)), 
-#		spw =flagspw, solint = 'int', refant = myrefant, minsnr = 2.0, solmode ='L1R', gaintype = 'G', calmode = 'ap', gaintable = [str(myfile1)+'.K1'],
-#		interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
-	gaincal(vis=myfile1, caltable=str(myfile1)+'.AP.G0'+mycalsuffix, append=True, field=str(','.join(mybpcals)), 
-		spw =flagspw, solint = 'int', refant = myrefant, minsnr = 2.0, gaintype = 'G', calmode = 'ap', gaintable = [str(myfile1)+'.K1'+mycalsuffix],
-		interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
-	os.system('rm -rf '+str(myfile1)+'.B1'+mycalsuffix)
-	default(bandpass)
-	bandpass(vis=myfile1, caltable=str(myfile1)+'.B1'+mycalsuffix, spw =flagspw, field=str(','.join(mybpcals)), solint='inf', refant=myrefant, solnorm = True,
-		minsnr=2.0, fillgaps=8, parang = True, gaintable=[str(myfile1)+'.K1'+mycalsuffix,str(myfile1)+'.AP.G0'+mycalsuffix], interp=['nearest,nearestflag','nearest,nearestflag'])
-# do a gaincal on all calibrators
-	mycals=myampcals+mypcals
-	i=0
-	os.system('rm -rf '+str(myfile1)+'.AP.G.'+mycalsuffix)
-	for i in range(0,len(mycals)):
-		mygaincal_ap2(myfile1,mycals[i],myrefant,gainspw,uvracal,mycalsuffix)
-# Get flux scale
-	os.system('rm -rf '+str(myfile1)+'.fluxscale'+mycalsuffix)
-######################################
-	if mypcals !=[]:
-		if '3C286' in myampcals:
-			myfluxscale= getfluxcal2(myfile1,'3C286',str(', '.join(mypcals)),mycalsuffix)
-			myfluxscaleref = '3C286'
-		elif '3C147' in myampcals:
-			myfluxscale= getfluxcal2(myfile1,'3C147',str(', '.join(mypcals)),mycalsuffix)
-			myfluxscaleref = '3C147'
-		else:
-			myfluxscale= getfluxcal2(myfile1,myampcals[0],str(', '.join(mypcals)),mycalsuffix)
-			myfluxscaleref = myampcals[0]
-		print myfluxscale
-		mygaintables =[str(myfile1)+'.fluxscale'+mycalsuffix,str(myfile1)+'.K1'+mycalsuffix, str(myfile1)+'.B1'+mycalsuffix]
-	else:
-		mygaintables =[str(myfile1)+'.AP.G.'+mycalsuffix,str(myfile1)+'.K1'+mycalsuffix, str(myfile1)+'.B1'+mycalsuffix]
-##############################
-	for i in range(0,len(myampcals)):
-		default(applycal)
-		applycal(vis=myfile1, field=myampcals[i], spw = flagspw, gaintable=mygaintables, gainfield=[myampcals[i],'',''], 
-        		 interp=['nearest','',''], calwt=[False], parang=False)
-#For phase calibrator:
-	if mypcals !=[]:
-		default(applycal)
-		applycal(vis=myfile1, field=str(', '.join(mypcals)), spw = flagspw, gaintable=mygaintables, gainfield=str(', '.join(mypcals)), 
-		         interp=['nearest','','nearest'], calwt=[False], parang=False)
-#For the target:
-	if target ==True:
-		if mypcals !=[]:
-			default(applycal)
-			applycal(vis=myfile1, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-		        	 gainfield=[str(', '.join(mypcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
-		else:
-			default(applycal)
-			applycal(vis=myfile1, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-		        	 gainfield=[str(', '.join(myampcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)	
+	mygaintables = mycalibrate(myfile1,myampcals,mypcals,mytargets,myrefant,flagspw,gainspw,uvracal,'')
 	print "Finished initial calibration."
+	mystagedone('initcal', {'gaintables': mygaintables}, [myfile1]+mygaintables)
 #	print "Summary of flagtables after initial calibration:"
 #	myflagtabs = flagmanager(vis = myfile1, mode ='list')
 #	print 'myflagtabs=',myflagtabs
@@ -840,146 +2970,77 @@ if doinitcal == True:
 
 
 #######Ishwar post calibration flagging
-if mydoflag == True:
+if mystagetorun('doflag', mydoflag, lambda: {'vis': myfile1, 'clipfluxcal': clipfluxcal, 'clipphasecal': clipphasecal, 'cliptarget': cliptarget,
+		'flagspw': flagspw, 'fields': [myampcals, mypcals, mytargets]}):
 	print "You have chosen to flag after the initial calibration."
-	default(flagdata)
+	myflagplan = []
 	if myampcals !=[]:
-		flagdata(vis=myfile1,mode="clip", spw=flagspw,field=str(', '.join(myampcals)), clipminmax=clipfluxcal,
-        		datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        		action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('clip', spw=flagspw, field=str(', '.join(myampcals)), clipminmax=clipfluxcal,
+			datacolumn='corrected', clipoutside=True, clipzeros=True, extendpols=False))
 	if mypcals !=[]:
-		flagdata(vis=myfile1,mode="clip", spw=flagspw,field=str(', '.join(mypcals)), clipminmax=clipphasecal,
-        		datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        		action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('clip', spw=flagspw, field=str(', '.join(mypcals)), clipminmax=clipphasecal,
+			datacolumn='corrected', clipoutside=True, clipzeros=True, extendpols=False))
 # After clip, now flag using 'tfcrop' option for flux and phase cal tight flagging
-		flagdata(vis=myfile1,mode="tfcrop", datacolumn="corrected", field=str(', '.join(mypcals)), ntime="scan",
-        		timecutoff=6.0, freqcutoff=5.0, timefit="line",freqfit="line",flagdimension="freqtime", 
-        		extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-        		action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('tfcrop', datacolumn='corrected', field=str(', '.join(mypcals)), ntime='scan',
+			timecutoff=6.0, freqcutoff=5.0, timefit='line', freqfit='line', flagdimension='freqtime',
+			extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False))
 # now flag using 'rflag' option  for flux and phase cal tight flagging
-		flagdata(vis=myfile1,mode="rflag",datacolumn="corrected",field=str(', '.join(mypcals)), timecutoff=5.0, 
-		        freqcutoff=5.0,timefit="poly",freqfit="line",flagdimension="freqtime", extendflags=False,
-		        timedevscale=4.0,freqdevscale=4.0,spectralmax=500.0,extendpols=False, growaround=False,
-		        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('rflag', datacolumn='corrected', field=str(', '.join(mypcals)), timecutoff=5.0,
+			freqcutoff=5.0, timefit='poly', freqfit='line', flagdimension='freqtime', extendflags=False,
+			timedevscale=4.0, freqdevscale=4.0, spectralmax=500.0, extendpols=False, growaround=False,
+			flagneartime=False, flagnearfreq=False))
 # Now extend the flags (70% more means full flag, change if required)
-		flagdata(vis=myfile1,mode="extend",spw=flagspw,field=str(', '.join(mypcals)),datacolumn="corrected",clipzeros=True,
-		         ntime="scan", extendflags=False, extendpols=False,growtime=90.0, growfreq=90.0,growaround=False,
-		         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('extend', spw=flagspw, field=str(', '.join(mypcals)), datacolumn='corrected', clipzeros=True,
+			ntime='scan', extendflags=False, extendpols=False, growtime=90.0, growfreq=90.0, growaround=False,
+			flagneartime=False, flagnearfreq=False))
 # Now flag for target - moderate flagging, more flagging in self-cal cycles
 	if mytargets !=[]:
-		flagdata(vis=myfile1,mode="clip", spw=flagspw,field=str(', '.join(mytargets)), clipminmax=cliptarget,
-		        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-		        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+		myflagplan.append(myflagcmd('clip', spw=flagspw, field=str(', '.join(mytargets)), clipminmax=cliptarget,
+			datacolumn='corrected', clipoutside=True, clipzeros=True, extendpols=False))
 # C-C baselines are selected
 		a, b = getbllists(myfile1)
-		flagdata(vis=myfile1,mode="tfcrop", datacolumn="corrected", field=str(', '.join(mytargets)), antenna=a[0],
-			ntime="scan", timecutoff=8.0, freqcutoff=8.0, timefit="poly",freqfit="line",flagdimension="freqtime", 
-		        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-		        action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		for mysel in a:
+			myflagplan.append(myflagcmd('tfcrop', datacolumn='corrected', field=str(', '.join(mytargets)),
+				ntime='scan', timecutoff=8.0, freqcutoff=8.0, timefit='poly', freqfit='line', flagdimension='freqtime',
+				extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False, **mysel))
 # C- arm antennas and arm-arm baselines are selected.
-		flagdata(vis=myfile1,mode="tfcrop", datacolumn="corrected", field=str(', '.join(mytargets)), antenna=b[0],
-			ntime="scan", timecutoff=6.0, freqcutoff=5.0, timefit="poly",freqfit="line",flagdimension="freqtime", 
-        		extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-        		action="apply", flagbackup=True,overwrite=True, writeflags=True)
+		for mysel in b:
+			myflagplan.append(myflagcmd('tfcrop', datacolumn='corrected', field=str(', '.join(mytargets)),
+				ntime='scan', timecutoff=6.0, freqcutoff=5.0, timefit='poly', freqfit='line', flagdimension='freqtime',
+				extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False, **mysel))
 # now flag using 'rflag' option
 # C-C baselines are selected
-		flagdata(vis=myfile1,mode="rflag",datacolumn="corrected",field=str(', '.join(mytargets)), timecutoff=5.0, antenna=a[0],
-        		freqcutoff=8.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
-        		timedevscale=8.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
-        		flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
+		for mysel in a:
+			myflagplan.append(myflagcmd('rflag', datacolumn='corrected', field=str(', '.join(mytargets)), timecutoff=5.0,
+				freqcutoff=8.0, timefit='poly', freqfit='poly', flagdimension='freqtime', extendflags=False,
+				timedevscale=8.0, freqdevscale=5.0, spectralmax=500.0, extendpols=False, growaround=False,
+				flagneartime=False, flagnearfreq=False, **mysel))
 # C- arm antennas and arm-arm baselines are selected.
-		flagdata(vis=myfile1,mode="rflag",datacolumn="corrected",field=str(', '.join(mytargets)), timecutoff=5.0, antenna=b[0],
-        		freqcutoff=5.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
-        		timedevscale=5.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
-        		flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
+		for mysel in b:
+			myflagplan.append(myflagcmd('rflag', datacolumn='corrected', field=str(', '.join(mytargets)), timecutoff=5.0,
+				freqcutoff=5.0, timefit='poly', freqfit='poly', flagdimension='freqtime', extendflags=False,
+				timedevscale=5.0, freqdevscale=5.0, spectralmax=500.0, extendpols=False, growaround=False,
+				flagneartime=False, flagnearfreq=False, **mysel))
+	runflagplan(myfile1, myflagplan, 'doflag')
 # Now summary
 	flagdata(vis=myfile1,mode="summary",datacolumn="corrected", extendflags=True, 
-         name=vis+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
+         name=vis+'summary.split', action="apply", flagbackup=False,overwrite=True, writeflags=True)
+	mysaveflags(myfile1,'doflag')
+	mystagedone('doflag', {}, [myfile1])
 
 
 #################### new redocal #########################3
 # Calibration begins.
-if redocal == True:
+if mystagetorun('redocal', redocal, lambda: {'vis': myfile1, 'refant': myrefant, 'flagspw': flagspw, 'gainspw': gainspw, 'uvrange': uvracal,
+		'fields': [myampcals, mypcals, mytargets]}):
 	print "You have chosen to redo the calibration on your data."
-	mycalsuffix = 'recal'
 	casalog.filter('INFO')
 #	print "Summary of flagtables before calibration:"
 #	myflagtabs = flagmanager(vis = myfile1, mode ='list')
 #	print 'myflagtabs=',myflagtabs
-	clearcal(vis=myfile1)
-#delmod step to keep model column free of spurious values
-	for i in range(0,len(myampcals)):
-#		delmod(vis=myfile1)	
-		default(setjy)
-		setjy(vis=myfile1, spw=flagspw, field=myampcals[i])
-		print "Done setjy on %s"%(myampcals[i])
-# Delay calibration  using the first flux calibrator in the list - should depend on which is less flagged
-	os.system('rm -rf '+str(myfile1)+'.K1'+mycalsuffix)
-	gaincal(vis=myfile1, caltable=str(myfile1)+'.K1'+mycalsuffix, spw =flagspw, field=myampcals[0], 
-		solint='60s', refant=myrefant,	solnorm= True, gaintype='K', gaintable=[], parang=True)
-	kcorrfield =myampcals[0]
-#	print 'wrote table',str(myfile1)+'.K1'+mycalsuffix
-# an initial bandpass
-	os.system('rm -rf '+str(myfile1)+'.AP.G0'+mycalsuffix)
-	default(gaincal)
-#	gaincal(vis=myfile1, caltable=str(myfile1)+'.AP.G0', append=True, field=str(','.join(mybpcals)), 
-#		spw =flagspw, solint = 'int', refant = myrefant, minsnr = 2.0, solmode ='L1R', gaintype = 'G', calmode = 'ap', gaintable = [str(myfile1)+'.K1'],
-#		interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
-	gaincal(vis=myfile1, caltable=str(myfile1)+'.AP.G0'+mycalsuffix, append=True, field=str(','.join(mybpcals)), 
-		spw =flagspw, solint = 'int', refant = myrefant, minsnr = 2.0, gaintype = 'G', calmode = 'ap', gaintable = [str(myfile1)+'.K1'],
-		interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
-	os.system('rm -rf '+str(myfile1)+'.B1')
-	default(bandpass)
-	bandpass(vis=myfile1, caltable=str(myfile1)+'.B1'+mycalsuffix, spw =flagspw, field=str(','.join(mybpcals)), solint='inf', refant=myrefant, solnorm = True,
-		minsnr=2.0, fillgaps=8, parang = True, gaintable=[str(myfile1)+'.K1'+mycalsuffix,str(myfile1)+'.AP.G0'+mycalsuffix], interp=['nearest,nearestflag','nearest,nearestflag'])
-# do a gaingal on alll calibrators
-	mycals=myampcals+mypcals
-	i=0
-	os.system('rm -rf '+str(myfile1)+'.AP.G.'+mycalsuffix)
-	for i in range(0,len(mycals)):
-		mygaincal_ap2(myfile1,mycals[i],myrefant,gainspw,uvracal,mycalsuffix)
-# Get flux scale
-#if doinitcal == True:	
-	os.system('rm -rf '+str(myfile1)+'.fluxscale'+mycalsuffix)
-########################################
-	if mypcals !=[]:
-		if '3C286' in myampcals:
-#			myfluxscale= getfluxcal(myfile1,'3C286',str(', '.join(mypcals)))
-			myfluxscale= getfluxcal2(myfile1,'3C286',str(', '.join(mypcals)),mycalsuffix)
-			myfluxscaleref = '3C286'
-		elif '3C147' in myampcals:
-#			myfluxscale= getfluxcal(myfile1,'3C147',str(', '.join(mypcals)))
-			myfluxscale= getfluxcal2(myfile1,'3C147',str(', '.join(mypcals)),mycalsuffix)
-			myfluxscaleref = '3C147'
-		else:
-#			myfluxscale= getfluxcal(myfile1,myampcals[0],str(', '.join(mypcals)))
-			myfluxscale= getfluxcal2(myfile1,myampcals[0],str(', '.join(mypcals)),mycalsuffix)
-			myfluxscaleref = myampcals[0]
-		print myfluxscale
-		mygaintables =[str(myfile1)+'.fluxscale'+mycalsuffix,str(myfile1)+'.K1'+mycalsuffix, str(myfile1)+'.B1'+mycalsuffix]
-	else:
-		mygaintables =[str(myfile1)+'.AP.G.'+mycalsuffix,str(myfile1)+'.K1'+mycalsuffix, str(myfile1)+'.B1'+mycalsuffix]
-###############################################################
-	for i in range(0,len(myampcals)):
-		default(applycal)
-		applycal(vis=myfile1, field=myampcals[i], spw = flagspw, gaintable=mygaintables, gainfield=[myampcals[i],'',''], 
-        		 interp=['nearest','',''], calwt=[False], parang=False)
-#For phase calibrator:
-	if mypcals !=[]:
-		default(applycal)
-		applycal(vis=myfile1, field=str(', '.join(mypcals)), spw = flagspw, gaintable=mygaintables, gainfield=str(', '.join(mypcals)), 
-		         interp=['nearest','','nearest'], calwt=[False], parang=False)
-#For the target:
-	if target ==True:
-		if mypcals !=[]:
-			default(applycal)
-			applycal(vis=myfile1, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-		        	 gainfield=[str(', '.join(mypcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
-		else:
-			default(applycal)
-			applycal(vis=myfile1, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-		        	 gainfield=[str(', '.join(myampcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)			
+	mygaintables = mycalibrate(myfile1,myampcals,mypcals,mytargets,myrefant,flagspw,gainspw,uvracal,'recal')
 	print "Finished re-calibration."
+	mystagedone('redocal', {'gaintables': mygaintables}, [myfile1]+mygaintables)
 #	print "Summary of flagtables after initial calibration:"
 #	myflagtabs = flagmanager(vis = myfile1, mode ='list')
 #	print 'myflagtabs=',myflagtabs
@@ -988,59 +3049,107 @@ if redocal == True:
 #############################################################
 # SPLIT step
 #############################################################
-if dosplit == True:
+if mystagetorun('split', dosplit, lambda: {'vis': myfile1, 'spw': gainspw}):
 	print "The data on targets will be split into separate files."
 	casalog.filter('INFO')
 # fix targets
 	myfields = getfields(myfile1)
-	stdcals = ['3C48','3C147','3C286','0542+498','1331+305','0137+331']
-	vlacals = np.loadtxt('./vla-cals.list',dtype='string')
-	myampcals =[]
-	mypcals=[]
-	mytargets=[]
-	for i in range(0,len(myfields)):
-		if myfields[i] in stdcals:
-			myampcals.append(myfields[i])
-		elif myfields[i] in vlacals:
-			mypcals.append(myfields[i])
-		else:
-			mytargets.append(myfields[i])
+	myampcals, mypcals, mytargets = getfieldtypes(myfile1,'./vla-cals.list',calpostol)
+	mysplitfiles = []
 	for i in range(0,len(mytargets)):
 		os.system('rm -rf '+mytargets[i]+'split.ms')
 		mysplitfile = mysplitinit(myfile1,mytargets[i],gainspw,1)
+		mysplitfiles.append(mysplitfile)
+	if dotargetpool == True:
+		mystagedone('split', {'mysplitfiles': mysplitfiles, 'mysplitfile': mysplitfile}, [])
+	else:
+		mystagedone('split', {'mysplitfiles': mysplitfiles, 'mysplitfile': mysplitfile}, mysplitfiles)
+elif dosplit == True:
+	mysplitfiles = mystageoutputs('split')['mysplitfiles']
+	mysplitfile = mystageoutputs('split')['mysplitfile']
+
+if dotargetpool == True:
+	if dosplit == False:
+		mysplitfiles = [mysplitfile]
+	mystages = [mystage for mystage in ['mysplitflag','dosplitavg','doflagavg','makedirty','doselfcal'] if globals()[mystage] == True]
+	if mystages != []:
+		runtargetpool(mysplitfiles,mystages,poolmem*1.0E09)
+	mysplitflag = False
+	dosplitavg = False
+	doflagavg = False
+	makedirty = False
+	doselfcal = False
+
+mysubstages = [mystage for mystage in ['mysplitflag','dosplitavg','doflagavg'] if globals()[mystage] == True]
+if nsubbands > 1 and mysubstages != []:
+	if mystagetorun('subbands', True, {'vis': mysplitfile, 'nsub': nsubbands, 'stages': mysubstages, 'width': mywidth2, 'smearloss': smearloss}):
+		mysubbandfile = runsubbands(mysplitfile,nsubbands,mysubstages,poolmem*1.0E09)
+		if mysubbandfile != '':
+			mystagedone('subbands', {'mysubbandfile': mysubbandfile}, [mysubbandfile])
+	else:
+		mysubbandfile = mystageoutputs('subbands')['mysubbandfile']
+	if mysubbandfile == '':
+		print "Flagging and averaging the whole band in this process instead."
+	else:
+		if 'dosplitavg' in mysubstages:
+			mysplitavgfile = mysubbandfile
+		mysplitflag = False
+		dosplitavg = False
+		doflagavg = False
 
 #############################################################
 # Flagging on split file
 #############################################################
 
-if mysplitflag == True:
+if mystagetorun('splitflag', mysplitflag, {'vis': mysplitfile}):
 	print "You have chosen to flag on the split file."
 	myantselect =''
-	mytfcrop(mysplitfile,'',myantselect,8.0,8.0,'DATA','')
+	mysplitplan = None
+	if flagshards > 1:
+		mysplitplan = []	# collect the commands and run them on groups of scans in parallel
+	mytfcrop(mysplitfile,'',myantselect,8.0,8.0,'DATA','',mysplitplan)
 	a, b = getbllists(mysplitfile)
 	tdev = 6.0
 	fdev = 6.0
-	myrflag(mysplitfile,'',a[0],tdev,fdev,'DATA','')
+	for mysel in a:
+		myrflag(mysplitfile,'',mysel,tdev,fdev,'DATA','',mysplitplan)
 	tdev = 5.0
 	fdev = 5.0
-	myrflag(mysplitfile,'',b[0],tdev,fdev,'DATA','')
+	for mysel in b:
+		myrflag(mysplitfile,'',mysel,tdev,fdev,'DATA','',mysplitplan)
+	if mysplitplan is not None:
+		mysplitpasses = [[mycmd] for mycmd in mysplitplan]	# one flagdata call per command, in the same order as above
+		if runflagshards(mysplitfile, mysplitpasses, 'splitflag', flagshards) == False:
+			runflagpasses(mysplitfile, mysplitpasses)
+		mynflagbackups += len(mysplitplan)
+	mystagedone('splitflag', {}, [mysplitfile])
 	
 
 #############################################################
 # SPLIT AVERAGE
 #############################################################
 
-if dosplitavg == True:
-	print "Your data will be averaged in frequency."
-#	os.system('rm -rf '+mytargets[i]+'avg-split.ms')
-	mysplitavgfile = mysplitavg(mysplitfile,'','',mywidth2)
+if mystagetorun('splitavg', dosplitavg, {'vis': mysplitfile, 'width': mywidth2, 'smearloss': smearloss, 'smearmaxtime': smearmaxtime}):
+	if smearloss > 0.0:
+		print "Your data will be averaged in frequency and time within the smearing budget."
+		mysplitavgfile, mysmearbudget = mysplitsmear(mysplitfile,myimsize,mycell,smearloss,smearmaxtime,
+			float(os.environ.get('CAPTURE_SMEARFREQ', 0.0)))
+		mystagedone('splitavg', {'mysplitavgfile': mysplitavgfile, 'smearing': mysmearbudget}, [mysplitavgfile])
+	else:
+		print "Your data will be averaged in frequency."
+#		os.system('rm -rf '+mytargets[i]+'avg-split.ms')
+		mysplitavgfile = mysplitavg(mysplitfile,'','',mywidth2)
+		mystagedone('splitavg', {'mysplitavgfile': mysplitavgfile}, [mysplitavgfile])
+elif dosplitavg == True:
+	mysplitavgfile = mystageoutputs('splitavg')['mysplitavgfile']
 
 
-if doflagavg == True:
+if mystagetorun('flagavg', doflagavg, {'vis': mysplitavgfile}):
 	print "Flagging on freqeuncy averaged data."
 	a, b = getbllists(mysplitavgfile)
-	myrflagavg(mysplitavgfile,'',b[0],6.0,6.0,'DATA','')
-	myrflagavg(mysplitavgfile,'',a[0],6.0,6.0,'DATA','')
+	for mysel in b+a:
+		myrflagavg(mysplitavgfile,'',mysel,6.0,6.0,'DATA','')
+	mystagedone('flagavg', {}, [mysplitavgfile])
 
 
 ############################################################
@@ -1053,9 +3162,12 @@ if makedirty == True:
 
 if doselfcal == True:
 	casalog.filter('INFO')
-	clearcal(vis = mysplitavgfile)
 	myfile2 = [mysplitavgfile]
 	if usetclean == True:
 		myselfcal(myfile2,myrefant,scaloops,mypcaloops,mythresholds,mycell,myimsize,mynterms,mywproj2,mysolint2,clipresid,'','',makedirty)
 
+if runreport != '':
+	printreport()
 
+if os.environ.has_key('CAPTURE_STAGES'):
+	open(workerdone,'w').write(time.strftime('%Y-%m-%d %H:%M:%S')+'\n')	# tells runworkers that this worker got to the end